@@ -75,6 +75,12 @@ KNOWN_COMMANDS = {
 KNOWN_COMMANDS_TRIGGERING_COLLECTSTATIC = {'runserver', 'gunicorn'}
 
 
+# the tests run with their own configuration, with all the tested apps
+KNOWN_COMMANDS_CONF_DIRS = {
+    "tests": os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf", "tests", "zentral"),
+}
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         warnings.warn("Not enough arguments.")
@@ -87,6 +93,9 @@ if __name__ == '__main__':
         wait_for_db_migration()
         if cmd in KNOWN_COMMANDS_TRIGGERING_COLLECTSTATIC:
             django_collectstatic()
+        conf_dir = KNOWN_COMMANDS_CONF_DIRS.get(cmd)
+        if conf_dir:
+            os.environ["ZENTRAL_CONF_DIR"] = conf_dir
         print('Launch known command "{}"'.format(cmd))
     else:
         filename = cmd
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from zentral.core.stores import stores
+
+
+class Command(BaseCommand):
+    help = 'Delete the old events from the event stores.'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int,
+                            help="keep the events of the last DAYS days. Defaults to the store retention_days")
+        parser.add_argument("store", nargs="*", help="store names. Defaults to all the stores")
+
+    def handle(self, *args, **kwargs):
+        before = None
+        days = kwargs.get("days")
+        if days is not None:
+            before = datetime.utcnow() - timedelta(days=days)
+        store_names = kwargs["store"]
+        for store in stores:
+            if store_names and store.name not in store_names:
+                continue
+            store.wait_and_configure_if_necessary()
+            for deleted in store.prune_events(before):
+                print("Store", store.name, deleted, "deleted")
@@ -140,6 +140,14 @@ for key in ('HOST', 'PASSWORD', 'PORT'):
     if val:
         DATABASES['default'][key] = val
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# the default cache is a per-process memory cache, and its invalidations are process-local.
+# a shared cache is required for the cross-process invalidations (node keys, …)
+
+if "CACHES" in django_zentral_settings:
+    CACHES = django_zentral_settings["CACHES"]
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
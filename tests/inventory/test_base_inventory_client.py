@@ -0,0 +1,43 @@
+from datetime import datetime
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from zentral.contrib.inventory.clients.dummy import InventoryClient
+
+
+class BaseInventoryClientTestCase(SimpleTestCase):
+    def test_sync_settings_not_in_source_config(self):
+        client = InventoryClient({"backend": "zentral.contrib.inventory.clients.dummy",
+                                  "sync_workers": 8,
+                                  "sync_interval": 120})
+        self.assertEqual(client.sync_workers, 8)
+        self.assertEqual(client.sync_interval, 120)
+        self.assertEqual(client.source["config"], {})
+
+    def test_is_machine_unchanged(self):
+        client = InventoryClient({"backend": "zentral.contrib.inventory.clients.dummy"})
+        last_seen = datetime.utcnow()
+        self.assertFalse(client.is_machine_unchanged("0123456789", last_seen))
+        client.last_seen_cache["0123456789"] = last_seen
+        self.assertTrue(client.is_machine_unchanged("0123456789", last_seen))
+        self.assertFalse(client.is_machine_unchanged("0123456789", datetime.utcnow()))
+        self.assertFalse(client.is_machine_unchanged("0123456789", None))
+
+    @patch("zentral.contrib.inventory.clients.base.BaseInventory.get_inventory_source")
+    @patch("zentral.contrib.inventory.clients.base.commit_machine_snapshot_and_trigger_events")
+    def test_sync_commit_error(self, commit, get_inventory_source):
+        get_inventory_source.return_value = None
+        committed_serial_numbers = []
+
+        def commit_side_effect(machine_d):
+            if machine_d["serial_number"] == "0123456789":
+                raise ValueError("YOLO")
+            committed_serial_numbers.append(machine_d["serial_number"])
+            return True
+
+        commit.side_effect = commit_side_effect
+        client = InventoryClient({"backend": "zentral.contrib.inventory.clients.dummy",
+                                  "sync_workers": 1})
+        client.sync()
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(committed_serial_numbers, ["9876543210"])
+        self.assertNotIn("0123456789", client.last_seen_cache)
@@ -0,0 +1,34 @@
+from django.test import SimpleTestCase
+from zentral.contrib.inventory.clients.http import InventoryAPISession
+
+
+class FakeAPISession(InventoryAPISession):
+    def __init__(self, item_count, **kwargs):
+        super().__init__("https://www.example.com/api", "Fake", **kwargs)
+        self.items = list(range(item_count))
+        self.fetched_pages = []
+
+    def get_json(self, path, **params):
+        page = params["page"]
+        self.fetched_pages.append(page)
+        return self.items[(page - 1) * 10:page * 10]
+
+
+class InventoryAPISessionTestCase(SimpleTestCase):
+    def test_iter_paginated_json(self):
+        for item_count in (0, 5, 10, 35, 100):
+            session = FakeAPISession(item_count, max_workers=3)
+            self.assertEqual(list(session.iter_paginated_json("/items", page_size=10)),
+                             session.items)
+
+    def test_iter_paginated_json_prefetch(self):
+        session = FakeAPISession(15, max_workers=4)
+        list(session.iter_paginated_json("/items", page_size=10))
+        # the pages 1 to 4 are requested before the end is known
+        self.assertEqual(sorted(session.fetched_pages)[:2], [1, 2])
+        self.assertTrue(len(session.fetched_pages) <= 4)
+
+    def test_map(self):
+        session = FakeAPISession(0, max_workers=4)
+        self.assertEqual(list(session.map(lambda i: 2 * i, range(20))),
+                         [2 * i for i in range(20)])
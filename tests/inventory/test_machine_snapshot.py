@@ -228,6 +228,60 @@ class MachineSnapshotTestCase(TestCase):
         self.assertEqual(MachineSnapshotCommit.objects.count(), 3)
         self.assertEqual(CurrentMachineSnapshot.objects.count(), 0)
 
+    def test_meta_machine_bulk_load(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        msc, ms = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["serial_number"] = tree["serial_number"][::-1]
+        msc2, ms2 = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        tag = Tag.objects.create(name="tag name")
+        MachineTag.objects.create(tag=tag, serial_number=self.serial_number)
+        with self.assertNumQueries(3):
+            mm, mm2, mm3 = MetaMachine.bulk_load([self.serial_number, ms2.serial_number, "UNKNOWN"])
+            self.assertEqual(mm.snapshots, [ms])
+            self.assertEqual(mm.tags, [tag])
+            self.assertEqual(mm.platform, MACOS)
+            self.assertEqual(mm2.snapshots, [ms2])
+            self.assertEqual(mm2.tags, [])
+            self.assertEqual(mm3.snapshots, [])
+            self.assertEqual(mm3.tags, [])
+        self.assertEqual(MetaMachine(self.serial_number).tags, mm.tags)
+
+    def test_current_reference_info(self):
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["reference"] = "GODZILLA"
+        msc, ms = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertEqual(MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA"),
+                         (self.serial_number, None, ms.id))
+        # cached
+        with self.assertNumQueries(0):
+            MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA")
+        # invalidated by the commit of a new snapshot
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["reference"] = "GODZILLA"
+        msc2, ms2 = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertEqual(MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA"),
+                         (self.serial_number, None, ms2.id))
+        # invalidated by the archive
+        MetaMachine(self.serial_number).archive()
+        with self.assertRaises(MachineSnapshot.DoesNotExist):
+            MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA")
+
+    def test_current_reference_info_reenroll(self):
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["reference"] = "GODZILLA"
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        # cache the old reference
+        MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA")
+        # re-enroll with a new reference
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["reference"] = "MOTHRA"
+        msc2, ms2 = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        with self.assertRaises(MachineSnapshot.DoesNotExist):
+            MachineSnapshot.objects.current_reference_info(self.source["module"], "GODZILLA")
+        self.assertEqual(MachineSnapshot.objects.current_reference_info(self.source["module"], "MOTHRA"),
+                         (self.serial_number, None, ms2.id))
+
     def test_machine_name(self):
         tree = {"source": {"module": "godzilla",
                            "name": "test"},
@@ -0,0 +1,85 @@
+from unittest.mock import Mock
+from django.test import SimpleTestCase
+from zentral.contrib.jamf.api_client import APIClient
+
+
+class FakeAPIClient(APIClient):
+    def __init__(self):
+        super().__init__("www.example.com", 8443, "/JSSResource", "user", "password", "secret")
+        self.computer_groups = [{"id": 1, "name": "Group 1", "is_smart": True}]
+        self.queries = []
+
+    def _make_get_query(self, path):
+        self.queries.append(path)
+        if path == "/computergroups":
+            return {"computer_groups": self.computer_groups}
+        raise ValueError("Unknown path")
+
+    def get_computer_group_with_name(self, group_name):
+        for computer_group in self.computer_groups:
+            if computer_group["name"] == group_name:
+                return {"computer_group": dict(computer_group, computers=[])}
+
+
+class APIClientGroupCacheTestCase(SimpleTestCase):
+    def test_computer_group_cached(self):
+        client = FakeAPIClient()
+        for _ in range(3):
+            self.assertEqual(client.get_computer_group("Group 1"), (1, True))
+        self.assertEqual(client.queries, ["/computergroups"])
+
+    def test_computer_group_miss_rebuild(self):
+        client = FakeAPIClient()
+        client.get_computer_group("Group 1")
+        # new group, found after one rebuild
+        client.computer_groups.append({"id": 2, "name": "Group 2", "is_smart": False})
+        for _ in range(3):
+            self.assertEqual(client.get_computer_group("Group 2"), (2, False))
+        self.assertEqual(client.queries, ["/computergroups", "/computergroups"])
+
+    def test_computer_group_missing_rebuilds_rate_limited(self):
+        client = FakeAPIClient()
+        client.get_computer_group("Group 1")
+        for _ in range(3):
+            with self.assertRaises(KeyError):
+                client.get_computer_group("Group 2")
+        # only one rebuild to confirm that the group is missing
+        self.assertEqual(client.queries, ["/computergroups", "/computergroups"])
+        # rebuilt again after the delay
+        client.group_cache_missing_keys["reverse_computer_groups"]["Group 2"] -= \
+            client.group_cache_miss_refresh_delay + 1
+        client.computer_groups.append({"id": 2, "name": "Group 2", "is_smart": False})
+        self.assertEqual(client.get_computer_group("Group 2"), (2, False))
+        self.assertEqual(len(client.queries), 3)
+
+    def test_add_computer_to_new_group_invalidates_cache(self):
+        client = FakeAPIClient()
+        client.get_computer_group("Group 1")
+        client.session = Mock()
+        client.session.post.return_value = Mock(status_code=201)
+        client.add_computer_to_group(12, "Group 2")
+        self.assertEqual(client.session.post.call_count, 1)
+        self.assertIsNone(client.reverse_computer_groups_built_at)
+        client.computer_groups.append({"id": 2, "name": "Group 2", "is_smart": False})
+        self.assertEqual(client.get_computer_group("Group 2"), (2, False))
+        self.assertEqual(client.queries, ["/computergroups", "/computergroups"])
+
+    def test_computer_group_cache_ttl(self):
+        client = FakeAPIClient()
+        client.get_computer_group("Group 1")
+        client.reverse_computer_groups_built_at -= client.group_cache_ttl + 1
+        client.get_computer_group("Group 1")
+        self.assertEqual(client.queries, ["/computergroups", "/computergroups"])
+
+    def test_computer_group_cache_invalidation(self):
+        client = FakeAPIClient()
+        client.get_computer_group("Group 1")
+        # known group, no invalidation
+        client.invalidate_group_cache("computer", 1, "Group 1", True)
+        client.get_computer_group("Group 1")
+        self.assertEqual(len(client.queries), 1)
+        # new group
+        client.computer_groups.append({"id": 2, "name": "Group 2", "is_smart": True})
+        client.invalidate_group_cache("computer", 2, "Group 2", True)
+        self.assertEqual(client.get_computer_group("Group 2"), (2, True))
+        self.assertEqual(len(client.queries), 2)
@@ -0,0 +1,69 @@
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from zentral.contrib.jamf.workers import MachineRefreshPreprocessor, WebhookEventPreprocessor
+
+
+JAMF_INSTANCE_D = {"pk": 1, "version": 0,
+                   "host": "www.example.com", "port": 8443, "path": "/JSSResource",
+                   "user": "user", "password": "password", "secret": "secret"}
+
+
+@patch("zentral.contrib.jamf.workers.MachineRefreshMixin.start_deferred_refreshes_thread")
+@patch("zentral.contrib.jamf.workers.MachineRefreshMixin.commit_machine_d", return_value=iter([]))
+class MachineRefreshTestCase(SimpleTestCase):
+    def get_preprocessor(self, preprocessor_cls=WebhookEventPreprocessor):
+        preprocessor = preprocessor_cls()
+        client = preprocessor.get_client(JAMF_INSTANCE_D)
+        client.get_machine_d = Mock(return_value={"serial_number": "0123456789"})
+        return preprocessor, client
+
+    def refresh(self, preprocessor, client, force=False):
+        return list(preprocessor.update_machine(JAMF_INSTANCE_D, client, "computer", 12, force))
+
+    def test_refresh_coalesced_and_deferred(self, commit_machine_d, start_deferred_refreshes_thread):
+        preprocessor, client = self.get_preprocessor()
+        for _ in range(3):
+            self.refresh(preprocessor, client)
+        # only one fetch, one deferred refresh
+        self.assertEqual(client.get_machine_d.call_count, 1)
+        self.assertEqual(len(preprocessor.deferred_refreshes), 1)
+        (due, raw_event), = preprocessor.deferred_refreshes.values()
+        key = preprocessor.get_refresh_key(client, "computer", 12)
+        self.assertEqual(due, preprocessor.last_refreshes[key] + preprocessor.refresh_coalescing_window)
+        self.assertEqual(raw_event, {"jamf_instance": JAMF_INSTANCE_D,
+                                     "device_type": "computer",
+                                     "jamf_ids": [12],
+                                     "deferred": True})
+        # not due before the end of the window
+        self.assertEqual(preprocessor.pop_due_deferred_refreshes(due - 1), [])
+        self.assertEqual(preprocessor.pop_due_deferred_refreshes(due), [raw_event])
+        self.assertEqual(preprocessor.deferred_refreshes, {})
+
+    def test_forced_refresh_not_coalesced(self, commit_machine_d, start_deferred_refreshes_thread):
+        preprocessor, client = self.get_preprocessor()
+        self.refresh(preprocessor, client)
+        self.refresh(preprocessor, client, force=True)
+        self.assertEqual(client.get_machine_d.call_count, 2)
+        self.assertEqual(preprocessor.deferred_refreshes, {})
+
+    def test_failed_refresh_not_recorded(self, commit_machine_d, start_deferred_refreshes_thread):
+        preprocessor, client = self.get_preprocessor()
+        client.get_machine_d.side_effect = ValueError("Boom!")
+        self.refresh(preprocessor, client)
+        self.assertEqual(preprocessor.last_refreshes, {})
+        client.get_machine_d.side_effect = None
+        self.refresh(preprocessor, client)
+        self.assertEqual(client.get_machine_d.call_count, 2)
+        self.assertEqual(preprocessor.deferred_refreshes, {})
+        self.assertEqual(len(preprocessor.last_refreshes), 1)
+
+    def test_deferred_refresh_processed(self, commit_machine_d, start_deferred_refreshes_thread):
+        preprocessor, client = self.get_preprocessor(MachineRefreshPreprocessor)
+        self.refresh(preprocessor, client)
+        list(preprocessor.process_raw_event({"jamf_instance": JAMF_INSTANCE_D,
+                                             "device_type": "computer",
+                                             "jamf_ids": [12],
+                                             "deferred": True}))
+        # the deferred refresh is due, even if the window is not over in this worker
+        self.assertEqual(client.get_machine_d.call_count, 2)
+        self.assertEqual(preprocessor.deferred_refreshes, {})
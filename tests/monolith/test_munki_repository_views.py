@@ -0,0 +1,131 @@
+import plistlib
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from accounts.models import User
+from zentral.contrib.inventory.models import MetaBusinessUnit
+from zentral.contrib.monolith.models import (build_signed_name,
+                                             Catalog, Manifest, ManifestCatalog, ManifestSubManifest,
+                                             MANIFEST_VERSION_CACHE_KEY,
+                                             PkgInfo, PkgInfoName, SubManifest, SubManifestPkgInfo)
+from zentral.utils.api_views import make_secret
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+@patch("zentral.contrib.monolith.views.post_monolith_repository_updates")
+@patch("zentral.contrib.monolith.views.post_monolith_munki_request")
+class MonolithMunkiRepositoryViewsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pwd = "godzillapwd"
+        cls.user = User.objects.create_user("godzilla", "godzilla@zentral.io", cls.pwd)
+        cls.mbu = MetaBusinessUnit.objects.create(name="MBU")
+        cls.bu = cls.mbu.create_enrollment_business_unit()
+        cls.manifest = Manifest.objects.create(meta_business_unit=cls.mbu)
+        cls.production = Catalog.objects.create(name="production")
+        cls.testing = Catalog.objects.create(name="testing")
+        ManifestCatalog.objects.create(manifest=cls.manifest, catalog=cls.production)
+        cls.pkg_info = PkgInfo.objects.create(name=PkgInfoName.objects.create(name="firefox"),
+                                              version="1.0",
+                                              data={"name": "firefox",
+                                                    "version": "1.0",
+                                                    "installer_item_location": "firefox-1.0.dmg"})
+        cls.pkg_info.catalogs.set([cls.production])
+
+    def setUp(self):
+        cache.clear()
+
+    def munki_get(self, section, name, **extra):
+        token = "{}$SERIAL$0123456789".format(make_secret("zentral.contrib.monolith", self.bu))
+        return self.client.get("/monolith/munki_repo/{}/{}".format(section, name),
+                               HTTP_X_MONOLITH_TOKEN=token, **extra)
+
+    # catalogs
+
+    def test_catalog_etag(self, post_monolith_munki_request, post_monolith_repository_updates):
+        response = self.munki_get("catalogs", self.production.get_signed_name())
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        pkg_info_data, = plistlib.loads(response.content)
+        self.assertEqual(pkg_info_data["name"], "firefox")
+        # not modified
+        response = self.munki_get("catalogs", self.production.get_signed_name(),
+                                  HTTP_IF_NONE_MATCH='"yolo", {}'.format(etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+    def test_catalog_not_in_manifest(self, post_monolith_munki_request, post_monolith_repository_updates):
+        response = self.munki_get("catalogs", self.testing.get_signed_name())
+        self.assertEqual(response.status_code, 404)
+
+    def test_catalog_cache_invalidated_after_edit(self, post_monolith_munki_request,
+                                                  post_monolith_repository_updates):
+        response = self.munki_get("catalogs", self.production.get_signed_name())
+        etag = response["ETag"]
+        # move the pkg info to the testing catalog
+        self.client.force_login(self.user)
+        response = self.client.post(reverse("monolith:update_pkg_info_catalog", args=(self.pkg_info.pk,)),
+                                    {"catalogs": self.testing.pk})
+        self.assertEqual(response.status_code, 302)
+        response = self.munki_get("catalogs", self.production.get_signed_name(),
+                                  HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(plistlib.loads(response.content), [])
+
+    # packages
+
+    def add_pkg_info_to_manifest(self):
+        sub_manifest = SubManifest.objects.create(name="browsers")
+        SubManifestPkgInfo.objects.create(sub_manifest=sub_manifest, key="managed_installs",
+                                          pkg_info_name=self.pkg_info.name)
+        ManifestSubManifest.objects.create(manifest=self.manifest, sub_manifest=sub_manifest)
+
+    def test_manifests_version_cached(self, post_monolith_munki_request, post_monolith_repository_updates):
+        with patch("zentral.contrib.monolith.models.ManifestManager._compute_version",
+                   return_value="yolo") as compute_version:
+            for _ in range(3):
+                self.assertEqual(Manifest.objects.version(), "yolo")
+        compute_version.assert_called_once_with()
+
+    @patch("zentral.contrib.monolith.repository_backends.local.Repository.make_munki_repository_response")
+    def test_package(self, make_munki_repository_response,
+                     post_monolith_munki_request, post_monolith_repository_updates):
+        make_munki_repository_response.return_value = HttpResponse("firefox")
+        package_name = "{}.dmg".format(build_signed_name("repository_package", self.pkg_info.pk))
+        response = self.munki_get("pkgs", package_name)
+        self.assertEqual(response.status_code, 404)
+        self.add_pkg_info_to_manifest()
+        # the manifests version is cached
+        response = self.munki_get("pkgs", package_name)
+        self.assertEqual(response.status_code, 404)
+        # new manifests version
+        cache.delete(MANIFEST_VERSION_CACHE_KEY)
+        response = self.munki_get("pkgs", package_name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"firefox")
+        make_munki_repository_response.assert_called_once_with("pkgs", "firefox-1.0.dmg", cache_server=None)
+
+    # manifests
+
+    def test_manifest_cached(self, post_monolith_munki_request, post_monolith_repository_updates):
+        with patch.object(Manifest, "serialize", autospec=True, side_effect=Manifest.serialize) as serialize:
+            for _ in range(3):
+                response = self.munki_get("manifests", "0123456789")
+                self.assertEqual(response.status_code, 200)
+                manifest_data = plistlib.loads(response.content)
+                self.assertEqual(manifest_data["catalogs"][0], self.production.get_signed_name())
+        self.assertEqual(serialize.call_count, 1)
+
+    def test_manifest_cache_invalidated_after_edit(self, post_monolith_munki_request,
+                                                   post_monolith_repository_updates):
+        response = self.munki_get("manifests", "0123456789")
+        self.assertNotIn(self.testing.get_signed_name(), plistlib.loads(response.content)["catalogs"])
+        ManifestCatalog.objects.create(manifest=self.manifest, catalog=self.testing)
+        # new manifests version
+        cache.delete(MANIFEST_VERSION_CACHE_KEY)
+        response = self.munki_get("manifests", "0123456789")
+        self.assertIn(self.testing.get_signed_name(), plistlib.loads(response.content)["catalogs"])
@@ -0,0 +1,121 @@
+import io
+import os.path
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
+from django.test import SimpleTestCase
+from zentral.contrib.monolith.exceptions import RepositoryError
+from zentral.contrib.monolith.repository_backends.http import Repository as HTTPRepository
+from zentral.contrib.monolith.repository_backends.local import Repository as LocalRepository
+from zentral.contrib.monolith.repository_backends.s3 import Repository as S3Repository
+
+
+class MonolithRepositoryBackendsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for attr, filename in (("get_all_catalog_local_path", "all_catalog.xml"),
+                               ("get_all_catalog_state_path", "all_catalog_state.json")):
+            patcher = patch("zentral.contrib.monolith.repository_backends.base.BaseRepository.{}".format(attr),
+                            return_value=os.path.join(self.root, filename))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def read_all_catalog(self, repository):
+        with open(repository.get_all_catalog_local_path(), "rb") as f:
+            return f.read()
+
+    # http
+
+    @patch("zentral.contrib.monolith.repository_backends.http.requests.get")
+    def test_http_conditional_get(self, requests_get):
+        repository = HTTPRepository({"root": "https://www.example.com/munki_repo/"})
+        requests_get.return_value = Mock(status_code=200,
+                                         headers={"ETag": '"yolo"',
+                                                  "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+                                         iter_content=Mock(return_value=[b"all", b"catalog"]))
+        repository.download_all_catalog()
+        requests_get.assert_called_once_with("https://www.example.com/munki_repo/catalogs/all",
+                                             headers={}, stream=True)
+        self.assertEqual(self.read_all_catalog(repository), b"allcatalog")
+        self.assertEqual(repository.load_all_catalog_state(),
+                         {"etag": '"yolo"', "last_modified": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        # not modified
+        requests_get.reset_mock()
+        requests_get.return_value = Mock(status_code=304)
+        self.assertEqual(repository.download_all_catalog(), repository.get_all_catalog_local_path())
+        requests_get.assert_called_once_with("https://www.example.com/munki_repo/catalogs/all",
+                                             headers={"If-None-Match": '"yolo"',
+                                                      "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"},
+                                             stream=True)
+        self.assertEqual(self.read_all_catalog(repository), b"allcatalog")
+
+    @patch("zentral.contrib.monolith.repository_backends.http.requests.get")
+    def test_http_error(self, requests_get):
+        repository = HTTPRepository({"root": "https://www.example.com/munki_repo/"})
+        requests_get.return_value = Mock(status_code=500)
+        with self.assertRaises(RepositoryError):
+            repository.download_all_catalog()
+        self.assertFalse(os.path.exists(repository.get_all_catalog_local_path()))
+
+    # s3
+
+    def test_s3_conditional_get(self):
+        repository = S3Repository({"aws_access_key_id": "yolo",
+                                   "aws_secret_access_key": "fomo",
+                                   "bucket": "munki",
+                                   "prefix": "repo"})
+        repository._client = Mock()
+        repository._client.get_object.return_value = {"Body": io.BytesIO(b"allcatalog"),
+                                                      "ETag": '"yolo"'}
+        repository.download_all_catalog()
+        repository._client.get_object.assert_called_once_with(Bucket="munki", Key="repo/catalogs/all")
+        self.assertEqual(self.read_all_catalog(repository), b"allcatalog")
+        self.assertEqual(repository.load_all_catalog_state(), {"etag": '"yolo"'})
+        # not modified
+        repository._client.get_object.reset_mock()
+        repository._client.get_object.side_effect = ClientError({"Error": {"Code": "304"}}, "GetObject")
+        self.assertEqual(repository.download_all_catalog(), repository.get_all_catalog_local_path())
+        repository._client.get_object.assert_called_once_with(Bucket="munki", Key="repo/catalogs/all",
+                                                              IfNoneMatch='"yolo"')
+        self.assertEqual(self.read_all_catalog(repository), b"allcatalog")
+        # error
+        repository._client.get_object.side_effect = ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+        with self.assertRaises(RepositoryError):
+            repository.download_all_catalog()
+
+    # sync
+
+    @patch("zentral.contrib.monolith.repository_backends.base.BaseRepository._sync_catalogs")
+    def test_sync_skipped(self, _sync_catalogs):
+        os.mkdir(os.path.join(self.root, "catalogs"))
+        with open(os.path.join(self.root, "catalogs", "all"), "wb") as f:
+            f.write(b"allcatalog")
+        repository = LocalRepository({"root": self.root})
+        sync_key = repository.get_all_catalog_sync_key(repository.download_all_catalog())
+        repository.update_all_catalog_state(synced=sync_key)
+        timings = repository.sync_catalogs()
+        self.assertEqual(list(timings.keys()), ["download"])
+        _sync_catalogs.assert_not_called()
+        # the default catalog is part of the sync key
+        repository = LocalRepository({"root": self.root,
+                                      "manual_catalog_management": True,
+                                      "default_catalog": "yolo"})
+        self.assertNotEqual(repository.get_all_catalog_sync_key(repository.download_all_catalog()), sync_key)
+
+    # local copy
+
+    def test_save_all_catalog_error(self):
+        repository = HTTPRepository({"root": "https://www.example.com/munki_repo/"})
+        repository.save_all_catalog([b"all", b"catalog"])
+
+        def failing_chunks():
+            yield b"partial"
+            raise ValueError("Boom!")
+
+        with self.assertRaises(ValueError):
+            repository.save_all_catalog(failing_chunks())
+        # previous copy kept, no temporary files left behind
+        self.assertEqual(self.read_all_catalog(repository), b"allcatalog")
+        self.assertEqual(os.listdir(self.root), ["all_catalog.xml"])
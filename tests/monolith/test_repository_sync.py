@@ -0,0 +1,129 @@
+import os.path
+import plistlib
+import shutil
+import tempfile
+from unittest.mock import patch
+from django.test import TestCase
+from zentral.contrib.monolith.models import Catalog, PkgInfo
+from zentral.contrib.monolith.repository_backends.local import Repository
+
+
+def build_pkg_info_data(name, version, catalogs=None, **kwargs):
+    pkg_info_data = {"name": name,
+                     "version": version,
+                     "catalogs": catalogs or ["production"]}
+    pkg_info_data.update(kwargs)
+    return pkg_info_data
+
+
+@patch("zentral.contrib.monolith.repository_backends.base.post_monolith_repository_updates")
+class MonolithRepositorySyncTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "catalogs"))
+        state_path_patcher = patch("zentral.contrib.monolith.repository_backends.base."
+                                   "BaseRepository.get_all_catalog_state_path",
+                                   return_value=os.path.join(self.root, "all_catalog_state.json"))
+        state_path_patcher.start()
+        self.addCleanup(state_path_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def sync(self, post_monolith_repository_updates, pkg_info_data_list, **config):
+        with open(os.path.join(self.root, "catalogs", "all"), "wb") as f:
+            plistlib.dump(pkg_info_data_list, f)
+        config["root"] = self.root
+        Repository(config).sync_catalogs()
+        (_, event_payloads), _ = post_monolith_repository_updates.call_args
+        post_monolith_repository_updates.reset_mock()
+        return event_payloads
+
+    def get_pkg_info_actions(self, event_payloads):
+        return sorted((p["pkg_info"]["name"], p["pkg_info"]["version"], p["action"])
+                      for p in event_payloads if p["type"] == "pkg_info")
+
+    def test_added_pkg_infos(self, post_monolith_repository_updates):
+        event_payloads = self.sync(post_monolith_repository_updates,
+                                   [build_pkg_info_data("firefox", "1.0", requires=["munkitools"],
+                                                        category="Browsers"),
+                                    build_pkg_info_data("munkitools", "3.0", catalogs=["production", "testing"])])
+        self.assertEqual(self.get_pkg_info_actions(event_payloads),
+                         [("firefox", "1.0", "added"), ("munkitools", "3.0", "added")])
+        self.assertEqual(sorted(p["catalog"]["name"] for p in event_payloads if p["type"] == "catalog"),
+                         ["production", "testing"])
+        self.assertEqual([p["category"]["name"] for p in event_payloads if p["type"] == "category"],
+                         ["Browsers"])
+        firefox = PkgInfo.objects.get(name__name="firefox")
+        self.assertEqual(firefox.category.name, "Browsers")
+        self.assertEqual([c.name for c in firefox.catalogs.all()], ["production"])
+        self.assertEqual([pin.name for pin in firefox.requires.all()], ["munkitools"])
+        self.assertIsNotNone(firefox.data_hash)
+        munkitools = PkgInfo.objects.get(name__name="munkitools")
+        self.assertEqual(sorted(c.name for c in munkitools.catalogs.all()), ["production", "testing"])
+
+    def test_unchanged_pkg_infos(self, post_monolith_repository_updates):
+        pkg_info_data_list = [build_pkg_info_data("firefox", "1.0")]
+        self.sync(post_monolith_repository_updates, pkg_info_data_list)
+        catalog_updated_at = Catalog.objects.get(name="production").updated_at
+        event_payloads = self.sync(post_monolith_repository_updates, pkg_info_data_list)
+        self.assertEqual(event_payloads, [])
+        # catalog cache not invalidated
+        self.assertEqual(Catalog.objects.get(name="production").updated_at, catalog_updated_at)
+
+    def test_changed_pkg_info(self, post_monolith_repository_updates):
+        self.sync(post_monolith_repository_updates, [build_pkg_info_data("firefox", "1.0")])
+        data_hash = PkgInfo.objects.get(name__name="firefox").data_hash
+        catalog_updated_at = Catalog.objects.get(name="production").updated_at
+        event_payloads = self.sync(post_monolith_repository_updates,
+                                   [build_pkg_info_data("firefox", "1.0", description="Web browser")])
+        self.assertEqual(self.get_pkg_info_actions(event_payloads), [("firefox", "1.0", "updated")])
+        event_payload, = event_payloads
+        self.assertEqual(event_payload["pkg_info"]["diff"]["data"]["added"]["description"], "Web browser")
+        firefox = PkgInfo.objects.get(name__name="firefox")
+        self.assertEqual(firefox.data["description"], "Web browser")
+        self.assertNotEqual(firefox.data_hash, data_hash)
+        # catalog cache invalidated
+        self.assertTrue(Catalog.objects.get(name="production").updated_at > catalog_updated_at)
+
+    def test_archived_pkg_info(self, post_monolith_repository_updates):
+        self.sync(post_monolith_repository_updates,
+                  [build_pkg_info_data("firefox", "1.0"),
+                   build_pkg_info_data("firefox", "2.0")])
+        event_payloads = self.sync(post_monolith_repository_updates,
+                                   [build_pkg_info_data("firefox", "2.0")])
+        self.assertEqual(self.get_pkg_info_actions(event_payloads), [("firefox", "1.0", "archived")])
+        self.assertIsNotNone(PkgInfo.objects.get(name__name="firefox", version="1.0").archived_at)
+        self.assertIsNone(PkgInfo.objects.get(name__name="firefox", version="2.0").archived_at)
+        # back in the repository
+        event_payloads = self.sync(post_monolith_repository_updates,
+                                   [build_pkg_info_data("firefox", "1.0"),
+                                    build_pkg_info_data("firefox", "2.0")])
+        self.assertEqual(self.get_pkg_info_actions(event_payloads), [("firefox", "1.0", "added")])
+        self.assertIsNone(PkgInfo.objects.get(name__name="firefox", version="1.0").archived_at)
+
+    def test_recatalogued_pkg_info(self, post_monolith_repository_updates):
+        self.sync(post_monolith_repository_updates, [build_pkg_info_data("firefox", "1.0")])
+        event_payloads = self.sync(post_monolith_repository_updates,
+                                   [build_pkg_info_data("firefox", "1.0", catalogs=["testing"])])
+        self.assertEqual(self.get_pkg_info_actions(event_payloads), [("firefox", "1.0", "updated")])
+        self.assertEqual(sorted((p["catalog"]["name"], p["action"])
+                                for p in event_payloads if p["type"] == "catalog"),
+                         [("production", "archived"), ("testing", "added")])
+        firefox = PkgInfo.objects.get(name__name="firefox")
+        self.assertEqual([c.name for c in firefox.catalogs.all()], ["testing"])
+        self.assertIsNotNone(Catalog.objects.get(name="production").archived_at)
+
+    def test_default_catalog_change(self, post_monolith_repository_updates):
+        pkg_info_data_list = [build_pkg_info_data("firefox", "1.0")]
+        self.sync(post_monolith_repository_updates, pkg_info_data_list,
+                  manual_catalog_management=True, default_catalog="Default 1")
+        firefox = PkgInfo.objects.get(name__name="firefox")
+        self.assertEqual([c.name for c in firefox.catalogs.all()], ["Default 1"])
+        data_hash = firefox.data_hash
+        event_payloads = self.sync(post_monolith_repository_updates, pkg_info_data_list,
+                                   manual_catalog_management=True, default_catalog="Default 2")
+        self.assertEqual([(p["catalog"]["name"], p["action"]) for p in event_payloads],
+                         [("Default 2", "added")])
+        # the pkg info is not skipped
+        self.assertNotEqual(PkgInfo.objects.get(name__name="firefox").data_hash, data_hash)
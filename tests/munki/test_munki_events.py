@@ -0,0 +1,31 @@
+from datetime import datetime, timezone
+from django.test import SimpleTestCase
+from zentral.contrib.munki.events import build_munki_events, parse_munki_time
+
+
+class MunkiEventsTestCase(SimpleTestCase):
+    def test_parse_munki_time(self):
+        self.assertEqual(parse_munki_time("2017-11-08 17:49:12 +0000"),
+                         datetime(2017, 11, 8, 17, 49, 12, tzinfo=timezone.utc))
+        # other formats
+        self.assertEqual(parse_munki_time("2017-11-08T18:49:12+01:00"),
+                         datetime(2017, 11, 8, 17, 49, 12, tzinfo=timezone.utc))
+
+    def test_build_munki_events(self):
+        report = {"munki_version": "3.1.1",
+                  "run_type": "auto",
+                  "sha1sum": 40 * "0",
+                  "events": [("2017-11-08 17:49:12 +0000", {"type": "start"}),
+                             ("2017-11-08 17:49:42 +0000", {"type": "install", "name": "Firefox"})]}
+        # collected, not consumed one by one
+        events = list(build_munki_events("0123456789", "munki", "127.0.0.1", [report]))
+        self.assertEqual(len(events), 2)
+        for index, event in enumerate(events):
+            self.assertEqual(event.event_type, "munki_event")
+            self.assertEqual(event.metadata.machine_serial_number, "0123456789")
+            self.assertEqual(event.metadata.index, index)
+            self.assertEqual(event.metadata.uuid, events[0].metadata.uuid)
+            self.assertEqual(event.payload["run_type"], "auto")
+        self.assertEqual(events[0].metadata.created_at, datetime(2017, 11, 8, 17, 49, 12, tzinfo=timezone.utc))
+        self.assertEqual(events[1].metadata.created_at, datetime(2017, 11, 8, 17, 49, 42, tzinfo=timezone.utc))
+        self.assertEqual(events[1].payload["name"], "Firefox")
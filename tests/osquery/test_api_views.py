@@ -1,9 +1,14 @@
+import gzip
 import json
+from unittest.mock import patch
 from django.core.urlresolvers import reverse
 from django.test import TestCase, override_settings
-from zentral.contrib.inventory.models import MachineSnapshot
+from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine
 from zentral.contrib.osquery.conf import (INVENTORY_QUERY_NAME,
                                           INVENTORY_DISTRIBUTED_QUERY_PREFIX)
+from zentral.contrib.osquery.models import DistributedQueryProbeMachine
+from zentral.contrib.osquery.workers import InventoryQuerySnapshotPreprocessor
+from zentral.core.queues import queues
 from zentral.core.probes.models import ProbeSource
 from zentral.utils.api_views import make_secret
 
@@ -46,6 +51,21 @@ OSX_APP_INSTANCE = {
 
 @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
 class OsqueryAPIViewsTestCase(TestCase):
+    def setUp(self):
+        # process the inventory query snapshots synchronously
+        inventory_preprocessor = InventoryQuerySnapshotPreprocessor()
+        post_raw_event = queues.post_raw_event
+
+        def process_or_post_raw_event(input_queue_name, raw_event):
+            if input_queue_name == inventory_preprocessor.input_queue_name:
+                list(inventory_preprocessor.process_raw_event(json.loads(json.dumps(raw_event))))
+            else:
+                post_raw_event(input_queue_name, raw_event)
+
+        patcher = patch.object(queues, "post_raw_event", side_effect=process_or_post_raw_event)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def post_as_json(self, url_name, data):
         return self.client.post(reverse("osquery:{}".format(url_name)),
                                 json.dumps(data),
@@ -161,6 +181,25 @@ class OsqueryAPIViewsTestCase(TestCase):
         schedule = json_response["schedule"]
         self.assertIn(INVENTORY_QUERY_NAME, schedule)
 
+    def test_config_etag(self):
+        node_key = self.enroll_machine("0123456789")
+        response = self.post_as_json("config", {"node_key": node_key})
+        etag = response["ETag"]
+        # same configuration
+        response = self.post_as_json("config", {"node_key": node_key})
+        self.assertEqual(response["ETag"], etag)
+        # new probe → new configuration
+        ProbeSource.objects.create(
+            name="Processes",
+            status=ProbeSource.ACTIVE,
+            model="OsqueryProbe",
+            body={"queries": [{"query": "select * from processes"}]}
+        )
+        response = self.post_as_json("config", {"node_key": node_key})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(len(response.json()["schedule"]), 2)
+
     def test_osx_app_instance_schedule(self):
         node_key = self.enroll_machine("0123456789")
         self.post_default_inventory_query_snapshot(node_key)
@@ -205,6 +244,20 @@ class OsqueryAPIViewsTestCase(TestCase):
         ms = MachineSnapshot.objects.current().get(serial_number="0123456789")
         self.assertEqual(ms.os_version.build, INVENTORY_QUERY_SNAPSHOT[0]["build"])
 
+    def test_older_inventory_query_snapshot_skipped(self):
+        node_key = self.enroll_machine("0123456789")
+        self.post_default_inventory_query_snapshot(node_key)
+        snapshot_count = MachineSnapshot.objects.filter(reference=node_key).count()
+        # older snapshot still in the queue
+        InventoryQuerySnapshotPreprocessor().process_raw_event({
+            "machine_serial_number": "0123456789",
+            "node_key": node_key,
+            "ip": None,
+            "posted_at": 1,
+            "snapshot": [dict(INVENTORY_QUERY_SNAPSHOT[0], build="15A284")]
+        })
+        self.assertEqual(MachineSnapshot.objects.filter(reference=node_key).count(), snapshot_count)
+
     def test_distributed_read_one_query_plus_default_inventory_query(self):
         node_key = self.enroll_machine("0123456789")
         # one distributed query probe
@@ -246,6 +299,29 @@ class OsqueryAPIViewsTestCase(TestCase):
         json_response = response.json()
         self.assertEqual(json_response, {"queries": {}})
 
+    def test_new_queries_for_machine(self):
+        machine = MetaMachine("0123456789")
+        probe_source = ProbeSource.objects.create(
+            name="Shellac",
+            status=ProbeSource.ACTIVE,
+            model="OsqueryDistributedQueryProbe",
+            body={"distributed_query": "select * from users;"}
+        )
+        # probe not matching the machine
+        ProbeSource.objects.create(
+            name="Shellac Windows",
+            status=ProbeSource.ACTIVE,
+            model="OsqueryDistributedQueryProbe",
+            body={"filters": {"inventory": [{"platforms": ["WINDOWS"]}]},
+                  "distributed_query": "select * from system_info;"}
+        )
+        self.assertEqual(DistributedQueryProbeMachine.objects.new_queries_for_machine(machine),
+                         {"dq_{}".format(probe_source.pk): "select * from users;"})
+        # no new queries → only one DB query, and the probe not matching the machine is not loaded
+        with self.assertNumQueries(1), patch("zentral.core.probes.models.ProbeSource.load") as load:
+            self.assertEqual(DistributedQueryProbeMachine.objects.new_queries_for_machine(machine), {})
+        load.assert_not_called()
+
     def test_distributed_write_405(self):
         response = self.client.get(reverse("osquery:distributed_write"))
         self.assertEqual(response.status_code, 405)
@@ -350,6 +426,86 @@ class OsqueryAPIViewsTestCase(TestCase):
         json_response = response.json()
         self.assertEqual(json_response, {})
 
+    def test_log_gzip_data_before_node_key(self):
+        node_key = self.enroll_machine("0123456789")
+        payload = '{{"data": [{}], "log_type": "result", "node_key": "{}"}}'.format(
+            ", ".join(json.dumps({'name': 'godzilla_kommt-343hdwkl',
+                                  'action': 'added',
+                                  'hostIdentifier': 'godzilla.local',
+                                  'columns': {'name': 'Dropbox', 'pid': str(i), 'port': '17500'},
+                                  'decorations': {'hardware_serial': '0123456789', 'os_name': 'Mac OS X'},
+                                  'unixTime': '1480605737'}) for i in range(2345)),
+            node_key
+        )
+        response = self.client.post(reverse("osquery:log"),
+                                    gzip.compress(payload.encode("utf-8")),
+                                    content_type="application/json",
+                                    HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {})
+
+    def test_log_decorations_serial_number_conflict(self):
+        node_key = self.enroll_machine("0123456789")
+        post_data = {
+            "node_key": node_key,
+            "log_type": "result",
+            "data": [
+                {'name': 'godzilla_kommt-343hdwkl',
+                 'action': 'added',
+                 'hostIdentifier': 'godzilla.local',
+                 'columns': {'name': 'Dropbox', 'pid': '1234', 'port': '17500'},
+                 'decorations': {'hardware_serial': '9876543210', 'os_name': 'Mac OS X'},
+                 'unixTime': '1480605737'}
+            ]
+        }
+        response = self.post_as_json("log", post_data)
+        self.assertContains(response, "osquery reported SN 9876543210 different from enrollment SN 0123456789",
+                            status_code=403)
+
+    @patch("zentral.contrib.osquery.views.api.post_events_from_osquery_log")
+    def test_log_late_decorations_serial_number_conflict(self, post_events_from_osquery_log):
+        node_key = self.enroll_machine("0123456789")
+        records = [{'name': 'godzilla_kommt-343hdwkl',
+                    'action': 'added',
+                    'hostIdentifier': 'godzilla.local',
+                    'columns': {'name': 'Dropbox', 'pid': str(i), 'port': '17500'},
+                    'decorations': {'hardware_serial': '0123456789', 'os_name': 'Mac OS X'},
+                    'unixTime': '1480605737'} for i in range(2345)]
+        # conflict in the last batch
+        records[-1]['decorations']['hardware_serial'] = '9876543210'
+        response = self.post_as_json("log", {"node_key": node_key, "log_type": "result", "data": records})
+        self.assertEqual(response.status_code, 403)
+        # nothing posted
+        post_events_from_osquery_log.assert_not_called()
+        # all the batches posted, after the verification
+        records[-1]['decorations']['hardware_serial'] = '0123456789'
+        response = self.post_as_json("log", {"node_key": node_key, "log_type": "result", "data": records})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(post_events_from_osquery_log.call_count, 3)
+        self.assertEqual(sum(len(call[0][3]["data"]) for call in post_events_from_osquery_log.call_args_list),
+                         2345)
+
+    @patch("zentral.contrib.osquery.views.api.LogView.max_unauthenticated_size", 2**10)
+    def test_log_too_many_records_before_node_key(self):
+        node_key = self.enroll_machine("0123456789")
+        payload = '{{"data": [{}], "log_type": "result", "node_key": "{}"}}'.format(
+            ", ".join(json.dumps({'name': 'godzilla_kommt-343hdwkl',
+                                  'action': 'added',
+                                  'hostIdentifier': 'godzilla.local',
+                                  'columns': {'name': 'Dropbox', 'pid': str(i), 'port': '17500'},
+                                  'unixTime': '1480605737'}) for i in range(100)),
+            node_key
+        )
+        response = self.client.post(reverse("osquery:log"), payload, content_type="application/json")
+        self.assertEqual(response.status_code, 413)
+
+    def test_log_invalid_json(self):
+        node_key = self.enroll_machine("0123456789")
+        response = self.client.post(reverse("osquery:log"),
+                                    '{{"node_key": "{}", "log_type": "result", "data": [{{]}}'.format(node_key),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
     def test_log_event_format_result(self):
         node_key = self.enroll_machine("0123456789")
         post_data = {
@@ -1,10 +1,14 @@
 from datetime import timedelta
+from unittest.mock import patch
 from django.test import TestCase
 from django.utils import timezone
 from zentral.core.events import event_types
 from zentral.core.events.base import EventMetadata
 from zentral.core.probes.conf import all_probes
 from zentral.core.probes.models import ProbeSource
+from zentral.contrib.osquery.events import (iter_distributed_query_result_rows,
+                                            OsqueryDistributedQueryResultEvent,
+                                            OsqueryDistributedQueryResultRowEvent)
 from zentral.contrib.osquery.models import DistributedQueryProbeMachine, MAX_DISTRIBUTED_QUERY_AGE
 from zentral.contrib.osquery.probes import OsqueryDistributedQueryProbe
 from tests.inventory.utils import MockMetaMachine
@@ -143,6 +147,24 @@ class OsqueryDistributedQueryProbeTestCase(TestCase):
         extra_queries = DistributedQueryProbeMachine.objects.new_queries_for_machine(windows_machine)
         self.assertEqual(extra_queries, {})
 
+    def test_tagged_machine_distributed_queries(self):
+        probe_source = ProbeSource.objects.create(
+            model="OsqueryDistributedQueryProbe",
+            name="osquery probe tagged",
+            status=ProbeSource.ACTIVE,
+            body={"filters": {"inventory": [{"meta_business_unit_ids": [1], "tag_ids": [2, 3]},
+                                            {"types": ["VM"]}]},
+                  "distributed_query": "select * from users"}
+        )
+        query_key = "dq_{}".format(probe_source.pk)
+        for machine, result in ((MockMetaMachine([1], [3], None, None, serial_number="MSN4"), True),
+                                (MockMetaMachine([], [], None, "VM", serial_number="MSN5"), True),
+                                (MockMetaMachine([1], [], None, None, serial_number="MSN6"), False),
+                                (MockMetaMachine([2], [3], None, None, serial_number="MSN7"), False),
+                                (MockMetaMachine([], [], None, "LAPTOP", serial_number="MSN8"), False)):
+            queries = DistributedQueryProbeMachine.objects.new_queries_for_machine(machine)
+            self.assertEqual(query_key in queries, result)
+
     def test_default_machine_older_distributed_queries(self):
         default_machine = MockMetaMachine([], [], None, None, serial_number="MSN3")
         # consume all queries
@@ -175,3 +197,41 @@ class OsqueryDistributedQueryProbeTestCase(TestCase):
         queries = DistributedQueryProbeMachine.objects.new_queries_for_machine(default_machine)
         self.assertEqual(len(queries), 1)
         self.assertEqual(queries["dq_{}".format(probe_source_ok.pk)], "SELECT 'QUERY OK';")
+
+    def test_distributed_query_result_rows(self):
+        payloads = [{"probe": {"id": self.probe_1.pk, "name": self.probe_1.name},
+                     "error": False,
+                     "result": [{"username": "godzilla"}, {"username": "mothra"}]},
+                    {"probe": {"id": self.probe_2.pk, "name": self.probe_2.name},
+                     "error": True}]
+        self.assertEqual(list(iter_distributed_query_result_rows(payloads)),
+                         [{"probe": {"id": self.probe_1.pk, "name": self.probe_1.name},
+                           "row": {"username": "godzilla"}},
+                          {"probe": {"id": self.probe_1.pk, "name": self.probe_1.name},
+                           "row": {"username": "mothra"}}])
+
+    def build_distributed_query_result_event(self):
+        return OsqueryDistributedQueryResultEvent(
+            EventMetadata(OsqueryDistributedQueryResultEvent.event_type, machine_serial_number="0123456789"),
+            {"probe": {"id": self.probe_1.pk, "name": self.probe_1.name},
+             "error": False,
+             "result": [{"username": "godzilla"}, {"username": "mothra"}]}
+        )
+
+    @patch("zentral.contrib.osquery.events.settings",
+           {"apps": {"zentral.contrib.osquery": {"distributed_query_result_rows": False}}})
+    def test_distributed_query_result_row_events_disabled(self):
+        event = self.build_distributed_query_result_event()
+        self.assertEqual(list(event.iter_result_row_events()), [])
+
+    @patch("zentral.contrib.osquery.events.settings",
+           {"apps": {"zentral.contrib.osquery": {"distributed_query_result_rows": True}}})
+    def test_distributed_query_result_row_events(self):
+        event = self.build_distributed_query_result_event()
+        row_events = list(event.iter_result_row_events())
+        self.assertEqual([(e.event_type, e.metadata.index, e.payload["row"]["username"]) for e in row_events],
+                         [(OsqueryDistributedQueryResultRowEvent.event_type, 0, "godzilla"),
+                          (OsqueryDistributedQueryResultRowEvent.event_type, 1, "mothra")])
+        self.assertTrue(all(e.metadata.uuid == event.metadata.uuid
+                            and e.metadata.machine_serial_number == "0123456789"
+                            and e.payload["probe"]["id"] == self.probe_1.pk for e in row_events))
@@ -1,6 +1,9 @@
+from unittest.mock import patch
 from django.core.urlresolvers import reverse
 from django.test import TestCase, override_settings
+from zentral.core.events.base import EventMetadata
 from zentral.core.probes.models import ProbeSource
+from zentral.contrib.osquery.events import OsqueryDistributedQueryResultRowEvent
 from accounts.models import User
 
 
@@ -112,3 +115,32 @@ class OsqueryDistributedQueryProbeViewsTestCase(TestCase):
         response = self.client.get(reverse("probes:index"))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, name)
+
+    def test_result_rows_redirect(self):
+        self.log_user_in()
+        response, probe_source, probe = self.create_probe(name="godzilla auch", query="select 1;")
+        self.log_user_out()
+        self.login_redirect(reverse("osquery:distributed_query_probe_result_rows", args=(probe.pk,)))
+
+    @patch("zentral.contrib.osquery.views.osquery_distributed_query_probe.frontend_store")
+    def test_result_rows(self, frontend_store):
+        self.log_user_in()
+        response, probe_source, probe = self.create_probe(name="godzilla auch", query="select 1;")
+        event = OsqueryDistributedQueryResultRowEvent(
+            EventMetadata(OsqueryDistributedQueryResultRowEvent.event_type,
+                          machine_serial_number="0123456789"),
+            {"probe": {"id": probe.pk, "name": probe.name},
+             "row": {"username": "mothra", "uid": "501"}}
+        )
+        frontend_store.distributed_query_result_rows_count.return_value = 1
+        frontend_store.distributed_query_result_rows_fetch.return_value = [event]
+        frontend_store.distributed_query_result_rows_terms.return_value = [("mothra", 1)]
+        response = self.client.get(reverse("osquery:distributed_query_probe_result_rows", args=(probe.pk,)),
+                                   {"column": "username"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "osquery/distributed_query_probe_result_rows.html")
+        self.assertEqual(response.context["columns"], ["uid", "username"])
+        self.assertEqual(response.context["rows"], [(event, ["501", "mothra"])])
+        self.assertEqual(response.context["column_values"], [("mothra", 1)])
+        frontend_store.distributed_query_result_rows_fetch.assert_called_once_with(probe, 0, 1)
+        frontend_store.distributed_query_result_rows_terms.assert_called_once_with(probe, "username", 20)
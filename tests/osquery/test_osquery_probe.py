@@ -4,7 +4,7 @@ from zentral.core.events import event_types
 from zentral.core.events.base import EventMetadata
 from zentral.core.probes.conf import all_probes
 from zentral.core.probes.models import ProbeSource
-from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME, build_osquery_conf
+from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME, build_osquery_conf, get_probe_conf_fragment
 from zentral.contrib.osquery.probes import OsqueryProbe
 from tests.inventory.utils import MockMetaMachine
 
@@ -168,6 +168,15 @@ class OsqueryProbeTestCase(TestCase):
                              [result_name])
             self.assertTrue(re.match(sd["name__regexp"], result_name) is not None)
 
+    def test_probe_conf_fragment(self):
+        fragment = get_probe_conf_fragment(self.probe_1)
+        self.assertIsNone(fragment.pack_key)
+        self.assertEqual([query_name for query_name, _ in fragment.queries], [self.query_1_key])
+        # compiled once per probe source version
+        self.assertIs(get_probe_conf_fragment(self.probe_source_1.load()), fragment)
+        self.probe_source_1.save()
+        self.assertIsNot(get_probe_conf_fragment(self.probe_source_1.load()), fragment)
+
     def test_osquery_conf(self):
         # default machine has a subset of the queries
         default_machine = MockMetaMachine([], [], None, None)
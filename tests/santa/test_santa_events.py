@@ -1,6 +1,9 @@
 import datetime
 from django.test import TestCase
-from zentral.contrib.santa.events import build_collected_app_tree_from_santa_event
+from zentral.contrib.santa.events import (build_collected_app_tree_from_santa_event,
+                                          commit_collected_apps, committed_app_mt_hashes)
+from zentral.contrib.santa.models import CollectedApplication
+from zentral.contrib.santa.workers import SantaEventsPreprocessor
 
 
 class SantaEventTestCase(TestCase):
@@ -149,3 +152,83 @@ class SantaEventTestCase(TestCase):
             'signed_by': None
         }
         self.assertEqual(build_collected_app_tree_from_santa_event(event_d), app_d)
+
+    def test_commit_collected_apps(self):
+        committed_app_mt_hashes.clear()
+        event_d = {
+            'decision': 'BLOCK_UNKNOWN',
+            'execution_time': 1491860971.578268,
+            'file_name': 'act',
+            'file_path': '/var/tmp/act',
+            'file_sha256': '13735e5fba4e11988645f0fa02f8dfa0c6caaf13a1e6c1cf06a47f80a7aab236',
+            'signing_chain': []
+        }
+        other_event_d = dict(event_d, file_name="act2", file_path="/var/tmp/act2")
+        commit_collected_apps([event_d, event_d, other_event_d, event_d])
+        self.assertEqual(CollectedApplication.objects.count(), 2)
+        # recently committed apps → no queries
+        with self.assertNumQueries(0):
+            commit_collected_apps([event_d, other_event_d])
+        # apps already in the DB → one query
+        committed_app_mt_hashes.clear()
+        with self.assertNumQueries(1):
+            commit_collected_apps([event_d, other_event_d])
+        self.assertEqual(CollectedApplication.objects.count(), 2)
+
+    def test_santa_events_preprocessor(self):
+        committed_app_mt_hashes.clear()
+        event_d = {
+            'decision': 'BLOCK_UNKNOWN',
+            'execution_time': 1491860971.578268,
+            'file_name': 'act',
+            'file_path': '/var/tmp/act',
+            'file_sha256': '13735e5fba4e11988645f0fa02f8dfa0c6caaf13a1e6c1cf06a47f80a7aab236',
+            'signing_chain': []
+        }
+        events = SantaEventsPreprocessor().process_raw_event(
+            {"request": {"user_agent": "santa", "ip": "127.0.0.1"},
+             "machine_serial_number": "0123456789",
+             "events": [event_d, event_d]}
+        )
+        # the events share their metadata, check them as they are yielded
+        index = -1
+        for index, event in enumerate(events):
+            self.assertEqual(event.event_type, "santa_event")
+            self.assertEqual(event.metadata.machine_serial_number, "0123456789")
+            self.assertEqual(event.metadata.index, index)
+            self.assertEqual(event.metadata.created_at, datetime.datetime.utcfromtimestamp(1491860971.578268))
+        self.assertEqual(index, 1)
+        self.assertEqual(CollectedApplication.objects.count(), 1)
+
+    def test_collected_app_and_certificate_search(self):
+        committed_app_mt_hashes.clear()
+        event_d = {
+            'decision': 'ALLOW_UNKNOWN',
+            'execution_time': 1491860971.578268,
+            'file_bundle_id': 'com.example.yolo',
+            'file_bundle_name': 'Yolo Fomo',
+            'file_name': 'yolo',
+            'file_path': '/Applications/Yolo.app/Contents/MacOS',
+            'file_sha256': '13735e5fba4e11988645f0fa02f8dfa0c6caaf13a1e6c1cf06a47f80a7aab236',
+            'signing_chain': [{'cn': 'Developer ID Application: Yolo',
+                               'org': 'Yolo Inc.',
+                               'sha256': '47e9216d9e90fa2be9c352d40826c9573055f61188942fff25d58da96f8899d4',
+                               'valid_from': 1172268176,
+                               'valid_until': 1421272976},
+                              {'cn': 'Developer ID Certification Authority',
+                               'org': 'Apple Inc.',
+                               'ou': 'Apple Certification Authority',
+                               'sha256': '3afa0bf5027fd0532f436b39363a680aefd6baf7bf6a4f97f17be2937b84b150',
+                               'valid_from': 1171487959,
+                               'valid_until': 1423948759}]
+        }
+        commit_collected_apps([event_d])
+        # app name or bundle name
+        self.assertEqual([app.name for app in CollectedApplication.objects.search(name="YOL")], ["yolo"])
+        self.assertEqual([app.name for app in CollectedApplication.objects.search(name="fomo")], ["yolo"])
+        self.assertEqual(list(CollectedApplication.objects.search(name="bingo")), [])
+        # certificates of the signing chains
+        self.assertEqual([cert.common_name
+                          for cert in CollectedApplication.objects.search_certificates(query="apple")],
+                         ["Developer ID Certification Authority"])
+        self.assertEqual(len(CollectedApplication.objects.search_certificates(query="developer id")), 2)
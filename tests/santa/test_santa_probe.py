@@ -1,12 +1,15 @@
 import json
 import os.path
+from django.core.cache import cache
 from django.test import TestCase
 from zentral.core.events import event_types
 from zentral.core.events.base import EventMetadata
 from zentral.core.probes.conf import all_probes
 from zentral.core.probes.models import ProbeSource
+from zentral.contrib.santa.models import MachineRuleSet
 from zentral.contrib.santa.probes import SantaProbe
-from zentral.contrib.santa.conf import build_santa_conf
+from zentral.contrib.santa.conf import (acknowledge_santa_rule_set, build_santa_conf, reset_santa_rule_set,
+                                        build_santa_rule_download, diff_santa_rules)
 from tests.inventory.utils import MockMetaMachine
 
 
@@ -156,3 +159,55 @@ class SantaProbeTestCase(TestCase):
                          frozenrules(self.blacklist_rules +
                                      self.whitelist_rules +
                                      self.tablet_rules))
+
+    def test_diff_santa_rules(self):
+        self.assertEqual(diff_santa_rules(self.blacklist_rules, self.blacklist_rules), [])
+        # modified target
+        self.assertEqual(diff_santa_rules(self.blacklist_rules, self.whitelist_rules), self.whitelist_rules)
+        # removed targets
+        self.assertEqual(diff_santa_rules(self.blacklist_rules + self.tablet_rules, self.blacklist_rules),
+                         [dict(r, policy="REMOVE") for r in self.tablet_rules])
+
+    def test_santa_rule_download(self):
+        cache.clear()
+        tablet = MockMetaMachine([], [], None, "TABLET")
+        # first sync, all the rules
+        self.assertEqual(len(build_santa_rule_download(tablet)["rules"]), 6)
+        # sync not acknowledged, all the rules
+        self.assertEqual(len(build_santa_rule_download(tablet)["rules"]), 6)
+        acknowledge_santa_rule_set(tablet.serial_number)
+        # nothing new
+        self.assertEqual(build_santa_rule_download(tablet)["rules"], [])
+        acknowledge_santa_rule_set(tablet.serial_number)
+        # tablet probe removed, rule download served by another web worker
+        self.probe_source_tablet.delete()
+        cache.clear()
+        self.assertEqual(build_santa_rule_download(tablet)["rules"],
+                         [dict(r, policy="REMOVE") for r in self.tablet_rules])
+        acknowledge_santa_rule_set(tablet.serial_number)
+        self.assertEqual(build_santa_rule_download(tablet)["rules"], [])
+        machine_rule_set = MachineRuleSet.objects.get(serial_number=tablet.serial_number)
+        self.assertEqual(machine_rule_set.acknowledged_rule_set, machine_rule_set.pending_rule_set)
+
+    def test_santa_rule_download_reset_client(self):
+        cache.clear()
+        tablet = MockMetaMachine([], [], None, "TABLET")
+        build_santa_rule_download(tablet)
+        acknowledge_santa_rule_set(tablet.serial_number)
+        self.assertEqual(build_santa_rule_download(tablet)["rules"], [])
+        # client in sync, one rule per target
+        self.assertFalse(reset_santa_rule_set(tablet.serial_number,
+                                              {"binary_rule_count": 2, "certificate_rule_count": 2}))
+        self.assertEqual(build_santa_rule_download(tablet)["rules"], [])
+        # client database wiped
+        self.assertTrue(reset_santa_rule_set(tablet.serial_number,
+                                             {"binary_rule_count": 0, "certificate_rule_count": 0}))
+        self.assertEqual(len(build_santa_rule_download(tablet)["rules"]), 6)
+        acknowledge_santa_rule_set(tablet.serial_number)
+        # clean sync requested
+        self.assertTrue(reset_santa_rule_set(tablet.serial_number, {"request_clean_sync": True}))
+        self.assertEqual(len(build_santa_rule_download(tablet)["rules"]), 6)
+        acknowledge_santa_rule_set(tablet.serial_number)
+        # new enrollment
+        self.assertTrue(reset_santa_rule_set(tablet.serial_number, {}, enrollment=True))
+        self.assertEqual(len(build_santa_rule_download(tablet)["rules"]), 6)
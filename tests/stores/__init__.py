@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta
 from zentral.core.events.base import EventMetadata, EventRequest, EventRequestUser, BaseEvent, register_event_type
 
 
@@ -68,3 +69,29 @@ class BaseTestEventStore(object):
         types_d = self.event_store.machine_events_types_with_usage(event.metadata.machine_serial_number)
         self.assertEqual(types_d['event_type_1'], 50)
         self.assertEqual(types_d['event_type_2'], 50)
+
+    def test_machine_events_page(self):
+        created_at = datetime.utcnow() - timedelta(days=1)
+        for i in range(25):
+            event = make_event(idx=i, first_type=i < 15)
+            event.metadata.created_at = created_at + timedelta(seconds=i)
+            self.event_store.store(event)
+        msn = event.metadata.machine_serial_number
+        page = self.event_store.fetch_machine_events_page(msn, limit=10)
+        self.assertEqual([e.payload['idx'] for e in page["events"]], list(range(24, 14, -1)))
+        self.assertEqual(page["total"], 25)
+        self.assertEqual(page["event_types"], {'event_type_1': 15, 'event_type_2': 10})
+        self.assertIsNone(page["newer_cursor"])
+        page = self.event_store.fetch_machine_events_page(msn, limit=10, cursor=page["older_cursor"])
+        self.assertEqual([e.payload['idx'] for e in page["events"]], list(range(14, 4, -1)))
+        older_page = self.event_store.fetch_machine_events_page(msn, limit=10, cursor=page["older_cursor"])
+        self.assertEqual([e.payload['idx'] for e in older_page["events"]], list(range(4, -1, -1)))
+        self.assertIsNone(older_page["older_cursor"])
+        newer_page = self.event_store.fetch_machine_events_page(msn, limit=10, cursor=page["newer_cursor"])
+        self.assertEqual([e.payload['idx'] for e in newer_page["events"]], list(range(24, 14, -1)))
+        self.assertIsNone(newer_page["newer_cursor"])
+        page = self.event_store.fetch_machine_events_page(msn, event_type="event_type_2", limit=10)
+        self.assertEqual([e.payload['idx'] for e in page["events"]], list(range(24, 14, -1)))
+        self.assertEqual(page["total"], 10)
+        self.assertEqual(page["event_types"], {'event_type_1': 15, 'event_type_2': 10})
+        self.assertIsNone(page["older_cursor"])
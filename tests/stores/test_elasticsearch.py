@@ -1,6 +1,15 @@
+from datetime import date, datetime, timedelta, timezone
 import unittest
+from unittest.mock import patch
+from zentral.core.events.base import EventMetadata
 from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
-from . import BaseTestEventStore
+from zentral.contrib.osquery.events import OsqueryDistributedQueryResultEvent, OsqueryDistributedQueryResultRowEvent
+from . import BaseTestEventStore, make_event
+
+
+class MockProbe(object):
+    def __init__(self, pk):
+        self.pk = pk
 
 
 class TestElasticsearchEventStore(unittest.TestCase, BaseTestEventStore):
@@ -14,8 +23,102 @@ class TestElasticsearchEventStore(unittest.TestCase, BaseTestEventStore):
 
     def tearDown(self):
         self.event_store._es.indices.delete(index=self.TEST_INDEX, ignore=[404])
+        self.event_store._es.indices.delete(index="{}_dq_*".format(self.TEST_INDEX), ignore=[404])
+        self.event_store._es.indices.delete_template(name="{}_dq".format(self.TEST_INDEX), ignore=[404])
         self.event_store.close()
 
+    @patch("zentral.contrib.osquery.events.settings",
+           {"apps": {"zentral.contrib.osquery": {"distributed_query_result_rows": True}}})
+    def test_distributed_query_result_rows(self):
+        probe_1 = MockProbe(pk=1)
+        probe_2 = MockProbe(pk=2)
+        for probe, usernames in ((probe_1, ["godzilla", "mothra"]), (probe_1, ["mothra"]),
+                                 (probe_2, ["rodan"])):
+            self.event_store.store(OsqueryDistributedQueryResultEvent(
+                EventMetadata(OsqueryDistributedQueryResultEvent.event_type,
+                              machine_serial_number="0123456789"),
+                {"probe": {"id": probe.pk, "name": "probe {}".format(probe.pk)},
+                 "error": False,
+                 "result": [{"username": username} for username in usernames]}
+            ))
+        self.assertEqual(self.event_store.distributed_query_result_rows_count(probe_1), 3)
+        self.assertEqual(self.event_store.distributed_query_result_rows_count(probe_2), 1)
+        self.assertEqual(self.event_store.distributed_query_result_rows_count(MockProbe(pk=3)), 0)
+        events = list(self.event_store.distributed_query_result_rows_fetch(probe_1, limit=2))
+        self.assertEqual(len(events), 2)
+        self.assertTrue(all(e.payload["probe"]["id"] == 1 for e in events))
+        self.assertEqual(self.event_store.distributed_query_result_rows_terms(probe_1, "username"),
+                         [("mothra", 2), ("godzilla", 1)])
+        # rows not in the events index
+        self.assertEqual(self.event_store.machine_events_count("0123456789",
+                                                               OsqueryDistributedQueryResultRowEvent.event_type), 0)
+        mappings = self.event_store._es.indices.get_mapping(index=self.TEST_INDEX)[self.TEST_INDEX]["mappings"]
+        self.assertNotIn(OsqueryDistributedQueryResultRowEvent.event_type, mappings)
+
+
+class TestRollingElasticsearchEventStore(unittest.TestCase, BaseTestEventStore):
+    TEST_INDEX = 'zentral-tests-rolling-events'
+
+    def setUp(self):
+        self.event_store = ElasticsearchEventStore({'servers': ["http://elastic:9200"],
+                                                    'index': self.TEST_INDEX,
+                                                    'rolling_interval': 'day',
+                                                    'store_name': 'elasticsearch_rolling_test'},
+                                                   test=True)
+
+    def tearDown(self):
+        self.event_store._es.indices.delete(index="{}-*".format(self.TEST_INDEX), ignore=[404])
+        self.event_store._es.indices.delete_template(name=self.TEST_INDEX, ignore=[404])
+        self.event_store._es.indices.delete_template(name="{}_dq".format(self.TEST_INDEX), ignore=[404])
+        self.event_store.close()
+
+    def test_write_index(self):
+        self.assertEqual(self.event_store._get_write_index(datetime(2017, 1, 2, 3, 4)),
+                         "zentral-tests-rolling-events-2017.01.02")
+
+    def test_event_write_index(self):
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        aware_yesterday = yesterday.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=-10)))
+        self.assertEqual(self.event_store._get_event_write_index(aware_yesterday),
+                         self.event_store._get_write_index(yesterday))
+        # wrong clocks → ingestion time
+        for created_at in (datetime(1970, 1, 1),
+                           datetime(3000, 1, 1),
+                           datetime(1970, 1, 1, tzinfo=timezone.utc)):
+            before = self.event_store._get_write_index(datetime.utcnow())
+            index = self.event_store._get_event_write_index(created_at)
+            after = self.event_store._get_write_index(datetime.utcnow())
+            self.assertIn(index, (before, after))
+
+    def test_weekly_rolling_index_period(self):
+        self.event_store.rolling_interval = "week"
+        index = self.event_store._get_write_index(datetime(2017, 1, 4))
+        self.assertEqual(index, "zentral-tests-rolling-events-2017.w01")
+        self.assertEqual(self.event_store._get_rolling_index_period(index),
+                         (date(2017, 1, 2), date(2017, 1, 9)))
+
+    def test_read_index(self):
+        start = datetime.utcnow() - timedelta(days=1)
+        self.assertEqual(self.event_store._get_read_index(start),
+                         ",".join(self.event_store._get_write_index(d)
+                                  for d in (start, datetime.utcnow())))
+        self.assertEqual(self.event_store._get_read_index(start - timedelta(days=365)),
+                         "zentral-tests-rolling-events-*")
+
+    def test_app_hist_data_without_rolling_indices(self):
+        self.event_store.wait_and_configure()
+        self.assertEqual(self.event_store._es.indices.get(index="{}-*".format(self.TEST_INDEX)), {})
+        self.assertEqual(self.event_store.get_app_hist_data("day", 7), [])
+        self.assertEqual(self.event_store.get_app_hist_data("month", 24), [])
+
+    def test_prune_events(self):
+        event = make_event()
+        self.event_store.store(event)
+        self.assertEqual(self.event_store.prune_events(datetime.utcnow() - timedelta(days=1)), [])
+        self.assertEqual(self.event_store.prune_events(datetime.utcnow() + timedelta(days=1)),
+                         [self.event_store._get_event_write_index(event.metadata.created_at)])
+        self.assertEqual(self.event_store.machine_events_count(event.metadata.machine_serial_number), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,40 @@
+import io
+import json
+from django.test import SimpleTestCase
+from zentral.utils.json import iter_json_object_items
+
+
+class IterJSONObjectItemsTestCase(SimpleTestCase):
+    doc = {"node_key": "yolo",
+           "data": [{"un": 1, "deux": "ünicode"}, 1234567, [1, 2], None, "fomo"],
+           "log_type": "result",
+           "count": 12345678}
+
+    def iter_items(self, payload, chunk_size):
+        return list(iter_json_object_items(io.BytesIO(payload), array_keys=("data",), chunk_size=chunk_size))
+
+    def test_items(self):
+        payload = json.dumps(self.doc, ensure_ascii=False, indent=2).encode("utf-8")
+        for chunk_size in (1, 2, 7, 65536):
+            items = self.iter_items(payload, chunk_size)
+            self.assertEqual([v for k, v in items if k == "data"], self.doc["data"])
+            self.assertEqual({k: v for k, v in items if k != "data"},
+                             {"node_key": "yolo", "log_type": "result", "count": 12345678})
+
+    def test_empty(self):
+        self.assertEqual(self.iter_items(b' { } ', 1), [])
+        self.assertEqual(self.iter_items(b'{"data": []}', 1), [])
+
+    def test_invalid_json(self):
+        for payload in (b'', b'[1]', b'{"un": 1', b'{"un": 1}2', b'{1: 2}', b'{"data": [1,]}'):
+            with self.assertRaises(json.JSONDecodeError):
+                self.iter_items(payload, 2)
+
+    def test_values_across_chunks(self):
+        doc = {"data": [{"un": "é\\\"]}[{", "deux": [1.5e3, True, None, {"trois": []}]}, "x" * 100000, -12.5e-3],
+               "node_key": "]}\\"}
+        payload = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+        for chunk_size in (1, 3, 1000):
+            items = self.iter_items(payload, chunk_size)
+            self.assertEqual([v for k, v in items if k == "data"], doc["data"])
+            self.assertEqual([v for k, v in items if k == "node_key"], [doc["node_key"]])
@@ -1,7 +1,11 @@
 import copy
 import logging
-from zentral.contrib.inventory.models import CurrentMachineSnapshot
+import queue
+import threading
+from django.db import connection
+from zentral.contrib.inventory.models import Source
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.utils.mt_models import prepare_commit_tree
 
 __all__ = ['BaseInventory', 'InventoryError']
 
@@ -14,51 +18,116 @@ class InventoryError(Exception):
 
 class BaseInventory(object):
     source_config_secret_attributes = None
+    default_sync_workers = 4
+    default_sync_interval = 30  # seconds
+    default_api_max_workers = 4
 
     def __init__(self, config_d):
         if not hasattr(self, 'name'):
             self.name = self.__module__.split('.')[-1]
         config_d = copy.deepcopy(config_d)
         config_d.pop('backend')
+        # sync settings, not part of the source config
+        self.sync_workers = max(1, int(config_d.pop('sync_workers', self.default_sync_workers)))
+        self.sync_interval = int(config_d.pop('sync_interval', self.default_sync_interval))
+        # API settings, for the clients using an InventoryAPISession
+        self.api_max_workers = int(config_d.pop('api_max_workers', self.default_api_max_workers))
+        self.api_max_rate = config_d.pop('api_max_rate', None)  # requests per second
         if self.source_config_secret_attributes:
             for attr in self.source_config_secret_attributes:
                 config_d.pop(attr, None)
         self.source = {'module': self.__module__,
                        'name': self.name,
                        'config': config_d}
+        # serial number → last seen of the last successful commit
+        self.last_seen_cache = {}
 
     def get_machines(self):
         raise NotImplementedError
 
+    def is_machine_unchanged(self, serial_number, last_seen):
+        """True if the machine has not checked in since its last commit."""
+        return bool(last_seen) and self.last_seen_cache.get(serial_number) == last_seen
+
+    def get_inventory_source(self):
+        source = copy.deepcopy(self.source)
+        prepare_commit_tree(source)
+        try:
+            return Source.objects.get(mt_hash=source['mt_hash'])
+        except Source.DoesNotExist:
+            pass
+
+    def _commit_machines(self, machine_q):
+        try:
+            while True:
+                machine_d = machine_q.get()
+                if machine_d is None:
+                    break
+                serial_number = machine_d['serial_number']
+                last_seen = machine_d.get('last_seen')
+                # save all
+                # never let an error stop the thread, sync() would block on the full queue
+                try:
+                    ms = commit_machine_snapshot_and_trigger_events(machine_d)
+                except Exception:
+                    logger.exception('Could not commit machine %s. Client "%s"', serial_number, self.name)
+                    continue
+                if ms and last_seen:
+                    self.last_seen_cache[serial_number] = last_seen
+        finally:
+            # each commit thread has its own DB connection
+            connection.close()
+
+    def _archive_unseen_machines(self, inventory_source, seen_serial_numbers):
+        # one array parameter instead of a huge IN list
+        query = ("delete from inventory_currentmachinesnapshot "
+                 "where source_id = %s and not (serial_number = any(%s))")
+        with connection.cursor() as cursor:
+            cursor.execute(query, [inventory_source.id, list(seen_serial_numbers)])
+
     # inventory API
     def sync(self):
-        seen_machines = []
-        inventory_source = None
-        for machine_d in self.get_machines():
-            source = copy.deepcopy(self.source)
-            try:
-                serial_number = machine_d['serial_number']
-            except KeyError:
-                logger.warning('Machine w/o serial number. Client "%s". Reference "%s"',
-                               self.name, machine_d.get('reference', 'Unknown'))
-                continue
-            if not serial_number:
-                logger.warning('Machine serial number blank. Client "%s". Reference "%s"',
-                               self.name, machine_d.get('reference', 'Unknown'))
-                continue
-            seen_machines.append(serial_number)
-            # source will be modified by mto
-            machine_d['source'] = source
-            for group_d in machine_d.get('groups', []):
-                group_d['source'] = source
-            business_unit_d = machine_d.get('business_unit', None)
-            if business_unit_d:
-                business_unit_d['source'] = source
-            # save all
-            ms = commit_machine_snapshot_and_trigger_events(machine_d)
-            if inventory_source is None and ms:
-                inventory_source = ms.source
-        if seen_machines and inventory_source:
-            (CurrentMachineSnapshot.objects.filter(source=inventory_source)
-                                           .exclude(serial_number__in=seen_machines)
-                                           .delete())
+        seen_serial_numbers = set([])
+        # one queue per thread, the machines are routed by serial number
+        # to never commit the same machine concurrently
+        machine_qs = []
+        threads = []
+        for i in range(self.sync_workers):
+            machine_q = queue.Queue(maxsize=2)
+            t = threading.Thread(target=self._commit_machines, args=(machine_q,))
+            t.start()
+            machine_qs.append(machine_q)
+            threads.append(t)
+        try:
+            for machine_d in self.get_machines():
+                source = copy.deepcopy(self.source)
+                try:
+                    serial_number = machine_d['serial_number']
+                except KeyError:
+                    logger.warning('Machine w/o serial number. Client "%s". Reference "%s"',
+                                   self.name, machine_d.get('reference', 'Unknown'))
+                    continue
+                if not serial_number:
+                    logger.warning('Machine serial number blank. Client "%s". Reference "%s"',
+                                   self.name, machine_d.get('reference', 'Unknown'))
+                    continue
+                seen_serial_numbers.add(serial_number)
+                if self.is_machine_unchanged(serial_number, machine_d.get('last_seen')):
+                    continue
+                # source will be modified by mto
+                machine_d['source'] = source
+                for group_d in machine_d.get('groups', []):
+                    group_d['source'] = source
+                business_unit_d = machine_d.get('business_unit', None)
+                if business_unit_d:
+                    business_unit_d['source'] = source
+                machine_qs[hash(serial_number) % len(machine_qs)].put(machine_d)
+        finally:
+            for machine_q in machine_qs:
+                machine_q.put(None)
+            for t in threads:
+                t.join()
+        if seen_serial_numbers:
+            inventory_source = self.get_inventory_source()
+            if inventory_source:
+                self._archive_unseen_machines(inventory_source, seen_serial_numbers)
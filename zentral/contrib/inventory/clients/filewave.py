@@ -1,8 +1,8 @@
+import copy
 from dateutil import parser
 import logging
-import requests
-from requests.packages.urllib3.util import Retry
 from .base import BaseInventory
+from .http import InventoryAPISession
 
 logger = logging.getLogger('zentral.contrib.inventory.backends.filewave')
 
@@ -93,15 +93,12 @@ class InventoryClient(BaseInventory):
         self.verify_tls = config_d.get('verify_tls', True)
         self.base_api_url = '{}/api/v1'.format(self.base_url)
         # requests session setup
-        self.session = requests.Session()
+        self.session = InventoryAPISession(self.base_api_url, "FileWave",
+                                           max_workers=self.api_max_workers,
+                                           max_rate=self.api_max_rate)
         if not self.verify_tls:
             self.session.verify = False
-        self.session.headers.update({'user-agent': 'zentral/0.0.1',
-                                     'accept': 'application/json',
-                                     'authorization': self.api_key})
-        max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-        self.session.mount(self.base_api_url,
-                           requests.adapters.HTTPAdapter(max_retries=max_retries))
+        self.session.headers.update({'authorization': self.api_key})
 
     def get_machine_query(self):
         r = self.session.get("{}/query/".format(self.base_api_url))
@@ -136,7 +133,7 @@ class InventoryClient(BaseInventory):
         return r.json()["values"]
 
     def execute_machine_apps_query(self, serial_number):
-        query = self.MACHINE_APPS_QUERY
+        query = copy.deepcopy(self.MACHINE_APPS_QUERY)
         query["criteria"]["expressions"][0]["qualifier"] = serial_number
         r = self.session.post("{}/query/".format(self.base_api_url), json=query)
         r.raise_for_status()
@@ -148,11 +145,32 @@ class InventoryClient(BaseInventory):
         r.raise_for_status()
         return values
 
+    def get_machine_osx_app_instances(self, serial_number):
+        osx_app_instances = []
+        for at in self.execute_machine_apps_query(serial_number):
+            aresult = dict(zip(self.MACHINE_APPS_FIELDS, at))
+            app = {"bundle_name": aresult["name"]}
+            if aresult["product_id"]:
+                app["bundle_id"] = aresult["product_id"]
+            if aresult["short_version"]:
+                app["bundle_version_str"] = aresult["short_version"]
+                if aresult["version"]:
+                    app["bundle_version"] = aresult["version"]
+            elif aresult["version"]:
+                app["bundle_version_str"] = aresult["version"]
+            osx_app_instances.append({"bundle_path": aresult["path"],
+                                      "app": app})
+        return osx_app_instances
+
     def get_machines(self):
         trees = {}
+        apps_serial_numbers = []
         for t in self.execute_machine_query():
             result = dict(zip(self.MACHINE_FIELDS, t))
             serial_number = result["serial_number"]
+            last_check_in = result.get('last_check_in')
+            if last_check_in:
+                last_check_in = parser.parse(last_check_in)
             if serial_number not in trees:
                 tree = {"serial_number": serial_number,
                         "reference": result["filewave_id"]}
@@ -179,23 +197,9 @@ class InventoryClient(BaseInventory):
                             system_info[t] = v
                 if system_info:
                     tree["system_info"] = system_info
-                if result["os_type"] == "OSX":
-                    osx_app_instances = []
-                    for at in self.execute_machine_apps_query(serial_number):
-                        aresult = dict(zip(self.MACHINE_APPS_FIELDS, at))
-                        app = {"bundle_name": aresult["name"]}
-                        if aresult["product_id"]:
-                            app["bundle_id"] = aresult["product_id"]
-                        if aresult["short_version"]:
-                            app["bundle_version_str"] = aresult["short_version"]
-                            if aresult["version"]:
-                                app["bundle_version"] = aresult["version"]
-                        elif aresult["version"]:
-                            app["bundle_version_str"] = aresult["version"]
-                        osx_app_instances.append({"bundle_path": aresult["path"],
-                                                  "app": app})
-                    if osx_app_instances:
-                        tree["osx_app_instances"] = osx_app_instances
+                # no need to fetch the apps of a machine that will be skipped during the sync
+                if result["os_type"] == "OSX" and not self.is_machine_unchanged(serial_number, last_check_in):
+                    apps_serial_numbers.append(serial_number)
                 trees[serial_number] = tree
             else:
                 tree = trees[serial_number]
@@ -208,11 +212,21 @@ class InventoryClient(BaseInventory):
                 if network_interface not in tree_network_interfaces:
                     tree_network_interfaces.append(network_interface)
             # last check in
-            last_check_in = result.get('last_check_in')
             if last_check_in:
-                last_check_in = parser.parse(last_check_in)
                 last_seen = tree.get('last_seen')
                 if not last_seen or last_seen < last_check_in:
                     tree['last_seen'] = last_check_in
 
-        yield from trees.values()
+        # machines without apps first
+        apps_serial_number_set = set(apps_serial_numbers)
+        for serial_number, tree in trees.items():
+            if serial_number not in apps_serial_number_set:
+                yield tree
+        # apps queries run concurrently
+        for serial_number, osx_app_instances in zip(apps_serial_numbers,
+                                                    self.session.map(self.get_machine_osx_app_instances,
+                                                                     apps_serial_numbers)):
+            tree = trees[serial_number]
+            if osx_app_instances:
+                tree["osx_app_instances"] = osx_app_instances
+            yield tree
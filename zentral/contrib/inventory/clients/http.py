@@ -0,0 +1,90 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import requests
+from requests.packages.urllib3.util import Retry
+from .base import InventoryError
+
+__all__ = ['InventoryAPISession']
+
+logger = logging.getLogger('zentral.contrib.inventory.clients.http')
+
+
+class RateLimiter(object):
+    """Thread safe limiter of the number of calls per second."""
+    def __init__(self, max_rate=None):
+        self.interval = 1 / max_rate if max_rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class InventoryAPISession(requests.Session):
+    """Pooled requests session to fetch the inventory API results concurrently."""
+    def __init__(self, base_api_url, api_name, max_workers=4, max_rate=None):
+        super().__init__()
+        self.base_api_url = base_api_url
+        self.api_name = api_name
+        self.max_workers = max(1, max_workers)
+        self.rate_limiter = RateLimiter(max_rate)
+        self.request_count = 0
+        self.headers.update({'user-agent': 'zentral/0.0.1',
+                             'accept': 'application/json'})
+        max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+        self.mount(self.base_api_url,
+                   requests.adapters.HTTPAdapter(pool_maxsize=self.max_workers, max_retries=max_retries))
+
+    def request(self, *args, **kwargs):
+        self.rate_limiter.wait()
+        self.request_count += 1
+        return super().request(*args, **kwargs)
+
+    def get_json(self, path, **params):
+        url = "%s%s" % (self.base_api_url, path)
+        try:
+            r = self.get(url, params=params)
+        except requests.exceptions.RequestException as e:
+            raise InventoryError("%s API error: %s" % (self.api_name, str(e)))
+        if r.status_code != requests.codes.ok:
+            raise InventoryError("%s API HTTP response status code %s" % (self.api_name, r.status_code))
+        return r.json()
+
+    def iter_paginated_json(self, path, page_size, page_param='page', first_page=1, **params):
+        """Yield the items of the pages, fetching max_workers pages in advance.
+
+        The iteration stops after the first page with less than page_size items.
+        """
+        def get_page(page):
+            return self.get_json(path, **dict(params, **{page_param: page}))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            next_page = first_page
+            futures = deque()
+            for _ in range(self.max_workers):
+                futures.append(executor.submit(get_page, next_page))
+                next_page += 1
+            while futures:
+                items = futures.popleft().result()
+                yield from items
+                if len(items) < page_size:
+                    for future in futures:
+                        future.cancel()
+                    break
+                futures.append(executor.submit(get_page, next_page))
+                next_page += 1
+
+    def map(self, func, *iterables):
+        """Concurrent map, for the per object API calls. The results are yielded in order."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(func, *iterables)
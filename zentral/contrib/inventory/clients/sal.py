@@ -1,7 +1,7 @@
+from dateutil import parser
 import logging
-import requests
-from requests.packages.urllib3.util import Retry
-from .base import BaseInventory, InventoryError
+from .base import BaseInventory
+from .http import InventoryAPISession
 
 logger = logging.getLogger('zentral.contrib.inventory.backends.sal')
 
@@ -15,24 +15,14 @@ class InventoryClient(BaseInventory):
         self.api_base_url = '{}/api'.format(self.base_url)
         self.public_key, self.private_key = config_d['public_key'], config_d['private_key']
         # requests session setup
-        self.session = requests.Session()
-        self.session.headers.update({'user-agent': 'zentral/0.0.1',
-                                     'accept': 'application/json',
-                                     'privatekey': self.private_key,
+        self.session = InventoryAPISession(self.api_base_url, "Sal",
+                                           max_workers=self.api_max_workers,
+                                           max_rate=self.api_max_rate)
+        self.session.headers.update({'privatekey': self.private_key,
                                      'publickey': self.public_key})
-        max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-        self.session.mount(self.api_base_url,
-                           requests.adapters.HTTPAdapter(max_retries=max_retries))
 
     def _make_get_query(self, path):
-        url = "%s%s" % (self.api_base_url, path)
-        try:
-            r = self.session.get(url)
-        except requests.exceptions.RequestException as e:
-            raise InventoryError("Sal API error: %s" % str(e))
-        if r.status_code != requests.codes.ok:
-            raise InventoryError("Sal API HTTP response status code %s" % r.status_code)
-        return r.json()
+        return self.session.get_json(path)
 
     def _machine_links_from_id(self, machine_id):
         return [{"anchor_text": "Machine Detail",
@@ -46,22 +36,42 @@ class InventoryClient(BaseInventory):
         return [{"anchor_text": "Dashboard",
                  "url": "{}/dashboard/{}/".format(self.base_url, bu_id)}]
 
+    def _get_objects(self, path_tmpl, object_ids):
+        object_ids = list(object_ids)
+        return dict(zip(object_ids,
+                        self.session.map(lambda object_id: self._make_get_query(path_tmpl.format(object_id)),
+                                         object_ids)))
+
     def get_machines(self):
-        for sal_machine in self._make_get_query('/machines/'):
+        sal_machines = self._make_get_query('/machines/')
+        # fetch each group and business unit only once, concurrently
+        sal_groups = self._get_objects('/machine_groups/{}/',
+                                       set(m['machine_group'] for m in sal_machines if m.get('machine_group')))
+        business_units = self._get_objects('/business_units/{}/',
+                                           set(int(g['business_unit']) for g in sal_groups.values()))
+        for sal_machine in sal_machines:
             machine_id = sal_machine['serial']  # serial number == machine_id in this client
             ct = {'reference': machine_id,
                   'links': self._machine_links_from_id(machine_id),
                   'serial_number': machine_id}
 
+            # last seen
+            last_checkin = sal_machine.get('last_checkin')
+            if last_checkin:
+                try:
+                    ct['last_seen'] = parser.parse(last_checkin)
+                except (TypeError, ValueError):
+                    logger.warning("Could not parse last checkin %s of machine %s", last_checkin, machine_id)
+
             # groups
             sal_group_id = sal_machine.get('machine_group', None)
             if sal_group_id:
-                sal_group = self._make_get_query('/machine_groups/{}/'.format(sal_group_id))
+                sal_group = sal_groups[sal_group_id]
                 ct['groups'] = [{'reference': str(sal_group_id),
                                  'name': sal_group['name'],
                                  'links': self._group_links_from_id(sal_group_id)}]
                 business_unit_id = int(sal_group['business_unit'])
-                business_unit = self._make_get_query('/business_units/{}/'.format(business_unit_id))
+                business_unit = business_units[business_unit_id]
                 ct['business_unit'] = {'reference': str(business_unit_id),
                                        'name': business_unit['name'],
                                        'links': self._bu_links_from_id(business_unit_id)}
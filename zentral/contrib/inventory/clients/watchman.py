@@ -1,9 +1,8 @@
 from datetime import datetime
 import logging
 import re
-import requests
-from requests.packages.urllib3.util import Retry
-from .base import BaseInventory, InventoryError
+from .base import BaseInventory
+from .http import InventoryAPISession
 
 logger = logging.getLogger('zentral.contrib.inventory.backends.watchman')
 
@@ -27,34 +26,16 @@ class InventoryClient(BaseInventory):
         self.base_url = 'https://%(account)s.monitoringclient.com' % config_d
         self.base_api_url = '{}/v2.5'.format(self.base_url)
         # requests session setup
-        self.session = requests.Session()
-        self.session.headers.update({'user-agent': 'zentral/0.0.1',
-                                     'accept': 'application/json'})
+        self.session = InventoryAPISession(self.base_api_url, "Watchman",
+                                           max_workers=self.api_max_workers,
+                                           max_rate=self.api_max_rate)
         self.session.params = {'api_key': config_d['api_key']}
-        max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-        self.session.mount(self.base_api_url,
-                           requests.adapters.HTTPAdapter(max_retries=max_retries))
 
     def _make_get_query(self, path, **params):
-        url = "%s%s" % (self.base_api_url, path)
-        try:
-            r = self.session.get(url, params=params)
-        except requests.exceptions.RequestException as e:
-            raise InventoryError("Watchman API error: %s" % str(e))
-        if r.status_code != requests.codes.ok:
-            raise InventoryError("Watchman API HTTP response status code %s" % r.status_code)
-        return r.json()
+        return self.session.get_json(path, **params)
 
     def _make_paginated_get_query(self, path, **params):
-        params['page'] = 0
-        while True:
-            i = 0
-            params['page'] += 1
-            for r in self._make_get_query(path, **params):
-                i += 1
-                yield r
-            if i < 50:
-                break
+        return self.session.iter_paginated_json(path, page_size=50, **params)
 
     def _computers(self):
         return self._make_paginated_get_query('/computers',
@@ -1,5 +1,6 @@
 import logging
 import pprint
+import time
 from django.core.management.base import BaseCommand, CommandError
 from zentral.contrib.inventory.clients import clients
 
@@ -16,6 +17,8 @@ class Command(BaseCommand):
                             help='get client machines')
         parser.add_argument('--serial-number', dest='serial_number', type=str, nargs=1,
                             help='get client machine by serial_number')
+        parser.add_argument('--benchmark', action='store_true', dest='benchmark', default=False,
+                            help='report the client machines fetching throughput')
 
     def handle(self, *args, **kwargs):
         if kwargs.get("list_clients"):
@@ -34,9 +37,23 @@ class Command(BaseCommand):
                 client = clients[client_id]
             except IndexError:
                 raise CommandError("Client {} does not exist".format(client_id))
+            benchmark = kwargs.get("benchmark")
+            session = getattr(client, "session", None)
+            start_request_count = getattr(session, "request_count", 0)
+            start_t = time.monotonic()
             n = 0
             for tree in client.get_machines():
                 n += 1
-                if serial_number is None or tree.get("serial_number") == serial_number:
+                if not benchmark and (serial_number is None or tree.get("serial_number") == serial_number):
                     pprint.pprint(tree)
+            duration = time.monotonic() - start_t
             print(n, "MACHINES")
+            if benchmark:
+                print("{:.2f}s".format(duration))
+                if duration:
+                    print("{:.2f} MACHINES/s".format(n / duration))
+                if session is not None and hasattr(session, "request_count"):
+                    request_count = session.request_count - start_request_count
+                    print(request_count, "API REQUESTS")
+                    if duration:
+                        print("{:.2f} API REQUESTS/s".format(request_count / duration))
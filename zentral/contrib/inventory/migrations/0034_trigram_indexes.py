@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+# UPPER(…) LIKE UPPER(…) is used for the icontains lookups
+TRIGRAM_INDEXES = (
+    ("inventory_osxapp_bundle_name_trgm", "inventory_osxapp", "bundle_name"),
+    ("inventory_certificate_common_name_trgm", "inventory_certificate", "common_name"),
+    ("inventory_certificate_organization_trgm", "inventory_certificate", "organization"),
+    ("inventory_certificate_organizational_unit_trgm", "inventory_certificate", "organizational_unit"),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0033_auto_20171108_1749'),
+    ]
+
+    operations = [TrigramExtension()] + [
+        migrations.RunSQL(
+            "CREATE INDEX {} ON {} USING gin (UPPER({}) gin_trgm_ops);".format(index_name, table, column),
+            "DROP INDEX {};".format(index_name)
+        )
+        for index_name, table, column in TRIGRAM_INDEXES
+    ]
@@ -1,9 +1,11 @@
 from collections import Counter
 import colorsys
 from datetime import datetime, timedelta
+import hashlib
 import logging
 import re
 from django.contrib.postgres.fields import ArrayField, JSONField
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -366,7 +368,50 @@ class PuppetNode(AbstractMTObject):
     extra_facts = JSONField(blank=True, null=True)
 
 
+CURRENT_REFERENCE_INFO_CACHE_TIMEOUT = 600  # seconds
+
+
+def current_reference_info_cache_key(source_module, reference):
+    return "inventory.current_reference_info.{}".format(
+        hashlib.sha1("{}|{}".format(source_module, reference).encode("utf-8")).hexdigest()
+    )
+
+
+def invalidate_current_reference_info(source_module, reference):
+    """Remove the cached current reference info.
+
+    With the default per-process memory cache, only the cache of the current process is invalidated,
+    and the other processes keep the info until it expires. A shared CACHES backend is required
+    for an immediate invalidation everywhere.
+    """
+    if reference:
+        key = current_reference_info_cache_key(source_module, reference)
+        cache.delete(key)
+        # once more after the commit, the cache could have been refilled with the previous info in the meantime
+        transaction.on_commit(lambda: cache.delete(key))
+
+
 class MachineSnapshotManager(MTObjectManager):
+    def current_reference_info(self, source_module, reference):
+        """Cached serial number, business unit id and id of the current machine snapshot for a reference.
+
+        Used to authenticate the clients. Raises DoesNotExist or MultipleObjectsReturned.
+        """
+        key = current_reference_info_cache_key(source_module, reference)
+        info = cache.get(key)
+        if info is None:
+            info_l = list(self.filter(currentmachinesnapshot__isnull=False,
+                                      source__module=source_module,
+                                      reference=reference)
+                              .values_list("serial_number", "business_unit_id", "id"))
+            if not info_l:
+                raise MachineSnapshot.DoesNotExist
+            elif len(info_l) > 1:
+                raise MachineSnapshot.MultipleObjectsReturned
+            info = info_l[0]
+            cache.set(key, info, CURRENT_REFERENCE_INFO_CACHE_TIMEOUT)
+        return info
+
     def current(self):
         return (self.select_related('business_unit__meta_business_unit',
                                     'os_version',
@@ -474,9 +519,17 @@ class MachineSnapshotCommitManager(models.Manager):
                                                                    parent=new_parent,
                                                                    last_seen=last_seen,
                                                                    system_uptime=system_uptime)
+                # the reference of the replaced snapshot (re-enrollment) must not be accepted anymore
+                previous_reference = (CurrentMachineSnapshot.objects.filter(serial_number=serial_number,
+                                                                            source=source)
+                                                                    .values_list("machine_snapshot__reference",
+                                                                                 flat=True)
+                                                                    .first())
                 CurrentMachineSnapshot.objects.update_or_create(serial_number=serial_number,
                                                                 source=source,
                                                                 defaults={'machine_snapshot': machine_snapshot})
+                for reference in {previous_reference, machine_snapshot.reference}:
+                    invalidate_current_reference_info(source.module, reference)
                 return new_msc, machine_snapshot
         except IntegrityError:
             msc = MachineSnapshotCommit.objects.get(serial_number=serial_number,
@@ -635,8 +688,43 @@ class MetaBusinessUnitTag(models.Model):
 
 class MetaMachine(object):
     """Simplified access to the ms."""
-    def __init__(self, serial_number, snapshots=None):
+    def __init__(self, serial_number, snapshots=None, machine_tags=None, meta_business_unit_tags=None):
         self.serial_number = serial_number
+        if snapshots is not None:
+            self.snapshots = snapshots
+        # prefetched tags, see bulk_load
+        self._machine_tags = machine_tags
+        self._meta_business_unit_tags = meta_business_unit_tags
+
+    @classmethod
+    def bulk_load(cls, serial_numbers):
+        """Build the MetaMachines for a list of serial numbers with a fixed number of queries."""
+        serial_numbers = list(serial_numbers)
+        snapshots = {}
+        for ms in (MachineSnapshot.objects.current()
+                                          .select_related('source', 'business_unit__source')
+                                          .prefetch_related('groups__source')
+                                          .filter(serial_number__in=serial_numbers)):
+            snapshots.setdefault(ms.serial_number, []).append(ms)
+        machine_tags = {}
+        for mt in (MachineTag.objects.select_related('tag__meta_business_unit')
+                                     .filter(serial_number__in=serial_numbers)):
+            machine_tags.setdefault(mt.serial_number, []).append(mt.tag)
+        meta_business_unit_ids = set(ms.business_unit.meta_business_unit_id
+                                     for ms_l in snapshots.values()
+                                     for ms in ms_l
+                                     if ms.business_unit)
+        # shared between all the MetaMachines
+        meta_business_unit_tags = {}
+        if meta_business_unit_ids:
+            for mbut in (MetaBusinessUnitTag.objects.select_related('tag__meta_business_unit')
+                                                    .filter(meta_business_unit__in=meta_business_unit_ids)):
+                meta_business_unit_tags.setdefault(mbut.meta_business_unit_id, []).append(mbut.tag)
+        return [cls(serial_number,
+                    snapshots.get(serial_number, []),
+                    machine_tags.get(serial_number, []),
+                    meta_business_unit_tags)
+                for serial_number in serial_numbers]
 
     @cached_property
     def snapshots(self):
@@ -716,12 +804,22 @@ class MetaMachine(object):
 
     @cached_property
     def tags_with_types(self):
-        tags = [('machine', mt.tag)
-                for mt in MachineTag.objects.select_related('tag').filter(
-                    serial_number=self.serial_number
-                )]
-        tags.extend(('meta_business_unit', mbut.tag)
-                    for mbut in MetaBusinessUnitTag.objects.filter(meta_business_unit__in=self.meta_business_units))
+        if self._machine_tags is not None:
+            tags = [('machine', tag) for tag in self._machine_tags]
+        else:
+            tags = [('machine', mt.tag)
+                    for mt in MachineTag.objects.select_related('tag').filter(
+                        serial_number=self.serial_number
+                    )]
+        if self._meta_business_unit_tags is not None:
+            tags.extend(('meta_business_unit', tag)
+                        for mbu_id in self.meta_business_unit_id_set
+                        for tag in self._meta_business_unit_tags.get(mbu_id, []))
+        else:
+            tags.extend(('meta_business_unit', mbut.tag)
+                        for mbut in MetaBusinessUnitTag.objects.filter(
+                            meta_business_unit__in=self.meta_business_units
+                        ))
         tags.sort(key=lambda t: (t[1].meta_business_unit is None, str(t[1]).upper()))
         return tags
 
@@ -745,7 +843,10 @@ class MetaMachine(object):
         return tags
 
     def archive(self):
-        CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number).delete()
+        qs = CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number)
+        for source_module, reference in qs.values_list("source__module", "machine_snapshot__reference"):
+            invalidate_current_reference_info(source_module, reference)
+        qs.delete()
 
 
 class MACAddressBlockAssignmentOrganization(models.Model):
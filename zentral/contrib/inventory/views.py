@@ -14,7 +14,7 @@ from .forms import (MetaBusinessUnitSearchForm, MachineGroupSearchForm, MachineS
                     MacOSAppSearchForm)
 from .models import (BusinessUnit,
                      MetaBusinessUnit, MachineGroup,
-                     MachineSnapshot, MetaMachine,
+                     MetaMachine,
                      MetaBusinessUnitTag, MachineTag, Tag,
                      OSXApp, OSXAppInstance)
 from .utils import get_prometheus_inventory_metrics, prometheus_metrics_content_type
@@ -106,11 +106,7 @@ class MachineListView(LoginRequiredMixin, TemplateView):
         context['object'] = self.object
         context['inventory'] = True
         serial_number_page = self._get_serial_number_page()
-        ms_dict = {}
-        for ms in (MachineSnapshot.objects.current()
-                   .filter(serial_number__in=[msn for msn in serial_number_page])):
-            ms_dict.setdefault(ms.serial_number, []).append(ms)
-        context['object_list'] = [MetaMachine(msn, ms_dict[msn]) for msn in serial_number_page]
+        context['object_list'] = MetaMachine.bulk_load(serial_number_page)
         # pagination
         context['total_objects'] = serial_number_page.paginator.count
         if serial_number_page.has_next():
@@ -458,61 +454,42 @@ class ArchiveMachineView(LoginRequiredMixin, TemplateView):
         return redirect('inventory:index')
 
 
-class MachineEventSet(object):
-    def __init__(self, machine_serial_number, event_type=None):
-        self.machine_serial_number = machine_serial_number
-        self.event_type = event_type
-        self.store = frontend_store
-        self._count = None
-
-    def count(self):
-        if self._count is None:
-            self._count = self.store.machine_events_count(self.machine_serial_number, self.event_type)
-        return self._count
-
-    def __len__(self):
-        return self.count()
-
-    def __getitem__(self, k):
-        if isinstance(k, slice):
-            start = int(k.start or 0)
-            stop = int(k.stop or start + 1)
-        else:
-            start = k
-            stop = k + 1
-        for event in self.store.machine_events_fetch(self.machine_serial_number, start, stop - start, self.event_type):
-            if not self.event_type:
-                link = "?event_type={}".format(event.event_type)
-            else:
-                link = None
-            yield event, link
-
-
-class MachineEventsView(LoginRequiredMixin, ListView):
+class MachineEventsView(LoginRequiredMixin, TemplateView):
     template_name = "inventory/machine_events.html"
     paginate_by = 10
 
     def get_context_data(self, **kwargs):
         context = super(MachineEventsView, self).get_context_data(**kwargs)
-        context["serial_number"] = self.serial_number
-        context["machine"] = MetaMachine(self.serial_number)
+        serial_number = context["serial_number"]
+        context["machine"] = MetaMachine(serial_number)
+        request_event_type = self.request.GET.get('event_type')
+        events_page = frontend_store.fetch_machine_events_page(serial_number,
+                                                               request_event_type,
+                                                               self.paginate_by,
+                                                               self.request.GET.get('cursor'))
+        # events
+        object_list = []
+        for event in events_page["events"]:
+            if not request_event_type:
+                link = "?event_type={}".format(event.event_type)
+            else:
+                link = None
+            object_list.append((event, link))
+        context["object_list"] = object_list
+
         # pagination
-        page = context['page_obj']
-        if page.has_next():
-            qd = self.request.GET.copy()
-            qd['page'] = page.next_page_number()
-            context['next_url'] = "?{}".format(qd.urlencode())
-        if page.has_previous():
-            qd = self.request.GET.copy()
-            qd['page'] = page.previous_page_number()
-            context['previous_url'] = "?{}".format(qd.urlencode())
-        event_types = []
-        total_events = 0
+        for cursor_key, url_key in (("older_cursor", "next_url"),
+                                    ("newer_cursor", "previous_url")):
+            cursor = events_page[cursor_key]
+            if cursor:
+                qd = self.request.GET.copy()
+                qd['cursor'] = cursor
+                context[url_key] = "?{}".format(qd.urlencode())
 
         # event types selection
-        request_event_type = self.request.GET.get('event_type')
-        for event_type, count in frontend_store.machine_events_types_with_usage(
-                self.serial_number).items():
+        event_types = []
+        total_events = 0
+        for event_type, count in events_page["event_types"].items():
             total_events += count
             event_types.append((event_type,
                                 request_event_type == event_type,
@@ -524,11 +501,6 @@ class MachineEventsView(LoginRequiredMixin, ListView):
         context['event_types'] = event_types
         return context
 
-    def get_queryset(self):
-        self.serial_number = self.kwargs['serial_number']
-        et = self.request.GET.get('event_type')
-        return MachineEventSet(self.serial_number, et)
-
 
 class MachineTagsView(LoginRequiredMixin, FormView):
     template_name = "inventory/machine_tags.html"
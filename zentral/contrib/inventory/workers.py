@@ -8,10 +8,9 @@ logger = logging.getLogger("zentral.contrib.inventory.workers")
 
 
 class InventoryWorker(PrometheusWorkerMixin):
-    sleep = 30
-
     def __init__(self, client):
         self.client = client
+        self.sleep = client.sync_interval
         self.name = "inventory worker {}".format(client.source["name"])
 
     def log_info(self, msg):
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 from dateutil import parser
 from urllib.parse import urlparse
 from xml.sax.saxutils import escape as xml_escape
@@ -18,6 +20,9 @@ class APIClientError(Exception):
 
 
 class APIClient(object):
+    group_cache_ttl = 3600  # seconds
+    group_cache_miss_refresh_delay = 60  # seconds
+
     def __init__(self, host, port, path, user, password, secret, business_unit=None, **kwargs):
         self.host, self.path, self.port, self.secret, self.business_unit = host, path, port, secret, business_unit
         self.base_url = "https://{}:{}".format(host, port)
@@ -30,8 +35,14 @@ class APIClient(object):
         max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
         self.session.mount(self.api_base_url,
                            requests.adapters.HTTPAdapter(max_retries=max_retries))
+        # group metadata caches
+        self.group_cache_lock = threading.Lock()
         self.mobile_device_groups = {}
+        self.mobile_device_groups_built_at = None
         self.reverse_computer_groups = {}
+        self.reverse_computer_groups_built_at = None
+        # cache attr → {key: time of the rebuild confirming that the key is missing}
+        self.group_cache_missing_keys = {}
 
     def get_source_d(self):
         return {"module": "zentral.contrib.jamf",
@@ -105,37 +116,61 @@ class APIClient(object):
         return [{'anchor_text': 'Group',
                  'url': url_tmpl.format(self.base_url, path_prefix, path_device_type, group_id)}]
 
+    def _get_cached_group_info(self, cache_attr, rebuild_func, key):
+        with self.group_cache_lock:
+            built_at = getattr(self, "{}_built_at".format(cache_attr))
+            missing_keys = self.group_cache_missing_keys.setdefault(cache_attr, {})
+            now = time.monotonic()
+            if built_at is None or now - built_at > self.group_cache_ttl:
+                missing_keys.clear()
+            else:
+                try:
+                    return getattr(self, cache_attr)[key]
+                except KeyError:
+                    # new group? rebuild, unless a recent rebuild has already confirmed that the key is missing
+                    missing_at = missing_keys.get(key)
+                    if missing_at is not None and now - missing_at < self.group_cache_miss_refresh_delay:
+                        raise
+            rebuild_func()
+            try:
+                return getattr(self, cache_attr)[key]
+            except KeyError:
+                missing_keys[key] = time.monotonic()
+                raise
+
     def rebuild_reverse_computer_groups(self):
         self.reverse_computer_groups = {
             cg["name"]: (cg["id"], cg["is_smart"])
             for cg in self._make_get_query('/computergroups')['computer_groups']
         }
+        self.reverse_computer_groups_built_at = time.monotonic()
 
     def get_computer_group(self, group_name):
-        for i in range(2):
-            try:
-                return self.reverse_computer_groups[group_name]
-            except KeyError:
-                if i == 0:
-                    self.rebuild_reverse_computer_groups()
-                else:
-                    raise
+        return self._get_cached_group_info("reverse_computer_groups",
+                                           self.rebuild_reverse_computer_groups,
+                                           group_name)
 
     def rebuild_mobile_device_groups(self):
         self.mobile_device_groups = {
             mdg["id"]: mdg["is_smart"]
             for mdg in self._make_get_query('/mobiledevicegroups')['mobile_device_groups']
         }
+        self.mobile_device_groups_built_at = time.monotonic()
 
     def get_mobile_device_group_is_smart(self, group_id):
-        for i in range(2):
-            try:
-                return self.mobile_device_groups[group_id]
-            except KeyError:
-                if i == 0:
-                    self.rebuild_mobile_device_groups()
-                else:
-                    raise
+        return self._get_cached_group_info("mobile_device_groups",
+                                           self.rebuild_mobile_device_groups,
+                                           group_id)
+
+    def invalidate_group_cache(self, device_type, group_id, group_name, is_smart):
+        """Invalidate the group cache if the group information has changed."""
+        with self.group_cache_lock:
+            if device_type == "computer":
+                if self.reverse_computer_groups.get(group_name) != (group_id, is_smart):
+                    self.reverse_computer_groups_built_at = None
+            elif device_type == "mobile_device":
+                if self.mobile_device_groups.get(group_id) != is_smart:
+                    self.mobile_device_groups_built_at = None
 
     def get_group_machine_references(self, device_type, jamf_id):
         if device_type == "computer":
@@ -386,6 +421,10 @@ class APIClient(object):
             r = self.session.post(url, headers=headers, data=data.encode("iso-8859-1"))
         if r.status_code != requests.codes.created:
             raise APIClientError(r.text)
+        if not group_d:
+            # new group
+            with self.group_cache_lock:
+                self.reverse_computer_groups_built_at = None
 
     def remove_computer_from_group(self, jamf_id, group_name):
         group_d = self.get_computer_group_with_name(group_name)
@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import re
+import threading
+import time
 from dateutil import parser
 from zentral.contrib.inventory.models import MachineGroup, MachineSnapshot, MachineSnapshotCommit
 from zentral.contrib.inventory.utils import inventory_events_from_machine_snapshot_commit
@@ -14,28 +17,92 @@ from .api_client import APIClient
 logger = logging.getLogger("zentral.contrib.jamf.preprocessor")
 
 
-class WebhookEventPreprocessor(object):
-    name = "jamf webhook events preprocessor"
-    input_queue_name = "jamf_events"
+class MachineRefreshMixin(object):
+    refresh_max_workers = 8
+    refresh_coalescing_window = 120  # seconds
+    max_last_refreshes = 100000
 
     def __init__(self):
         self.clients = {}
+        self.last_refreshes = {}
+        # refresh key → (due time, raw refresh event), posted at the end of the coalescing window
+        self.deferred_refreshes = {}
+        self.deferred_refreshes_condition = threading.Condition()
+        self.deferred_refreshes_thread = None
 
     def get_client(self, jamf_instance_d):
         key = (jamf_instance_d["pk"], jamf_instance_d["version"])
         client = self.clients.get(key)
         if not client:
             client = APIClient(**jamf_instance_d)
+            # forget the clients of the previous versions of the instance and their caches
+            for old_key in [k for k in self.clients if k[0] == key[0]]:
+                del self.clients[old_key]
             self.clients[key] = client
         return client
 
-    def is_known_machine(self, client, serial_number):
-        kwargs = {"serial_number": serial_number}
-        for k, v in client.get_source_d().items():
-            kwargs["source__{}".format(k)] = v
-        return MachineSnapshotCommit.objects.filter(**kwargs).count() > 0
+    def get_refresh_key(self, client, device_type, jamf_id):
+        return (client.api_base_url, device_type, str(jamf_id))
+
+    def record_refresh(self, client, device_type, jamf_id):
+        now = time.monotonic()
+        if len(self.last_refreshes) >= self.max_last_refreshes:
+            self.last_refreshes = {k: t for k, t in self.last_refreshes.items()
+                                   if now - t < self.refresh_coalescing_window}
+        self.last_refreshes[self.get_refresh_key(client, device_type, jamf_id)] = now
+
+    def should_refresh_machine(self, jamf_instance_d, client, device_type, jamf_id, force=False):
+        # coalesce the refreshes of the same machine within the coalescing window
+        # the coalesced refreshes are deferred to the end of the window
+        key = self.get_refresh_key(client, device_type, jamf_id)
+        last_refresh = self.last_refreshes.get(key)
+        if not force and last_refresh is not None \
+           and time.monotonic() - last_refresh < self.refresh_coalescing_window:
+            self.defer_refresh(key, last_refresh + self.refresh_coalescing_window,
+                               jamf_instance_d, device_type, jamf_id)
+            return False
+        return True
+
+    def defer_refresh(self, key, due, jamf_instance_d, device_type, jamf_id):
+        with self.deferred_refreshes_condition:
+            if key in self.deferred_refreshes:
+                # already deferred
+                return
+            self.deferred_refreshes[key] = (due, {"jamf_instance": jamf_instance_d,
+                                                  "device_type": device_type,
+                                                  "jamf_ids": [jamf_id],
+                                                  "deferred": True})
+            self.deferred_refreshes_condition.notify()
+        self.start_deferred_refreshes_thread()
+
+    def start_deferred_refreshes_thread(self):
+        if self.deferred_refreshes_thread is None:
+            self.deferred_refreshes_thread = threading.Thread(target=self.post_deferred_refreshes, daemon=True)
+            self.deferred_refreshes_thread.start()
 
-    def update_machine(self, client, device_type, jamf_id):
+    def pop_due_deferred_refreshes(self, now):
+        # must be called with the deferred refreshes condition acquired
+        due_keys = [k for k, (due, _) in self.deferred_refreshes.items() if due <= now]
+        return [self.deferred_refreshes.pop(k)[1] for k in due_keys]
+
+    def post_deferred_refreshes(self):
+        while True:
+            with self.deferred_refreshes_condition:
+                now = time.monotonic()
+                raw_events = self.pop_due_deferred_refreshes(now)
+                if not raw_events:
+                    timeout = None
+                    if self.deferred_refreshes:
+                        timeout = min(due for due, _ in self.deferred_refreshes.values()) - now
+                    self.deferred_refreshes_condition.wait(timeout)
+                    continue
+            for raw_event in raw_events:
+                try:
+                    queues.post_raw_event(MachineRefreshPreprocessor.input_queue_name, raw_event)
+                except Exception:
+                    logger.exception("Could not post deferred machine refresh")
+
+    def get_machine_d(self, client, device_type, jamf_id):
         logger.info("Update machine %s %s %s", client.get_source_d(), device_type, jamf_id)
         try:
             machine_d = client.get_machine_d(device_type, jamf_id)
@@ -43,22 +110,60 @@ class WebhookEventPreprocessor(object):
             logger.exception("Could not get machine_d. %s %s %s",
                              client.get_source_d(), device_type, jamf_id)
         else:
-            try:
-                msc, ms = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(machine_d)
-            except:
-                logger.exception("Could not commit machine snapshot")
-            else:
-                if msc:
-                    for idx, (event_type, created_at, payload) in enumerate(
-                            inventory_events_from_machine_snapshot_commit(msc)):
-                        event_cls = event_cls_from_type(event_type)
-                        metadata = EventMetadata(event_cls.event_type,
-                                                 machine_serial_number=ms.serial_number,
-                                                 index=idx,
-                                                 created_at=created_at,
-                                                 tags=event_cls.tags)
-                        event = event_cls(metadata, payload)
-                        yield event
+            # only the successful refreshes are coalesced
+            self.record_refresh(client, device_type, jamf_id)
+            return machine_d
+
+    def iter_machine_ds(self, client, device_type, jamf_ids):
+        if len(jamf_ids) < 2:
+            for jamf_id in jamf_ids:
+                yield self.get_machine_d(client, device_type, jamf_id)
+        else:
+            # blocking jamf API calls, made concurrently
+            with ThreadPoolExecutor(max_workers=self.refresh_max_workers) as executor:
+                yield from executor.map(lambda jamf_id: self.get_machine_d(client, device_type, jamf_id),
+                                        jamf_ids)
+
+    def commit_machine_d(self, machine_d):
+        try:
+            msc, ms = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(machine_d)
+        except:
+            logger.exception("Could not commit machine snapshot")
+        else:
+            if msc:
+                for idx, (event_type, created_at, payload) in enumerate(
+                        inventory_events_from_machine_snapshot_commit(msc)):
+                    event_cls = event_cls_from_type(event_type)
+                    metadata = EventMetadata(event_cls.event_type,
+                                             machine_serial_number=ms.serial_number,
+                                             index=idx,
+                                             created_at=created_at,
+                                             tags=event_cls.tags)
+                    event = event_cls(metadata, payload)
+                    yield event
+
+    def update_machines(self, jamf_instance_d, client, device_type, jamf_ids, force=False):
+        jamf_ids = [jamf_id for jamf_id in jamf_ids
+                    if self.should_refresh_machine(jamf_instance_d, client, device_type, jamf_id, force)]
+        for machine_d in self.iter_machine_ds(client, device_type, jamf_ids):
+            if machine_d:
+                yield from self.commit_machine_d(machine_d)
+
+    def update_machine(self, jamf_instance_d, client, device_type, jamf_id, force=False):
+        yield from self.update_machines(jamf_instance_d, client, device_type, [jamf_id], force)
+
+
+class WebhookEventPreprocessor(MachineRefreshMixin):
+    name = "jamf webhook events preprocessor"
+    input_queue_name = "jamf_events"
+    max_inline_group_refreshes = 20
+    group_refresh_chunk_size = 100
+
+    def is_known_machine(self, client, serial_number):
+        kwargs = {"serial_number": serial_number}
+        for k, v in client.get_source_d().items():
+            kwargs["source__{}".format(k)] = v
+        return MachineSnapshotCommit.objects.filter(**kwargs).count() > 0
 
     def get_inventory_groups(self, client, device_type, jamf_id, is_smart):
         kwargs = {"reference": client.group_reference(device_type, jamf_id, is_smart)}
@@ -70,7 +175,7 @@ class WebhookEventPreprocessor(object):
         for ms_d in MachineSnapshot.objects.current().filter(groups__in=inventory_groups).values("reference"):
             yield ms_d["reference"]
 
-    def update_group_machines(self, client, device_type, jamf_group_id, is_smart):
+    def update_group_machines(self, jamf_instance_d, client, device_type, jamf_group_id, is_smart):
         try:
             current_machine_references = set(client.get_group_machine_references(device_type, jamf_group_id))
         except:
@@ -85,9 +190,16 @@ class WebhookEventPreprocessor(object):
                 # known group. update symmetric difference
                 inventory_machine_references = set(self.get_inventory_groups_machine_references(inventory_groups))
                 references_iterator = inventory_machine_references ^ current_machine_references
-            for reference in references_iterator:
-                _, jamf_machine_id = reference.split(",")
-                yield from self.update_machine(client, device_type, jamf_machine_id)
+            jamf_machine_ids = [reference.split(",")[1] for reference in references_iterator]
+            if len(jamf_machine_ids) <= self.max_inline_group_refreshes:
+                yield from self.update_machines(jamf_instance_d, client, device_type, jamf_machine_ids)
+            else:
+                # large group change. refresh the machines in the background to keep the events flowing
+                for i in range(0, len(jamf_machine_ids), self.group_refresh_chunk_size):
+                    queues.post_raw_event(MachineRefreshPreprocessor.input_queue_name,
+                                          {"jamf_instance": jamf_instance_d,
+                                           "device_type": device_type,
+                                           "jamf_ids": jamf_machine_ids[i:i + self.group_refresh_chunk_size]})
 
     def process_raw_event(self, raw_event):
         jamf_instance_d = raw_event["jamf_instance"]
@@ -104,9 +216,11 @@ class WebhookEventPreprocessor(object):
                 device_type = "mobile_device"
             jamf_group_id = jamf_event["jssid"]
             is_smart = jamf_event["smartGroup"]
+            # new or updated group ?
+            client.invalidate_group_cache(device_type, jamf_group_id, jamf_event.get("name"), is_smart)
             # find missing machines and machines still in the group
             # update them
-            yield from self.update_group_machines(client, device_type, jamf_group_id, is_smart)
+            yield from self.update_group_machines(jamf_instance_d, client, device_type, jamf_group_id, is_smart)
         elif event_type == "jamf_computer_push_capability_changed":
             # enrich jamf event ?
             pass
@@ -120,7 +234,8 @@ class WebhookEventPreprocessor(object):
            or (serial_number and not self.is_known_machine(client, serial_number)):
             device_type = raw_event.get("device_type")
             jamf_machine_id = raw_event.get("jamf_id")
-            yield from self.update_machine(client, device_type, jamf_machine_id)
+            yield from self.update_machine(jamf_instance_d, client, device_type, jamf_machine_id,
+                                           force=event_type == "jamf_computer_inventory_completed")
 
         # yield jamf event
         event_cls = event_cls_from_type(event_type)
@@ -132,6 +247,18 @@ class WebhookEventPreprocessor(object):
         )
 
 
+class MachineRefreshPreprocessor(MachineRefreshMixin):
+    name = "jamf machine refresh preprocessor"
+    input_queue_name = "jamf_machine_refreshes"
+
+    def process_raw_event(self, raw_event):
+        jamf_instance_d = raw_event["jamf_instance"]
+        client = self.get_client(jamf_instance_d)
+        # the deferred refreshes are due, at the end of their coalescing window
+        yield from self.update_machines(jamf_instance_d, client, raw_event["device_type"], raw_event["jamf_ids"],
+                                        force=raw_event.get("deferred", False))
+
+
 class BeatPreprocessor(object):
     name = "jamf beats preprocessor"
     input_queue_name = "jamf_beats"
@@ -269,4 +396,5 @@ class BeatPreprocessor(object):
 
 def get_workers():
     yield queues.get_preprocessor_worker(WebhookEventPreprocessor())
+    yield queues.get_preprocessor_worker(MachineRefreshPreprocessor())
     yield queues.get_preprocessor_worker(BeatPreprocessor())
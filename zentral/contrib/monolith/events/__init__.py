@@ -1,5 +1,6 @@
 import logging
 from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
+from zentral.core.queues import queues
 
 logger = logging.getLogger('zentral.contrib.monolith.events')
 
@@ -82,7 +83,7 @@ def post_monolith_cache_server_update_request(user_agent, ip, cache_server=None,
     event.post()
 
 
-def post_monolith_repository_updates(repository, payloads, request=None):
+def build_monolith_repository_update_events(repository, payloads, request=None):
     event_class = MonolithRepositoryUpdateEvent
     repository_serialized_info = repository.serialize_for_event()
     if request:
@@ -93,5 +94,8 @@ def post_monolith_repository_updates(repository, payloads, request=None):
                                  request=request,
                                  tags=event_class.tags)
         payload.update({"repository": repository_serialized_info})
-        event = event_class(metadata, payload)
-        event.post()
+        yield event_class(metadata, payload)
+
+
+def post_monolith_repository_updates(repository, payloads, request=None):
+    queues.post_events(build_monolith_repository_update_events(repository, payloads, request))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0031_auto_20170920_1509'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pkginfo',
+            name='data_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+    ]
@@ -1,4 +1,6 @@
 from datetime import datetime, timedelta
+import hashlib
+from itertools import chain
 import logging
 import os.path
 import plistlib
@@ -6,6 +8,7 @@ import random
 import urllib.parse
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core import signing
+from django.core.cache import cache
 from django.db import models, connection
 from django.db.models import F, Q
 from django.urls import reverse
@@ -27,6 +30,22 @@ def build_signed_name(model, key):
                          salt="monolith", key=API_SECRET)
 
 
+CATALOG_CACHE_TIMEOUT = 7 * 86400  # seconds
+
+
+class CatalogManager(models.Manager):
+    def touch(self, pk_list=None):
+        """
+        Update the updated_at of the catalogs, to invalidate their cached serializations.
+
+        To call each time the pkginfos of the catalogs are modified.
+        """
+        qs = self.all()
+        if pk_list is not None:
+            qs = qs.filter(pk__in=pk_list)
+        qs.update(updated_at=timezone.now())
+
+
 class Catalog(models.Model):
     name = models.CharField(max_length=256, unique=True)
     priority = models.PositiveIntegerField(default=0)
@@ -34,6 +53,8 @@ class Catalog(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     archived_at = models.DateTimeField(blank=True, null=True)
 
+    objects = CatalogManager()
+
     class Meta:
         ordering = ('-archived_at', '-priority', 'name')
 
@@ -49,6 +70,21 @@ class Catalog(models.Model):
             pkginfo_list.append(pkginfo.get_signed_pkg_info())
         return plistlib.dumps(pkginfo_list)
 
+    def get_etag_and_serialized_catalog(self):
+        """
+        Return the ETag and the serialized catalog.
+
+        The serialized catalogs are cached per catalog version (updated_at).
+        """
+        cache_key = "monolith.catalog.{}.{}".format(self.pk, self.updated_at.timestamp())
+        etag_and_serialized_catalog = cache.get(cache_key)
+        if etag_and_serialized_catalog is None:
+            serialized_catalog = self.serialize()
+            etag = hashlib.sha1(serialized_catalog).hexdigest()
+            etag_and_serialized_catalog = (etag, serialized_catalog)
+            cache.set(cache_key, etag_and_serialized_catalog, CATALOG_CACHE_TIMEOUT)
+        return etag_and_serialized_catalog
+
     def get_absolute_url(self):
         return reverse("monolith:catalog", args=(self.pk,))
 
@@ -147,6 +183,7 @@ class PkgInfo(models.Model):
     requires = models.ManyToManyField(PkgInfoName, related_name="required_by")
     update_for = models.ManyToManyField(PkgInfoName, related_name="updated_by")
     data = JSONField()
+    data_hash = models.CharField(max_length=40, blank=True, null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     archived_at = models.DateTimeField(blank=True, null=True)
@@ -356,15 +393,75 @@ class SubManifestAttachment(models.Model):
         self.save()
 
 
+# (table, has updated_at column)
+# the pkginfo updates are tracked with the catalogs updated_at, see CatalogManager.touch.
+MANIFEST_VERSION_TABLES = (
+    ("monolith_catalog", True),
+    ("monolith_manifestcatalog", False),
+    ("monolith_manifestcatalog_tags", False),
+    ("monolith_submanifest", True),
+    ("monolith_submanifestpkginfo", True),
+    ("monolith_submanifestattachment", True),
+    ("monolith_manifestsubmanifest", False),
+    ("monolith_manifestsubmanifest_tags", False),
+    ("monolith_manifestenrollmentpackage", True),
+    ("monolith_manifestenrollmentpackage_tags", False),
+    ("monolith_printer", True),
+    ("monolith_printer_tags", False),
+)
+MANIFEST_VERSION_CACHE_KEY = "monolith.manifests_version"
+MANIFEST_VERSION_CACHE_TIMEOUT = 30  # seconds
+MANIFEST_CACHE_TIMEOUT = 86400  # seconds
+
+
+class ManifestManager(models.Manager):
+    def version(self):
+        """
+        Fingerprint of the manifests configuration, changes each time one of the
+        catalogs, sub manifests, enrollment packages or printers, or their tags,
+        is created, updated or deleted.
+
+        Cached for MANIFEST_VERSION_CACHE_TIMEOUT seconds, to scan the tables once per
+        period and not on every munki request. The configuration changes reach the
+        munki clients after at most this delay.
+        """
+        version = cache.get(MANIFEST_VERSION_CACHE_KEY)
+        if version is None:
+            version = self._compute_version()
+            cache.set(MANIFEST_VERSION_CACHE_KEY, version, MANIFEST_VERSION_CACHE_TIMEOUT)
+        return version
+
+    def _compute_version(self):
+        query = "SELECT {}".format(
+            ", ".join("(SELECT concat_ws('.', count(*), max(id){}) FROM {})".format(
+                         ", max(updated_at)" if has_updated_at else "", table
+                      ) for table, has_updated_at in MANIFEST_VERSION_TABLES)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            return hashlib.sha1("|".join(cursor.fetchone()).encode("utf-8")).hexdigest()
+
+
 class Manifest(models.Model):
     meta_business_unit = models.OneToOneField(MetaBusinessUnit)
 
+    objects = ManifestManager()
+
     class Meta:
         ordering = ('meta_business_unit__name',)
 
     def __str__(self):
         return str(self.meta_business_unit)
 
+    def get_cache_key(self, name, tags=None, version=None):
+        if version is None:
+            version = Manifest.objects.version()
+        return "monolith.manifest.{}.{}.{}.{}".format(
+            name, self.pk, version,
+            hashlib.sha1(",".join(str(tag_id) for tag_id in sorted(t.id for t in tags or [])).encode("utf-8"))
+                   .hexdigest()
+        )
+
     def get_absolute_url(self):
         return reverse('monolith:manifest', args=(self.pk,))
 
@@ -482,6 +579,9 @@ class Manifest(models.Model):
         """PkgInfos that enrollment packages are an update for with their dependencies"""
         update_for_list = ",".join(["'{}'".format(ep.get_update_for())
                                     for ep in self.enrollment_packages(tags).values()])
+        if not update_for_list:
+            # no enrollment packages
+            return []
         if tags:
             m2mt_filter = "OR m2mt.tag_id in ({})".format(",".join(str(int(t.id)) for t in tags))
         else:
@@ -509,6 +609,21 @@ class Manifest(models.Model):
         ).format(update_for_list=update_for_list, manifest_id=int(self.id), m2mt_filter=m2mt_filter)
         return PkgInfo.objects.raw(query)
 
+    def get_pkginfo_id_set(self, tags=None):
+        """
+        Return the ids of the pkginfos available for a given set of tags.
+
+        Cached per manifests configuration version and set of tags.
+        """
+        cache_key = self.get_cache_key("pkginfo_ids", tags)
+        pkginfo_ids = cache.get(cache_key)
+        if pkginfo_ids is None:
+            pkginfo_ids = frozenset(pkginfo.pk
+                                    for pkginfo in chain(self.pkginfos_with_deps_and_updates(tags),
+                                                         self.enrollment_packages_pkginfo_deps(tags)))
+            cache.set(cache_key, pkginfo_ids, MANIFEST_CACHE_TIMEOUT)
+        return pkginfo_ids
+
     def get_enrollment_catalog_signed_name(self):
         return build_signed_name("enrollment_catalog", self.meta_business_unit.id)
 
@@ -533,9 +648,13 @@ class Manifest(models.Model):
                 'included_manifests': []}
 
         # include the sub manifests
-        for sm in self.sub_manifests(tags):
+        sub_manifests = self.sub_manifests(tags)
+        sub_manifest_with_attachments_ids = set(SubManifestAttachment.objects.filter(sub_manifest__in=sub_manifests)
+                                                                             .values_list("sub_manifest_id", flat=True)
+                                                                             .distinct())
+        for sm in sub_manifests:
             data['included_manifests'].append(sm.get_signed_name())
-            if sm.has_attachments():
+            if sm.id in sub_manifest_with_attachments_ids:
                 # add the sub manifest catalog to make the attachments available.
                 # include the catalog even if the attachments are all trashed
                 # so that autoremove works.
@@ -557,16 +676,27 @@ class Manifest(models.Model):
         # printers
 
         # include the catalog with all the printers for autoremove
-        all_printers = self.printer_set.all()
-        if all_printers.count():
+        if self.printer_set.exists():
             data['catalogs'].append(self.get_printer_catalog_signed_name())
         # include only the matching active printers as managed installs
         for printer in self.printers(tags):
-            print("MANAGED INSTALL", printer.get_pkg_info_name())
             data.setdefault("managed_installs", []).append(printer.get_pkg_info_name())
 
         return plistlib.dumps(data)
 
+    def get_serialized_manifest(self, tags):
+        """
+        Return the serialized manifest for a given set of tags.
+
+        Cached, with the signed names, per manifests configuration version and set of tags.
+        """
+        cache_key = self.get_cache_key("serialized", tags)
+        serialized_manifest = cache.get(cache_key)
+        if serialized_manifest is None:
+            serialized_manifest = self.serialize(tags)
+            cache.set(cache_key, serialized_manifest, MANIFEST_CACHE_TIMEOUT)
+        return serialized_manifest
+
 
 class ManifestCatalog(models.Model):
     manifest = models.ForeignKey(Manifest)
@@ -1,7 +1,14 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import json
 import logging
 import os.path
 import plistlib
+import tempfile
+import time
+from django.db import connection, transaction
 from zentral.contrib.monolith.events import post_monolith_repository_updates
 from zentral.contrib.monolith.models import Catalog, PkgInfo, PkgInfoCategory, PkgInfoName
 from zentral.utils.local_dir import get_and_create_local_dir
@@ -9,6 +16,24 @@ from zentral.utils.local_dir import get_and_create_local_dir
 logger = logging.getLogger('zentral.contrib.monolith.repository_backends.base')
 
 
+# to serialize the concurrent catalog syncs
+SYNC_CATALOGS_LOCK_ID = 0x6d6f6e6f  # "mono"
+
+
+@contextmanager
+def timed_phase(timings, phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = time.monotonic() - start
+
+
+def get_pkg_info_data_hash(pkg_info_data, default_catalog_name=None):
+    # the default catalog overrides the catalogs of the pkg info data
+    return hashlib.sha1(json.dumps([pkg_info_data, default_catalog_name], sort_keys=True).encode("utf-8")).hexdigest()
+
+
 class BaseRepository(object):
     def __init__(self, config):
         self.manual_catalog_management = config.get("manual_catalog_management", False)
@@ -23,184 +48,344 @@ class BaseRepository(object):
     def get_all_catalog_local_path(self):
         return os.path.join(get_and_create_local_dir("monolith", "repository"), "all_catalog.xml")
 
-    def _import_pkg_info_data_catalogs(self, pkg_info_data, event_payloads):
-        catalogs = []
+    def get_all_catalog_state_path(self):
+        return os.path.join(get_and_create_local_dir("monolith", "repository"), "all_catalog_state.json")
+
+    def load_all_catalog_state(self):
+        """
+        Return the state of the local copy of the all catalog.
+
+        etag / last_modified: conditional download of the all catalog.
+        synced: hash of the last all catalog successfully synced.
+        """
+        try:
+            with open(self.get_all_catalog_state_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_and_replace(self, filepath, mode, write):
+        # unique temporary file in the same directory, for the concurrent syncs
+        with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(filepath),
+                                         prefix=".{}.".format(os.path.basename(filepath)),
+                                         delete=False) as f:
+            tmp_filepath = f.name
+            try:
+                write(f)
+            except Exception:
+                f.close()
+                os.unlink(tmp_filepath)
+                raise
+        os.replace(tmp_filepath, filepath)
+
+    def save_all_catalog_state(self, state):
+        self._write_and_replace(self.get_all_catalog_state_path(), "w", lambda f: json.dump(state, f))
+
+    def update_all_catalog_state(self, **kwargs):
+        state = self.load_all_catalog_state()
+        state.update(kwargs)
+        self.save_all_catalog_state(state)
+
+    def save_all_catalog(self, chunks):
+        """Write the downloaded all catalog, without leaving a partial copy behind."""
+        filepath = self.get_all_catalog_local_path()
+
+        def write(f):
+            for chunk in chunks:
+                f.write(chunk)
+
+        self._write_and_replace(filepath, "wb", write)
+        return filepath
+
+    def get_all_catalog_sync_key(self, all_catalog_path):
+        h = hashlib.sha256()
+        with open(all_catalog_path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 2**10), b""):
+                h.update(chunk)
+        # the default catalog is used in the sync too
+        h.update(str(self.default_catalog_name).encode("utf-8"))
+        return h.hexdigest()
+
+    def _get_pkg_info_data_catalog_names(self, pkg_info_data):
         if self.default_catalog_name:
             # force the catalog to the default catalog
             pkg_info_catalogs = [self.default_catalog_name]
         else:
             # take the catalogs from the pkg info data
             pkg_info_catalogs = pkg_info_data.get("catalogs", [])
-        for catalog_name in pkg_info_catalogs:
-            catalog_name = catalog_name.strip()
-            event_payload = {"catalog": {"name": catalog_name},
-                             "type": "catalog"}
-            try:
-                catalog = Catalog.objects.get(name=catalog_name)
-            except Catalog.DoesNotExist:
-                catalog = Catalog.objects.create(name=catalog_name)
-                event_payload["action"] = "added"
-            else:
-                if catalog.archived_at:
-                    catalog.archived_at = None
-                    catalog.save()
-                    event_payload["action"] = "unarchived"
-            catalogs.append(catalog)
-            if "action" in event_payload:
-                event_payload["catalog"]["id"] = catalog.id
-                event_payloads.append(event_payload)
+        return list(OrderedDict.fromkeys(catalog_name.strip() for catalog_name in pkg_info_catalogs))
+
+    def _load_catalogs(self, catalog_names, event_payloads):
+        # one query to fetch the existing catalogs, one to create the missing ones, one to unarchive
+        catalogs = {c.name: c for c in Catalog.objects.filter(name__in=catalog_names)}
+        new_catalogs = Catalog.objects.bulk_create([Catalog(name=catalog_name)
+                                                    for catalog_name in catalog_names
+                                                    if catalog_name not in catalogs])
+        archived_catalogs = [c for c in catalogs.values() if c.archived_at]
+        if archived_catalogs:
+            Catalog.objects.filter(pk__in=[c.pk for c in archived_catalogs]).update(archived_at=None,
+                                                                                    updated_at=datetime.now())
+        for action, action_catalogs in (("added", new_catalogs),
+                                        ("unarchived", archived_catalogs)):
+            for catalog in action_catalogs:
+                catalog.archived_at = None
+                catalogs[catalog.name] = catalog
+                event_payloads.append({"catalog": {"name": catalog.name,
+                                                   "id": catalog.id},
+                                       "type": "catalog",
+                                       "action": action})
         return catalogs
 
-    def _import_pkg_info_data(self, pkg_info_data, event_payloads):
-        name = pkg_info_data['name']
-        version = pkg_info_data['version']
-        logger.debug('PKGINFO %s %s', name, version)
-        # catalogs
-        catalogs = self._import_pkg_info_data_catalogs(pkg_info_data, event_payloads)
-        if not catalogs:
-            logger.warning('PKGINFO %s %s w/o catalogs', name, version)
-            return catalogs, None
-        # name
-        pkg_info_name, _ = PkgInfoName.objects.get_or_create(name=name)
-        # category
-        pkg_info_category = None
-        category = pkg_info_data.get('category', None)
-        if category:
-            pkg_info_category, pkg_info_category_created = PkgInfoCategory.objects.get_or_create(name=category)
-            if pkg_info_category_created:
-                event_payloads.append({"category": {"name": pkg_info_category.name,
-                                                    "id": pkg_info_category.id},
-                                       "type": "category",
-                                       "action": "added"})
-        # requires
-        requires = [pif for pif, created in (PkgInfoName.objects.get_or_create(name=n)
-                                             for n in pkg_info_data.get('requires', []))]
-        # update_for
-        update_for = [pif for pif, created in (PkgInfoName.objects.get_or_create(name=n)
-                                               for n in pkg_info_data.get('update_for', []))]
-        # serialize pkg_info_data
-        for key, val in pkg_info_data.items():
-            if isinstance(val, datetime):
-                pkg_info_data[key] = val.isoformat()
-        # save PkgInfo in db
-        event_payload = {"pkg_info": {"name": name,
-                                      "version": version},
+    def _load_objects_by_name(self, model, names):
+        # one query to fetch the existing objects, one to create the missing ones
+        objects = {o.name: o for o in model.objects.filter(name__in=names)}
+        new_objects = model.objects.bulk_create([model(name=name) for name in names if name not in objects])
+        for o in new_objects:
+            objects[o.name] = o
+        return objects, new_objects
+
+    def _update_pkg_info(self, pkg_info, pkg_info_data, pkg_info_category, catalogs, requires, update_for):
+        event_payload = {"pkg_info": {"name": pkg_info.name.name,
+                                      "version": pkg_info.version},
                          "type": "pkg_info"}
-        try:
-            pkg_info = (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                       .get(name=pkg_info_name, version=version))
-        except PkgInfo.DoesNotExist:
-            pkg_info = PkgInfo.objects.create(name=pkg_info_name,
-                                              version=version,
-                                              category=pkg_info_category,
-                                              data=pkg_info_data)
-            pkg_info.catalogs.set(catalogs)
-            pkg_info.requires.set(requires)
-            pkg_info.update_for.set(update_for)
+
+        # if the pkg exists, but is archived, consider it like a new pkg
+        if pkg_info.archived_at:
+            diff = None
+            pkg_info.archived_at = None
             event_payload["action"] = "added"
         else:
-            # if the pkg exists, but is archived, consider it like a new pkg
-            if pkg_info.archived_at:
-                diff = None
-                pkg_info.archived_at = None
-                event_payload["action"] = "added"
-            else:
-                diff = {}
-
-            # update category if necessary
-            pkg_info_old_category = pkg_info.category
-            if pkg_info_old_category != pkg_info_category:
-                pkg_info.category = pkg_info_category
-                if diff is not None:
-                    attr_diff = {}
-                    if pkg_info_old_category:
-                        attr_diff["removed"] = str(pkg_info_old_category)
-                    if pkg_info_category:
-                        attr_diff["added"] = str(pkg_info_category)
-                    diff["category"] = attr_diff
-                    event_payload["action"] = "updated"
+            diff = {}
+
+        # update category if necessary
+        pkg_info_old_category = pkg_info.category
+        if pkg_info_old_category != pkg_info_category:
+            pkg_info.category = pkg_info_category
+            if diff is not None:
+                attr_diff = {}
+                if pkg_info_old_category:
+                    attr_diff["removed"] = str(pkg_info_old_category)
+                if pkg_info_category:
+                    attr_diff["added"] = str(pkg_info_category)
+                diff["category"] = attr_diff
+                event_payload["action"] = "updated"
+
+        # update data if necessary
+        pkg_info_old_data = pkg_info.data
+        if pkg_info_old_data != pkg_info_data:
+            pkg_info.data = pkg_info_data
+            if diff is not None:
+                attr_diff = {}
+                if pkg_info_old_data:
+                    attr_diff["removed"] = pkg_info_old_data
+                if pkg_info_data:
+                    attr_diff["added"] = pkg_info_data
+                diff["data"] = attr_diff
+                event_payload["action"] = "updated"
 
-            # update data if necessary
-            pkg_info_old_data = pkg_info.data
-            if pkg_info_old_data != pkg_info_data:
-                pkg_info.data = pkg_info_data
+        # update m2m attributes
+        pkg_info_m2m_updates = [("requires", requires),
+                                ("update_for", update_for)]
+        if not self.manual_catalog_management:
+            # need to update the pkg info catalogs too
+            pkg_info_m2m_updates.append(("catalogs", catalogs))
+
+        for pkg_info_attr, pkg_info_values in pkg_info_m2m_updates:
+            pkg_info_old_values = set(getattr(pkg_info, pkg_info_attr).all())
+            pkg_info_values = set(pkg_info_values)
+            if pkg_info_old_values != pkg_info_values:
+                getattr(pkg_info, pkg_info_attr).set(pkg_info_values)
                 if diff is not None:
                     attr_diff = {}
-                    if pkg_info_old_data:
-                        attr_diff["removed"] = pkg_info_old_data
-                    if pkg_info_data:
-                        attr_diff["added"] = pkg_info_data
-                    diff["data"] = attr_diff
+                    removed = pkg_info_old_values - pkg_info_values
+                    if removed:
+                        attr_diff = {"removed": sorted(str(r) for r in removed)}
+                    added = pkg_info_values - pkg_info_old_values
+                    if added:
+                        attr_diff = {"added": sorted(str(a) for a in added)}
+                    diff[pkg_info_attr] = attr_diff
                     event_payload["action"] = "updated"
 
-            # save updates
-            if event_payload.get("action"):
-                pkg_info.save()
+        # include the updates in the event payload
+        if diff:
+            event_payload["pkg_info"]["diff"] = diff
 
-            # update m2m attributes
-            pkg_info_m2m_updates = [("requires", requires),
-                                    ("update_for", update_for)]
-            if not self.manual_catalog_management:
-                # need to update the pkg info catalogs too
-                pkg_info_m2m_updates.append(("catalogs", catalogs))
-
-            for pkg_info_attr, pkg_info_values in pkg_info_m2m_updates:
-                pkg_info_old_values = set(getattr(pkg_info, pkg_info_attr).all())
-                pkg_info_values = set(pkg_info_values)
-                if pkg_info_old_values != pkg_info_values:
-                    getattr(pkg_info, pkg_info_attr).set(pkg_info_values)
-                    if diff is not None:
-                        attr_diff = {}
-                        removed = pkg_info_old_values - pkg_info_values
-                        if removed:
-                            attr_diff = {"removed": sorted(str(r) for r in removed)}
-                        added = pkg_info_values - pkg_info_old_values
-                        if added:
-                            attr_diff = {"added": sorted(str(a) for a in added)}
-                        diff[pkg_info_attr] = attr_diff
-                        event_payload["action"] = "updated"
-
-            # include the updates in the event payload
-            if diff:
-                event_payload["pkg_info"]["diff"] = diff
-
-        if "action" in event_payload:
-            event_payloads.append(event_payload)
-
-        return catalogs, pkg_info.get_key()
+        return event_payload
 
-    def sync_catalogs(self):
-        with open(self.download_all_catalog(), "rb") as f:
-            catalog_plist = plistlib.load(f)
-        found_pkg_infos = set([])
-        found_catalogs = set([])
-        event_payloads = []
-        # update or create current pkg_infos
-        for pkg_info_data in catalog_plist:
-            catalogs, pkg_info_key = self._import_pkg_info_data(pkg_info_data, event_payloads)
-            found_catalogs.update(catalogs)
-            if pkg_info_key:
-                if pkg_info_key in found_pkg_infos:
+    def _update_pkg_info_data_hashes(self, data_hashes):
+        # only the data hashes have changed. one query.
+        query = ("UPDATE monolith_pkginfo SET data_hash = h.data_hash "
+                 "FROM (SELECT unnest(%s::integer[]) AS id, unnest(%s::varchar[]) AS data_hash) AS h "
+                 "WHERE monolith_pkginfo.id = h.id")
+        with connection.cursor() as cursor:
+            cursor.execute(query, [list(data_hashes.keys()), list(data_hashes.values())])
+
+    def _sync_catalogs(self, catalog_plist, event_payloads, timings):
+        with timed_phase(timings, "prepare"):
+            pkg_info_data_dict = OrderedDict()
+            for pkg_info_data in catalog_plist:
+                # serialize pkg_info_data
+                for key, val in pkg_info_data.items():
+                    if isinstance(val, datetime):
+                        pkg_info_data[key] = val.isoformat()
+                pkg_info_key = (pkg_info_data['name'], pkg_info_data['version'])
+                if pkg_info_key in pkg_info_data_dict:
                     logger.warning('PKGINFO %s %s already found', pkg_info_key[0], pkg_info_key[1])
+                pkg_info_data_dict[pkg_info_key] = pkg_info_data
+            all_catalog_names = set([])
+            all_names = set([])
+            all_category_names = set([])
+            pkg_info_catalog_names = {}
+            for pkg_info_key, pkg_info_data in pkg_info_data_dict.items():
+                catalog_names = self._get_pkg_info_data_catalog_names(pkg_info_data)
+                if not catalog_names:
+                    logger.warning('PKGINFO %s %s w/o catalogs', pkg_info_key[0], pkg_info_key[1])
+                    continue
+                pkg_info_catalog_names[pkg_info_key] = catalog_names
+                all_catalog_names.update(catalog_names)
+                all_names.add(pkg_info_key[0])
+                all_names.update(pkg_info_data.get('requires', []))
+                all_names.update(pkg_info_data.get('update_for', []))
+                category = pkg_info_data.get('category', None)
+                if category:
+                    all_category_names.add(category)
+
+        with timed_phase(timings, "names"):
+            catalogs = self._load_catalogs(all_catalog_names, event_payloads)
+            pkg_info_names, _ = self._load_objects_by_name(PkgInfoName, all_names)
+            categories, new_categories = self._load_objects_by_name(PkgInfoCategory, all_category_names)
+            for category in new_categories:
+                event_payloads.append({"category": {"name": category.name,
+                                                    "id": category.id},
+                                       "type": "category",
+                                       "action": "added"})
+
+        with timed_phase(timings, "diff"):
+            existing_pkg_infos = {(name, version): (pk, data_hash, archived_at)
+                                  for pk, name, version, data_hash, archived_at
+                                  in PkgInfo.objects.values_list("id", "name__name", "version",
+                                                                 "data_hash", "archived_at")}
+            new_pkg_info_keys = []
+            updated_pkg_info_keys = {}
+            for pkg_info_key in pkg_info_catalog_names:
+                data_hash = get_pkg_info_data_hash(pkg_info_data_dict[pkg_info_key], self.default_catalog_name)
+                try:
+                    pk, existing_data_hash, archived_at = existing_pkg_infos[pkg_info_key]
+                except KeyError:
+                    new_pkg_info_keys.append((pkg_info_key, data_hash))
                 else:
-                    found_pkg_infos.update([pkg_info_key])
-        # archive old catalogs if auto catalog management
-        if not self.manual_catalog_management:
-            for c in Catalog.objects.filter(archived_at__isnull=True):
-                if c not in found_catalogs:
-                    c.archived_at = datetime.now()
-                    c.save()
+                    if archived_at or existing_data_hash != data_hash:
+                        updated_pkg_info_keys[pk] = (pkg_info_key, data_hash)
+
+        def get_pkg_info_relations(pkg_info_key):
+            pkg_info_data = pkg_info_data_dict[pkg_info_key]
+            category = pkg_info_data.get('category', None)
+            return (pkg_info_data,
+                    categories[category] if category else None,
+                    [catalogs[n] for n in pkg_info_catalog_names[pkg_info_key]],
+                    [pkg_info_names[n] for n in pkg_info_data.get('requires', [])],
+                    [pkg_info_names[n] for n in pkg_info_data.get('update_for', [])])
+
+        with timed_phase(timings, "create"):
+            new_pkg_infos = []
+            new_pkg_info_relations = []
+            for pkg_info_key, data_hash in new_pkg_info_keys:
+                pkg_info_data, category, pkg_info_catalogs, requires, update_for = \
+                    get_pkg_info_relations(pkg_info_key)
+                new_pkg_infos.append(PkgInfo(name=pkg_info_names[pkg_info_key[0]],
+                                             version=pkg_info_key[1],
+                                             category=category,
+                                             data=pkg_info_data,
+                                             data_hash=data_hash))
+                new_pkg_info_relations.append((pkg_info_catalogs, requires, update_for))
+            new_pkg_infos = PkgInfo.objects.bulk_create(new_pkg_infos)
+            catalog_links = []
+            requires_links = []
+            update_for_links = []
+            for pkg_info, (pkg_info_catalogs, requires, update_for) in zip(new_pkg_infos, new_pkg_info_relations):
+                catalog_links.extend(PkgInfo.catalogs.through(pkginfo_id=pkg_info.pk, catalog_id=c.pk)
+                                     for c in pkg_info_catalogs)
+                requires_links.extend(PkgInfo.requires.through(pkginfo_id=pkg_info.pk, pkginfoname_id=pin.pk)
+                                      for pin in set(requires))
+                update_for_links.extend(PkgInfo.update_for.through(pkginfo_id=pkg_info.pk, pkginfoname_id=pin.pk)
+                                        for pin in set(update_for))
+                event_payloads.append({"pkg_info": {"name": pkg_info.name.name,
+                                                    "version": pkg_info.version},
+                                       "type": "pkg_info",
+                                       "action": "added"})
+            for through_model, links in ((PkgInfo.catalogs.through, catalog_links),
+                                         (PkgInfo.requires.through, requires_links),
+                                         (PkgInfo.update_for.through, update_for_links)):
+                through_model.objects.bulk_create(links)
+
+        with timed_phase(timings, "update"):
+            updated_data_hashes = {}
+            for pkg_info in (PkgInfo.objects.select_related("name", "category")
+                                            .prefetch_related("catalogs", "requires", "update_for")
+                                            .filter(pk__in=list(updated_pkg_info_keys))):
+                pkg_info_key, data_hash = updated_pkg_info_keys[pkg_info.pk]
+                event_payload = self._update_pkg_info(pkg_info, *get_pkg_info_relations(pkg_info_key))
+                if event_payload.get("action"):
+                    pkg_info.data_hash = data_hash
+                    pkg_info.save()
+                    event_payloads.append(event_payload)
+                else:
+                    updated_data_hashes[pkg_info.pk] = data_hash
+            if updated_data_hashes:
+                self._update_pkg_info_data_hashes(updated_data_hashes)
+
+        with timed_phase(timings, "archive"):
+            # archive old catalogs if auto catalog management
+            if not self.manual_catalog_management:
+                found_catalog_ids = [c.pk for c in catalogs.values()]
+                archived_catalogs = list(Catalog.objects.filter(archived_at__isnull=True)
+                                                        .exclude(pk__in=found_catalog_ids))
+                if archived_catalogs:
+                    now = datetime.now()
+                    Catalog.objects.filter(pk__in=[c.pk for c in archived_catalogs]).update(archived_at=now,
+                                                                                            updated_at=now)
+                for c in archived_catalogs:
                     event_payloads.append({"catalog": {"name": c.name,
                                                        "id": c.id},
                                            "type": "catalog",
                                            "action": "archived"})
-        # archive old pkg_infos
-        for pkg_info in PkgInfo.objects.select_related("name").filter(archived_at__isnull=True):
-            if pkg_info.get_key() not in found_pkg_infos:
-                pkg_info.archived_at = datetime.now()
-                pkg_info.save()
-                event_payloads.append({"pkg_info": {"name": pkg_info.name.name,
-                                                    "version": pkg_info.version},
-                                       "type": "pkg_info",
-                                       "action": "archived"})
-        post_monolith_repository_updates(self, event_payloads)
+            # archive old pkg_infos
+            archived_pkg_info_ids = []
+            for pkg_info_key, (pk, _, archived_at) in existing_pkg_infos.items():
+                if not archived_at and pkg_info_key not in pkg_info_catalog_names:
+                    archived_pkg_info_ids.append(pk)
+                    event_payloads.append({"pkg_info": {"name": pkg_info_key[0],
+                                                        "version": pkg_info_key[1]},
+                                           "type": "pkg_info",
+                                           "action": "archived"})
+            if archived_pkg_info_ids:
+                now = datetime.now()
+                PkgInfo.objects.filter(pk__in=archived_pkg_info_ids).update(archived_at=now,
+                                                                            updated_at=now)
+
+        if any(event_payload["type"] == "pkg_info" for event_payload in event_payloads):
+            # invalidate the cached catalogs
+            Catalog.objects.touch()
+
+    def sync_catalogs(self):
+        timings = OrderedDict()
+        with timed_phase(timings, "download"):
+            all_catalog_path = self.download_all_catalog()
+            sync_key = self.get_all_catalog_sync_key(all_catalog_path)
+        if self.load_all_catalog_state().get("synced") == sync_key:
+            logger.info("Catalogs already synced. download: %.3fs", timings["download"])
+            return timings
+        with timed_phase(timings, "load"):
+            with open(all_catalog_path, "rb") as f:
+                catalog_plist = plistlib.load(f)
+        event_payloads = []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [SYNC_CATALOGS_LOCK_ID])
+            self._sync_catalogs(catalog_plist, event_payloads, timings)
+            transaction.on_commit(lambda: self.update_all_catalog_state(synced=sync_key))
+        with timed_phase(timings, "events"):
+            post_monolith_repository_updates(self, event_payloads)
+        logger.info("Catalogs synced. %s", ", ".join("{}: {:.3f}s".format(phase, duration)
+                                                     for phase, duration in timings.items()))
+        return timings
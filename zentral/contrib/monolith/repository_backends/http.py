@@ -1,9 +1,12 @@
+import logging
 import os.path
 from django.http import HttpResponseRedirect
 import requests
 from zentral.contrib.monolith.exceptions import RepositoryError
 from .base import BaseRepository
 
+logger = logging.getLogger('zentral.contrib.monolith.repository_backends.http')
+
 
 class Repository(BaseRepository):
     def __init__(self, config):
@@ -17,12 +20,23 @@ class Repository(BaseRepository):
 
     def download_all_catalog(self):
         filepath = self.get_all_catalog_local_path()
-        r = requests.get(os.path.join(self.root, "catalogs/all"))
+        headers = {}
+        if os.path.exists(filepath):
+            # conditional GET
+            state = self.load_all_catalog_state()
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+        r = requests.get(os.path.join(self.root, "catalogs/all"), headers=headers, stream=True)
+        if r.status_code == 304:
+            logger.debug("All catalog not modified")
+            return filepath
         if not r.status_code == 200:
             raise RepositoryError
-        with open(filepath, "wb") as f:
-            for chunk in r.iter_content(chunk_size=64*2**10):
-                f.write(chunk)
+        self.save_all_catalog(r.iter_content(chunk_size=64*2**10))
+        self.update_all_catalog_state(etag=r.headers.get("ETag"),
+                                      last_modified=r.headers.get("Last-Modified"))
         return filepath
 
     def make_munki_repository_response(self, section, name, cache_server=None):
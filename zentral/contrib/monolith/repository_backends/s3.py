@@ -1,10 +1,14 @@
+import logging
 import os.path
 import boto3
 from botocore.client import Config
+from botocore.exceptions import ClientError
 from django.http import HttpResponseRedirect
 from zentral.contrib.monolith.exceptions import RepositoryError
 from .base import BaseRepository
 
+logger = logging.getLogger('zentral.contrib.monolith.repository_backends.s3')
+
 
 class Repository(BaseRepository):
     def __init__(self, config):
@@ -45,13 +49,27 @@ class Repository(BaseRepository):
 
     def download_all_catalog(self):
         filepath = self.get_all_catalog_local_path()
+        get_object_kwargs = {"Bucket": self.bucket,
+                             "Key": os.path.join(self.prefix, "catalogs/all")}
+        if os.path.exists(filepath):
+            # conditional GET
+            etag = self.load_all_catalog_state().get("etag")
+            if etag:
+                get_object_kwargs["IfNoneMatch"] = etag
         try:
-            self.client.download_file(self.bucket,
-                                      os.path.join(self.prefix, "catalogs/all"),
-                                      filepath)
-        except Exception as e:
-            print("Exception", e)
+            response = self.client.get_object(**get_object_kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+                logger.debug("All catalog not modified")
+                return filepath
+            logger.exception("Could not download the all catalog")
+            raise RepositoryError
+        except Exception:
+            logger.exception("Could not download the all catalog")
             raise RepositoryError
+        body = response["Body"]
+        self.save_all_catalog(iter(lambda: body.read(64*2**10), b""))
+        self.update_all_catalog_state(etag=response.get("ETag"))
         return filepath
 
     def make_munki_repository_response(self, section, name, cache_server=None):
@@ -1,4 +1,3 @@
-from itertools import chain
 import logging
 import os.path
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -8,9 +7,11 @@ from django.core.urlresolvers import reverse_lazy
 from django.db.models import F
 from django.http import (FileResponse,
                          Http404,
-                         HttpResponse, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect)
+                         HttpResponse, HttpResponseForbidden, HttpResponseNotFound, HttpResponseNotModified,
+                         HttpResponseRedirect)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.views.generic import DetailView, ListView, TemplateView, View
 from django.views.generic.edit import CreateView, DeleteView, FormView, UpdateView
 from zentral.contrib.inventory.models import MetaMachine
@@ -82,6 +83,7 @@ class UpdatePkgInfoCatalogView(LoginRequiredMixin, UpdateView):
         response = super().form_valid(form)
         new_catalogs = set(self.object.catalogs.all())
         if old_catalogs != new_catalogs:
+            Catalog.objects.touch([c.pk for c in old_catalogs | new_catalogs])
             attr_diff = {}
             removed = old_catalogs - new_catalogs
             if removed:
@@ -934,7 +936,23 @@ class DownloadPrinterPPDView(View):
 # managedsoftwareupdate API
 
 
+def make_xml_response_with_etag(request, etag, data):
+    etag = '"{}"'.format(etag)
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag in (e.strip() for e in if_none_match.split(",")):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type="application/xml")
+    response["ETag"] = etag
+    return response
+
+
 class MRBaseView(View):
+    @cached_property
+    def tags(self):
+        # not needed by all the views
+        return MetaMachine(self.machine_serial_number).tags
+
     def post_monolith_munki_request(self, **payload):
         payload["manifest"] = {"id": self.manifest.id,
                                "name": str(self.manifest)}
@@ -948,8 +966,6 @@ class MRBaseView(View):
             return HttpResponseForbidden("No no no!")
         self.machine_serial_number = api_data.get("machine_serial_number", None)
         self.user_agent, self.ip = user_agent_and_ip_address_from_request(request)
-        self.machine = MetaMachine(self.machine_serial_number)
-        self.tags = self.machine.tags
         self.meta_business_unit = api_data['business_unit'].meta_business_unit
         self.manifest = get_object_or_404(Manifest, meta_business_unit=self.meta_business_unit)
         return super().dispatch(request, *args, **kwargs)
@@ -1017,9 +1033,10 @@ class MRCatalogView(MRSignedView):
             # verify machine access to catalog and respond
             catalog = self.manifest.catalog(c_id, self.tags)
             if catalog:
-                catalog_data = catalog.serialize()
                 event_payload["catalog"].update({"name": catalog.name,
                                                  "priority": catalog.priority})
+                etag, catalog_data = catalog.get_etag_and_serialized_catalog()
+                return make_xml_response_with_etag(self.request, etag, catalog_data)
         if catalog_data:
             return HttpResponse(catalog_data, content_type="application/xml")
 
@@ -1039,7 +1056,7 @@ class MRManifestView(MRSignedView):
     def do_get(self, model, key, event_payload):
         manifest_data = None
         if model == "manifest":
-            manifest_data = self.manifest.serialize(self.tags)
+            manifest_data = self.manifest.get_serialized_manifest(self.tags)
         elif model == "sub_manifest":
             sm_id = int(key)
             # verify machine access to sub manifest and respond
@@ -1102,17 +1119,19 @@ class MRPackageView(MRSignedView):
         elif model == "repository_package":
             pk = int(key)
             event_payload["repository_package"] = {"id": pk}
-            # TODO: cache
-            for pkginfo in chain(self.manifest.pkginfos_with_deps_and_updates(self.tags),
-                                 self.manifest.enrollment_packages_pkginfo_deps(self.tags)):
-                if pkginfo.pk == pk:
-                    event_payload["repository_package"].update({"name": pkginfo.name.name,
-                                                                "version": pkginfo.version})
-                    cache_server = CacheServer.objects.get_current_for_manifest_and_ip(self.manifest, self.ip)
-                    return monolith_conf.repository.make_munki_repository_response(
-                        "pkgs", pkginfo.data["installer_item_location"],
-                        cache_server=cache_server
-                    )
+            if pk not in self.manifest.get_pkginfo_id_set(self.tags):
+                return
+            try:
+                pkginfo = PkgInfo.objects.select_related("name").get(pk=pk)
+            except PkgInfo.DoesNotExist:
+                return
+            event_payload["repository_package"].update({"name": pkginfo.name.name,
+                                                        "version": pkginfo.version})
+            cache_server = CacheServer.objects.get_current_for_manifest_and_ip(self.manifest, self.ip)
+            return monolith_conf.repository.make_munki_repository_response(
+                "pkgs", pkginfo.data["installer_item_location"],
+                cache_server=cache_server
+            )
 
 
 class MRRedirectView(MRBaseView):
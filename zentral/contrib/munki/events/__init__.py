@@ -1,6 +1,10 @@
+from datetime import datetime, timezone
+from itertools import chain
 import logging
+import uuid
 from dateutil import parser
 from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
+from zentral.core.queues import queues
 
 logger = logging.getLogger('zentral.contrib.munki.events')
 
@@ -33,20 +37,46 @@ class MunkiEvent(BaseEvent):
 register_event_type(MunkiEvent)
 
 
+def parse_munki_time(value):
+    # fast path for the "%Y-%m-%d %H:%M:%S +0000" format of the munki reports
+    if len(value) == 25 and value.endswith(" +0000"):
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                            tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return parser.parse(value)
+
+
 def post_munki_request_event(msn, user_agent, ip, **kwargs):
     MunkiRequestEvent.post_machine_request_payloads(msn, user_agent, ip, [kwargs])
 
 
-def post_munki_events(msn, user_agent, ip, data):
-    for report in data:
+def build_munki_events(msn, user_agent, ip, reports):
+    request = EventRequest(user_agent, ip)
+    for report in reports:
         events = report.pop('events')
-        metadata = EventMetadata(MunkiEvent.event_type,
-                                 machine_serial_number=msn,
-                                 request=EventRequest(user_agent, ip),
-                                 tags=MunkiEvent.tags)
+        # one uuid per report, one metadata per event
+        report_uuid = uuid.uuid4()
         for index, (created_at, payload) in enumerate(events):
-            metadata.index = index
-            metadata.created_at = parser.parse(created_at)
+            metadata = EventMetadata(MunkiEvent.event_type,
+                                     uuid=report_uuid,
+                                     index=index,
+                                     created_at=parse_munki_time(created_at),
+                                     machine_serial_number=msn,
+                                     request=request,
+                                     tags=MunkiEvent.tags)
+            # the report values are shared, not copied
             payload.update(report)
-            event = MunkiEvent(metadata, payload)
-            event.post()
+            yield MunkiEvent(metadata, payload)
+
+
+def post_munki_events(msn, user_agent, ip, reports, request_payload=None):
+    """Post the events of the munki reports in one batch, with an optional munki request event."""
+    events = build_munki_events(msn, user_agent, ip, reports)
+    if request_payload is not None:
+        events = chain(MunkiRequestEvent.build_from_machine_request_payloads(msn, user_agent, ip,
+                                                                             [request_payload]),
+                       events)
+    queues.post_events(events)
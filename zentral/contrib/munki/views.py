@@ -10,7 +10,7 @@ from django.views.generic.edit import FormView
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.core.probes.models import ProbeSource
 from zentral.utils.api_views import SignedRequestHeaderJSONPostAPIView, BaseEnrollmentView, BaseInstallerPackageView
-from .events import post_munki_events, post_munki_request_event
+from .events import parse_munki_time, post_munki_events, post_munki_request_event
 from .forms import CreateInstallProbeForm, UpdateInstallProbeForm
 from .models import MunkiState
 from .osx_package.builder import MunkiZentralEnrollPkgBuilder
@@ -141,24 +141,23 @@ class PostJobView(BaseView):
             msn = ms.serial_number
         else:
             msn = ms_tree['reference']
-        reports = [(parser.parse(r.pop('start_time')),
-                    parser.parse(r.pop('end_time')),
+        reports = [(parse_munki_time(r.pop('start_time')),
+                    parse_munki_time(r.pop('end_time')),
                     r) for r in data.pop('reports')]
-        # Events
-        post_munki_request_event(msn, self.user_agent, self.ip,
-                                 request_type="postflight",
-                                 include_santa_fileinfo=data.get('include_santa_fileinfo', False))
+        # Events, in one batch
         post_munki_events(msn,
                           self.user_agent,
                           self.ip,
-                          (r for _, _, r in reports))
+                          (r for _, _, r in reports),
+                          request_payload={"request_type": "postflight",
+                                           "include_santa_fileinfo": data.get('include_santa_fileinfo', False)})
         # MunkiState
         update_dict = {'user_agent': self.user_agent,
                        'ip': self.ip}
         if data.get('santa_fileinfo_included', False):
             update_dict['binaryinfo_last_seen'] = timezone.now()
         if reports:
-            reports.sort()
+            reports.sort(key=lambda t: t[:2])
             start_time, end_time, report = reports[-1]
             update_dict.update({'munki_version': report.get('munki_version', None),
                                 'sha1sum': report['sha1sum'],
@@ -1,5 +1,10 @@
+from collections import namedtuple, OrderedDict
+import hashlib
+import json
 import logging
+from django.core.cache import cache
 from zentral.core.probes.conf import ProbeList
+from zentral.core.probes.models import ProbeSource
 from zentral.contrib.inventory.conf import MACOS
 
 logger = logging.getLogger('zentral.contrib.osquery.conf')
@@ -64,6 +69,41 @@ def get_distributed_inventory_queries(machine, ms):
             yield "{}{}".format(INVENTORY_DISTRIBUTED_QUERY_PREFIX, table_name), query
 
 
+OsqueryConfFragment = namedtuple("OsqueryConfFragment",
+                                 ["pack_key", "pack_discovery_queries", "queries", "file_paths"])
+
+
+def compile_probe_conf_fragment(probe):
+    queries = OrderedDict()
+    for osquery_query in probe.iter_scheduled_queries():
+        if osquery_query.name in queries:
+            logger.warning("Probe %s query %s skipped, already seen", probe.pk, osquery_query.name)
+        else:
+            queries[osquery_query.name] = osquery_query.to_configuration()
+    return OsqueryConfFragment(probe.pack_key,
+                               tuple(probe.pack_discovery_queries),
+                               tuple(queries.items()),
+                               tuple((file_path.category, file_path.file_path, file_path.file_access)
+                                     for file_path in getattr(probe, "file_paths", [])))
+
+
+# probe source pk → (probe source updated_at, compiled configuration fragment)
+probe_conf_fragments = {}
+
+
+def get_probe_conf_fragment(probe):
+    """Return the configuration fragment of a probe, compiled once per probe source version."""
+    version = probe.source.updated_at
+    try:
+        fragment_version, fragment = probe_conf_fragments[probe.pk]
+    except KeyError:
+        fragment_version = fragment = None
+    if fragment is None or fragment_version != version:
+        fragment = compile_probe_conf_fragment(probe)
+        probe_conf_fragments[probe.pk] = (version, fragment)
+    return fragment
+
+
 def build_osquery_conf(machine):
     schedule = {
         INVENTORY_QUERY_NAME: {
@@ -76,32 +116,33 @@ def build_osquery_conf(machine):
     file_paths = {}
     file_accesses = []
     # ProbeList() to avoid cache inconsistency
-    # TODO: check performances
     for probe in (ProbeList().model_filter("OsqueryProbe",
                                            "OsqueryComplianceProbe",
                                            "OsqueryFIMProbe")
                              .machine_filtered(machine)):
+        fragment = get_probe_conf_fragment(probe)
+
         # packs or schedule
-        if probe.pack_key:
-            pack_conf = packs.setdefault(probe.pack_key,
-                                         {"discovery": probe.pack_discovery_queries,
+        if fragment.pack_key:
+            pack_conf = packs.setdefault(fragment.pack_key,
+                                         {"discovery": list(fragment.pack_discovery_queries),
                                           "queries": {}})
             query_dict = pack_conf["queries"]
         else:
             query_dict = schedule
 
         # add probe queries to query_dict
-        for osquery_query in probe.iter_scheduled_queries():
-            if osquery_query.name in query_dict:
-                logger.warning("Query %s skipped, already seen", osquery_query.name)
+        for query_name, query_conf in fragment.queries:
+            if query_name in query_dict:
+                logger.warning("Query %s skipped, already seen", query_name)
             else:
-                query_dict[osquery_query.name] = osquery_query.to_configuration()
+                query_dict[query_name] = dict(query_conf)
 
         # file paths / file accesses
-        for file_path in getattr(probe, "file_paths", []):
-            file_paths[file_path.category] = [file_path.file_path]
-            if file_path.file_access:
-                file_accesses.append(file_path.category)
+        for category, file_path, file_access in fragment.file_paths:
+            file_paths[category] = [file_path]
+            if file_access:
+                file_accesses.append(category)
 
     conf = {
         'decorators': DECORATORS,
@@ -114,3 +155,32 @@ def build_osquery_conf(machine):
     if file_accesses:
         conf['file_accesses'] = list(set(file_accesses))
     return conf
+
+
+CONF_CACHE_TIMEOUT = 3600  # seconds
+
+
+def get_machine_conf_class(machine):
+    # everything the configuration depends on, besides the probes
+    return [sorted(machine.meta_business_unit_id_set),
+            sorted(machine.tag_id_set),
+            machine.platform,
+            machine.type,
+            machine.has_deb_packages]
+
+
+def get_serialized_osquery_conf(machine):
+    """
+    Return the ETag and the serialized osquery configuration of the machine.
+
+    The configurations are cached per probe sources version and machine class.
+    """
+    conf_key = json.dumps([ProbeSource.objects.version(), get_machine_conf_class(machine)])
+    cache_key = "osquery.conf.{}".format(hashlib.sha1(conf_key.encode("utf-8")).hexdigest())
+    etag_and_serialized_conf = cache.get(cache_key)
+    if etag_and_serialized_conf is None:
+        serialized_conf = json.dumps(build_osquery_conf(machine))
+        etag = hashlib.sha1(serialized_conf.encode("utf-8")).hexdigest()
+        etag_and_serialized_conf = (etag, serialized_conf)
+        cache.set(cache_key, etag_and_serialized_conf, CONF_CACHE_TIMEOUT)
+    return etag_and_serialized_conf
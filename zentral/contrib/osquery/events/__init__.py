@@ -1,6 +1,9 @@
 from datetime import datetime
 import logging
-from zentral.core.events.base import BaseEvent, register_event_type
+import time
+from django.core.cache import cache
+from zentral.conf import settings
+from zentral.core.events.base import BaseEvent, EventMetadata, register_event_type
 from zentral.core.queues import queues
 
 logger = logging.getLogger('zentral.contrib.osquery.events')
@@ -57,10 +60,35 @@ register_event_type(OsqueryResultEvent)
 class OsqueryDistributedQueryResultEvent(OsqueryEvent):
     event_type = "osquery_distributed_query_result"
 
+    def iter_result_row_events(self):
+        """
+        Yield one event per result row, if the distributed query result rows are enabled.
+
+        The row events are not posted. They are bulk indexed by the stores supporting them.
+        """
+        if not settings["apps"]["zentral.contrib.osquery"].get("distributed_query_result_rows", False):
+            return
+        for index, payload in enumerate(iter_distributed_query_result_rows([self.payload])):
+            metadata = EventMetadata(OsqueryDistributedQueryResultRowEvent.event_type,
+                                     uuid=self.metadata.uuid,
+                                     index=index,
+                                     created_at=self.metadata.created_at,
+                                     machine_serial_number=self.metadata.machine_serial_number,
+                                     request=self.metadata.request,
+                                     tags=OsqueryDistributedQueryResultRowEvent.tags)
+            yield OsqueryDistributedQueryResultRowEvent(metadata, payload)
+
 
 register_event_type(OsqueryDistributedQueryResultEvent)
 
 
+class OsqueryDistributedQueryResultRowEvent(OsqueryEvent):
+    event_type = "osquery_distributed_query_result_row"
+
+
+register_event_type(OsqueryDistributedQueryResultRowEvent)
+
+
 class OsqueryFileCarveEvent(OsqueryEvent):
     event_type = "osquery_file_carve"
 
@@ -77,6 +105,13 @@ register_event_type(OsqueryStatusEvent)
 
 # Utility functions used by the osquery enrollment / log API
 
+def iter_distributed_query_result_rows(payloads):
+    for payload in payloads:
+        for row in payload.get("result") or []:
+            yield {"probe": payload["probe"],
+                   "row": row}
+
+
 def post_distributed_query_result(msn, user_agent, ip, payloads):
     OsqueryDistributedQueryResultEvent.post_machine_request_payloads(msn, user_agent, ip, payloads)
 
@@ -90,6 +125,26 @@ def post_finished_file_carve_session(session_id):
                           {"session_id": session_id})
 
 
+INVENTORY_QUERY_SNAPSHOT_QUEUE_NAME = "osquery_inventory_query_snapshots"
+PENDING_INVENTORY_QUERY_SNAPSHOT_TIMEOUT = 86400  # seconds
+
+
+def pending_inventory_query_snapshot_cache_key(msn):
+    return "osquery.pending_inventory_query_snapshot.{}".format(msn)
+
+
+def post_inventory_query_snapshot(msn, node_key, ip, snapshot):
+    # remember the most recent snapshot, to skip the older ones still in the queue
+    posted_at = time.time()
+    cache.set(pending_inventory_query_snapshot_cache_key(msn), posted_at, PENDING_INVENTORY_QUERY_SNAPSHOT_TIMEOUT)
+    queues.post_raw_event(INVENTORY_QUERY_SNAPSHOT_QUEUE_NAME,
+                          {"machine_serial_number": msn,
+                           "node_key": node_key,
+                           "ip": ip,
+                           "posted_at": posted_at,
+                           "snapshot": snapshot})
+
+
 def get_osquery_result_created_at(payload):
     return datetime.utcfromtimestamp(float(payload['unixTime']))
 
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def delete_duplicated_distributed_query_probe_machines(apps, schema_editor):
+    DistributedQueryProbeMachine = apps.get_model("osquery", "DistributedQueryProbeMachine")
+    seen = set([])
+    for dqpm in DistributedQueryProbeMachine.objects.all().order_by("id"):
+        key = (dqpm.probe_source_id, dqpm.machine_serial_number)
+        if key in seen:
+            dqpm.delete()
+        else:
+            seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0003_carvesession_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicated_distributed_query_probe_machines),
+        migrations.AlterUniqueTogether(
+            name='distributedqueryprobemachine',
+            unique_together=set([('probe_source', 'machine_serial_number')]),
+        ),
+    ]
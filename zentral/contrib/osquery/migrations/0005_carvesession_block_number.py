@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def update_block_number(apps, schema_editor):
+    CarveSession = apps.get_model("osquery", "CarveSession")
+    for carve_session in CarveSession.objects.all():
+        carve_session.block_number = carve_session.carveblock_set.count()
+        carve_session.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0004_distributedqueryprobemachine_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='carvesession',
+            name='block_number',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(update_block_number)
+    ]
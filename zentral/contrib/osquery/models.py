@@ -1,7 +1,8 @@
 import logging
 import os.path
 from datetime import timedelta
-from django.db import models
+from django.core.files.base import ContentFile
+from django.db import connection, models
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.crypto import get_random_string
@@ -10,7 +11,7 @@ from django.utils.text import slugify
 from zentral.conf import settings
 from zentral.contrib.inventory.models import MachineSnapshotCommit, MetaMachine
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
-from zentral.core.probes.conf import ProbeList
+from zentral.core.probes.models import ProbeSource
 
 logger = logging.getLogger("zentral.contrib.osquery.models")
 
@@ -46,34 +47,64 @@ def enroll(serial_number, business_unit, host_identifier, ip):
     return ms, action
 
 
-class DistributedQueryProbeMachineManager(models.Manager):
-    def new_queries_for_machine(self, machine):
-        queries = {}
+DISTRIBUTED_QUERY_PROBE_MODELS = ['OsqueryDistributedQueryProbe', 'OsqueryFileCarveProbe']
 
-        seen_probe_id = {dqpm.probe_source_id for dqpm in self.filter(machine_serial_number=machine.serial_number)}
+# SQL version of the probe inventory filters, see InventoryFilter.test_machine.
+# no inventory filters, or one inventory filter with each attribute empty or matching the machine.
+INVENTORY_FILTER_ATTRIBUTES = ("meta_business_unit_ids", "tag_ids", "platforms", "types")
+PROBE_SOURCE_INVENTORY_FILTERS_MATCH = (
+    "coalesce(jsonb_array_length(probes_probesource.body #> '{{filters,inventory}}'), 0) = 0 "
+    "OR EXISTS (SELECT 1 FROM jsonb_array_elements(probes_probesource.body #> '{{filters,inventory}}') f "
+    "WHERE {})"
+).format(" AND ".join(
+    "(coalesce(jsonb_array_length(f->'{attr}'), 0) = 0 "
+    "OR EXISTS (SELECT 1 FROM jsonb_array_elements_text(f->'{attr}') v WHERE v = ANY(%s::text[])))".format(attr=attr)
+    for attr in INVENTORY_FILTER_ATTRIBUTES
+))
 
-        def probe_model_filter(probe):
-            return probe.get_model() in ['OsqueryDistributedQueryProbe', 'OsqueryFileCarveProbe']
 
-        def not_seen_probe_filter(probe):
-            return probe.pk not in seen_probe_id
-        min_age = timezone.now() - MAX_DISTRIBUTED_QUERY_AGE
+def get_machine_inventory_filter_values(machine):
+    # the machine values for each inventory filter attribute, as text
+    return [[str(v) for v in values]
+            for values in (machine.meta_business_unit_id_set,
+                           machine.tag_id_set,
+                           [machine.platform] if machine.platform else [],
+                           [machine.type] if machine.type else [])]
 
-        def recent_probe_filter(probe):
-            return probe.created_at > min_age
-        # TODO: slow
-        # could filter the probes that are too old in the db
-        probe_list = (ProbeList().filter(probe_model_filter)
-                                 .machine_filtered(machine)
-                                 .filter(not_seen_probe_filter)
-                                 .filter(recent_probe_filter))
-        for probe in probe_list:
-            dqpm, created = self.get_or_create(probe_source_id=probe.pk,
-                                               machine_serial_number=machine.serial_number)
-            if created:
-                queries[probe.distributed_query_name] = probe.distributed_query
 
-        return queries
+class DistributedQueryProbeMachineManager(models.Manager):
+    def new_queries_for_machine(self, machine):
+        # recent active distributed query probe sources not yet sent to the machine,
+        # and matching the machine
+        min_age = timezone.now() - MAX_DISTRIBUTED_QUERY_AGE
+        serial_number = machine.serial_number
+        probe_sources = (ProbeSource.objects.active()
+                                            .filter(model__in=DISTRIBUTED_QUERY_PROBE_MODELS,
+                                                    created_at__gt=min_age)
+                                            .exclude(distributedqueryprobemachine__machine_serial_number=serial_number)
+                                            .extra(where=[PROBE_SOURCE_INVENTORY_FILTERS_MATCH],
+                                                   params=get_machine_inventory_filter_values(machine)))
+        probes = {}
+        for probe_source in probe_sources:
+            probe = probe_source.load()
+            if probe.loaded:
+                probes[probe.pk] = probe
+        if not probes:
+            return {}
+
+        # link the probes to the machine.
+        # only the links created here are returned, in case of concurrent requests.
+        query = (
+            "insert into osquery_distributedqueryprobemachine "
+            "(probe_source_id, machine_serial_number, created_at) "
+            "select unnest(%s::integer[]), %s, %s "
+            "on conflict (probe_source_id, machine_serial_number) do nothing "
+            "returning probe_source_id"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, [list(probes), machine.serial_number, timezone.now()])
+            return {probes[probe_source_id].distributed_query_name: probes[probe_source_id].distributed_query
+                    for probe_source_id, in cursor.fetchall()}
 
 
 class DistributedQueryProbeMachine(models.Model):
@@ -87,6 +118,9 @@ class DistributedQueryProbeMachine(models.Model):
 
     objects = DistributedQueryProbeMachineManager()
 
+    class Meta:
+        unique_together = (('probe_source', 'machine_serial_number'),)
+
 
 def carve_session_dir_path(carve_session):
     return os.path.join('osquery/carves/',
@@ -107,6 +141,7 @@ class CarveSession(models.Model):
     carve_size = models.BigIntegerField()
     block_size = models.IntegerField()
     block_count = models.IntegerField()
+    block_number = models.IntegerField(default=0)  # number of blocks received
     archive = models.FileField(upload_to=carve_session_archive_path, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -121,14 +156,21 @@ class CarveSession(models.Model):
     def get_machine(self):
         return MetaMachine(self.machine_serial_number)
 
-    @cached_property
-    def block_number(self):
-        return self.carveblock_set.count()
-
     @cached_property
     def progress(self):
         return self.block_number * 100 // self.block_count
 
+    def add_block(self, block_id, data):
+        """Save a block and return the updated number of blocks received."""
+        carve_block = CarveBlock.objects.create(carve_session=self, block_id=block_id)
+        carve_block.file.save(str(block_id), ContentFile(data))
+        # atomic increment
+        with connection.cursor() as cursor:
+            cursor.execute("update osquery_carvesession set block_number = block_number + 1 "
+                           "where id = %s returning block_number", [self.pk])
+            self.block_number = cursor.fetchone()[0]
+        return self.block_number
+
 
 def carve_session_block_path(instance, filename):
     return os.path.join(carve_session_dir_path(instance.carve_session), str(instance.block_id))
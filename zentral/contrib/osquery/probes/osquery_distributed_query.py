@@ -1,6 +1,7 @@
 import logging
-from django.core.urlresolvers import reverse_lazy
+from django.core.urlresolvers import reverse, reverse_lazy
 from rest_framework import serializers
+from zentral.conf import settings
 from zentral.utils.sql import format_sql
 from .base import register_probe_class, BaseProbe, BaseProbeSerializer
 
@@ -33,6 +34,12 @@ class OsqueryDistributedQueryProbe(BaseProbe):
             logger.warning("OsqueryDistributedQueryResultEvent w/o probe.id")
             return False
 
+    def get_extra_links(self):
+        if settings["apps"]["zentral.contrib.osquery"].get("distributed_query_result_rows", False):
+            return [("Result rows", "list",
+                     reverse("osquery:distributed_query_probe_result_rows", args=(self.pk,)))]
+        return []
+
     def get_extra_event_search_dict(self):
         # match probe pk
         return {'event_type': self.forced_event_type,
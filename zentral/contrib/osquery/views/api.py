@@ -1,26 +1,30 @@
 from base64 import b64decode
+import json
 import logging
+import tempfile
 from django.core.exceptions import SuspiciousOperation
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
 from django.db.models import Q
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.utils.crypto import get_random_string
+from django.utils.functional import cached_property
 from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine
-from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.core.events.base import post_machine_conflict_event
 from zentral.core.probes.models import ProbeSource
 from zentral.utils.api_views import JSONPostAPIView, verify_secret, APIAuthError
+from zentral.utils.json import iter_json_object_items
 from zentral.contrib.inventory.conf import MACOS, platform_with_os_name
-from zentral.contrib.osquery.conf import (build_osquery_conf,
-                                          get_distributed_inventory_queries,
+from zentral.contrib.osquery.conf import (get_distributed_inventory_queries,
+                                          get_serialized_osquery_conf,
                                           INVENTORY_QUERY_NAME,
                                           INVENTORY_DISTRIBUTED_QUERY_PREFIX)
 from zentral.contrib.osquery.events import (post_distributed_query_result, post_enrollment_event,
                                             post_file_carve_events, post_finished_file_carve_session,
-                                            post_events_from_osquery_log, post_request_event)
+                                            post_events_from_osquery_log, post_inventory_query_snapshot,
+                                            post_request_event)
 from zentral.contrib.osquery.models import (enroll,
                                             DistributedQueryProbeMachine,
-                                            CarveBlock, CarveSession)
+                                            CarveSession)
 
 logger = logging.getLogger('zentral.contrib.osquery.views.api')
 
@@ -55,8 +59,11 @@ class BaseNodeView(JSONPostAPIView):
     def check_data_secret(self, data):
         auth_err = None
         try:
-            self.ms = MachineSnapshot.objects.current().get(source__module='zentral.contrib.osquery',
-                                                            reference=data['node_key'])
+            self.node_key = data['node_key']
+            (self.machine_serial_number,
+             self.business_unit_id,
+             self.machine_snapshot_id) = MachineSnapshot.objects.current_reference_info('zentral.contrib.osquery',
+                                                                                        self.node_key)
         except KeyError:
             auth_err = "Missing node_key"
         except MachineSnapshot.DoesNotExist:
@@ -67,8 +74,15 @@ class BaseNodeView(JSONPostAPIView):
             logger.error("APIAuthError %s", auth_err, extra=data)
             raise APIAuthError(auth_err)
         # TODO: Better verification ?
-        self.machine_serial_number = self.ms.serial_number
-        self.business_unit = self.ms.business_unit
+
+    @cached_property
+    def ms(self):
+        # only loaded when needed. The authentication uses the cached node key info.
+        return MachineSnapshot.objects.select_related('business_unit__meta_business_unit',
+                                                      'os_version',
+                                                      'system_info',
+                                                      'teamviewer',
+                                                      'puppet_node').get(pk=self.machine_snapshot_id)
 
     def do_post(self, data):
         post_request_event(self.machine_serial_number,
@@ -76,71 +90,9 @@ class BaseNodeView(JSONPostAPIView):
                            self.request_type)
         return self.do_node_post(data)
 
-    def commit_inventory_query_result(self, snapshot):
-        tree = self.ms.serialize()
-        tree["serial_number"] = self.machine_serial_number
-        tree["public_ip_address"] = self.ip
-        if self.business_unit:
-            tree['business_unit'] = self.business_unit.serialize()
-
-        def clean_dict(d):
-            for k, v in list(d.items()):
-                if v is None or v == "":
-                    del d[k]
-            return d
-
-        deb_packages = []
-        network_interfaces = []
-        osx_app_instances = []
-        for t in snapshot:
-            table_name = t.pop('table_name')
-            if table_name == 'os_version':
-                os_version = clean_dict(t)
-                if os_version:
-                    tree['os_version'] = os_version
-            elif table_name == 'system_info':
-                system_info = clean_dict(t)
-                if system_info:
-                    tree['system_info'] = system_info
-            elif table_name == 'uptime':
-                try:
-                    system_uptime = int(t['total_seconds'])
-                except (KeyError, TypeError, ValueError):
-                    pass
-                else:
-                    if system_uptime > 0:
-                        tree['system_uptime'] = system_uptime
-            elif table_name == 'network_interface':
-                network_interface = clean_dict(t)
-                if network_interface:
-                    if network_interface not in network_interfaces:
-                        network_interfaces.append(network_interface)
-                    else:
-                        logger.warning("Duplicated network interface")
-            elif table_name == 'deb_packages':
-                deb_package = clean_dict(t)
-                if deb_package:
-                    if deb_package not in deb_packages:
-                        deb_packages.append(deb_package)
-                    else:
-                        logger.warning("Duplicated deb package")
-            elif table_name == 'apps':
-                bundle_path = t.pop('bundle_path')
-                osx_app = clean_dict(t)
-                if osx_app and bundle_path:
-                    osx_app_instance = {'app': osx_app,
-                                        'bundle_path': bundle_path}
-                    if osx_app_instance not in osx_app_instances:
-                        osx_app_instances.append(osx_app_instance)
-                    else:
-                        logger.warning("Duplicated osx app instance")
-        if deb_packages:
-            tree["deb_packages"] = deb_packages
-        if network_interfaces:
-            tree["network_interfaces"] = network_interfaces
-        if osx_app_instances:
-            tree["osx_app_instances"] = osx_app_instances
-        commit_machine_snapshot_and_trigger_events(tree)
+    def post_inventory_query_result(self, snapshot):
+        # committed asynchronously by the InventoryQuerySnapshotPreprocessor
+        post_inventory_query_snapshot(self.machine_serial_number, self.node_key, self.ip, snapshot)
 
 
 class ConfigView(BaseNodeView):
@@ -150,7 +102,10 @@ class ConfigView(BaseNodeView):
         # TODO: The machine serial number is included in the string used to authenticate the requests
         # This is done in the osx pkg builder. The machine serial number should always be present here.
         # Maybe we could code a fallback to the available mbu probes if the serial number is not present.
-        return build_osquery_conf(MetaMachine(self.machine_serial_number))
+        etag, serialized_conf = get_serialized_osquery_conf(MetaMachine(self.machine_serial_number))
+        response = HttpResponse(serialized_conf, content_type="application/json")
+        response["ETag"] = '"{}"'.format(etag)
+        return response
 
 
 class CarverStartView(BaseNodeView):
@@ -204,12 +159,8 @@ class CarverContinueView(BaseNodeView):
         data_data = data.pop("data")
 
         block_id = data["block_id"]
-        cb = CarveBlock.objects.create(carve_session=self.carve_session,
-                                       block_id=int(block_id))
-        cb.file.save(block_id, SimpleUploadedFile(block_id, b64decode(data_data)))
-
-        session_finished = (CarveBlock.objects.filter(carve_session=self.carve_session).count()
-                            == self.carve_session.block_count)
+        block_number = self.carve_session.add_block(int(block_id), b64decode(data_data))
+        session_finished = block_number == self.carve_session.block_count
         probe_source = self.carve_session.probe_source
         post_file_carve_events(self.machine_serial_number, self.user_agent, self.ip,
                                [{"probe": {"id": probe_source.pk,
@@ -296,59 +247,132 @@ class DistributedWriteView(BaseNodeView):
                         dq_payloads.append(payload)
                     else:
                         fc_payloads.append(payload)
-            if dq_payloads:
-                post_distributed_query_result(self.machine_serial_number,
-                                              self.user_agent, self.ip,
-                                              dq_payloads)
-            if fc_payloads:
-                post_file_carve_events(self.machine_serial_number,
-                                       self.user_agent, self.ip,
-                                       fc_payloads)
+        if dq_payloads:
+            post_distributed_query_result(self.machine_serial_number,
+                                          self.user_agent, self.ip,
+                                          dq_payloads)
+        if fc_payloads:
+            post_file_carve_events(self.machine_serial_number,
+                                   self.user_agent, self.ip,
+                                   fc_payloads)
         if inventory_snapshot:
-            self.commit_inventory_query_result(inventory_snapshot)
+            self.post_inventory_query_result(inventory_snapshot)
         return {}
 
 
 class LogView(BaseNodeView):
     request_type = "log"
-
-    def check_data_secret(self, data):
-        super().check_data_secret(data)
-        self.data_data = data.pop("data")
-        for r in self.data_data:
-            decorations = r.pop("decorations", None)
-            if decorations:
-                platform = platform_with_os_name(decorations.get("os_name"))
-                if platform == MACOS:
-                    hardware_serial = decorations.get("hardware_serial")
-                    if hardware_serial and hardware_serial != self.machine_serial_number:
-                        # The SN reported by osquery is not the one configured in the enrollment secret.
-                        # For other platforms than MACOS, it could happen. For example, we take the GCE instance ID as
-                        # serial number in the enrollment secret for linux, if possible.
-                        # Osquery builds one from the SMBIOS/DMI.
-                        auth_err = "osquery reported SN {} different from enrollment SN {}".format(
-                            hardware_serial,
-                            self.machine_serial_number
-                        )
-                        post_machine_conflict_event(self.request, "zentral.contrib.osquery",
-                                                    hardware_serial, self.machine_serial_number,
-                                                    decorations)
-                        raise APIAuthError(auth_err)
+    batch_size = 1000  # records
+    spool_max_memory_size = 2**20  # bytes. Above, the records are spooled to disk.
+    max_unauthenticated_size = 2**24  # bytes of records received before the node key
+
+    def verify_decorations(self, decorations):
+        key = (decorations.get("os_name"), decorations.get("hardware_serial"))
+        if key in self.verified_decorations:
+            return
+        platform = platform_with_os_name(decorations.get("os_name"))
+        if platform == MACOS:
+            hardware_serial = decorations.get("hardware_serial")
+            if hardware_serial and hardware_serial != self.machine_serial_number:
+                # The SN reported by osquery is not the one configured in the enrollment secret.
+                # For other platforms than MACOS, it could happen. For example, we take the GCE instance ID as
+                # serial number in the enrollment secret for linux, if possible.
+                # Osquery builds one from the SMBIOS/DMI.
+                auth_err = "osquery reported SN {} different from enrollment SN {}".format(
+                    hardware_serial,
+                    self.machine_serial_number
+                )
+                post_machine_conflict_event(self.request, "zentral.contrib.osquery",
+                                            hardware_serial, self.machine_serial_number,
+                                            decorations)
+                raise APIAuthError(auth_err)
+        self.verified_decorations.add(key)
+
+    def post_records(self, data, records):
+        post_events_from_osquery_log(self.machine_serial_number,
+                                     self.user_agent, self.ip,
+                                     dict(data, data=records))
 
     @transaction.non_atomic_requests
+    def post(self, request, *args, **kwargs):
+        # The log records are parsed and verified first, and spooled to a temporary file.
+        # Nothing is posted before the whole request is verified, because osquery retries the whole payload.
+        # The spooled records are posted in batches, to keep the memory usage constant.
+        payload_fileobj = self.get_payload_fileobj(request)
+        if payload_fileobj is None:
+            return HttpResponse("Unsupported Media Type", status=415)
+        self.verified_decorations = set([])
+        inventory_result = None
+        data = {}
+        authenticated = False
+        # the osquery TLS logger sends the node key after the records
+        pending_decorations = {}
+        unauthenticated_size = 0
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_max_memory_size) as spool:
+            try:
+                for key, value in iter_json_object_items(payload_fileobj, array_keys=("data",),
+                                                         encoding=self.payload_encoding):
+                    if key != "data":
+                        data[key] = value
+                        if not authenticated and "node_key" in data and "log_type" in data:
+                            self.check_data_secret(data)
+                            authenticated = True
+                            for decorations in pending_decorations.values():
+                                self.verify_decorations(decorations)
+                            pending_decorations = {}
+                        continue
+                    record = value
+                    record_size = 0
+                    decorations = record.pop("decorations", None)
+                    if decorations:
+                        if authenticated:
+                            self.verify_decorations(decorations)
+                        else:
+                            decorations_key = (decorations.get("os_name"), decorations.get("hardware_serial"))
+                            if decorations_key not in pending_decorations:
+                                pending_decorations[decorations_key] = decorations
+                                record_size += len(json.dumps(decorations))
+                    if record.get('name', None) == INVENTORY_QUERY_NAME:
+                        # only the last snapshot is kept
+                        if inventory_result is None or record['unixTime'] >= inventory_result[0]:
+                            inventory_result = (record['unixTime'], record['snapshot'])
+                    else:
+                        line = json.dumps(record).encode("utf-8") + b"\n"
+                        spool.write(line)
+                        record_size += len(line)
+                    if not authenticated:
+                        unauthenticated_size += record_size
+                        if unauthenticated_size > self.max_unauthenticated_size:
+                            logger.error("Too many log records before the node key", extra={'request': request})
+                            return HttpResponse("Request Entity Too Large", status=413)
+                if not authenticated:
+                    self.check_data_secret(data)
+                    for decorations in pending_decorations.values():
+                        self.verify_decorations(decorations)
+            except UnicodeDecodeError:
+                err_msg_tmpl = 'Could not decode payload with encoding %s'
+                logger.error(err_msg_tmpl, self.payload_encoding, extra={'request': request})
+                raise SuspiciousOperation(err_msg_tmpl % self.payload_encoding)
+            except json.JSONDecodeError:
+                raise SuspiciousOperation("Payload is not valid json")
+            except APIAuthError as auth_err:
+                logger.error("APIAuthError %s", auth_err, extra={'request': request})
+                return HttpResponseForbidden(str(auth_err))
+            # everything is verified
+            self.do_post(data)
+            spool.seek(0)
+            records = []
+            for line in spool:
+                records.append(json.loads(line.decode("utf-8")))
+                if len(records) >= self.batch_size:
+                    self.post_records(data, records)
+                    records = []
+            if records:
+                self.post_records(data, records)
+        if inventory_result:
+            self.post_inventory_query_result(inventory_result[1])
+        return JsonResponse({})
+
     def do_node_post(self, data):
-        inventory_results = []
-        other_results = []
-        for r in self.data_data:
-            if r.get('name', None) == INVENTORY_QUERY_NAME:
-                inventory_results.append((r['unixTime'], r['snapshot']))
-            else:
-                other_results.append(r)
-        if inventory_results:
-            inventory_results.sort(reverse=True)
-            last_snapshot = inventory_results[0][1]
-            self.commit_inventory_query_result(last_snapshot)
-        data['data'] = other_results
-        post_events_from_osquery_log(self.machine_serial_number,
-                                     self.user_agent, self.ip, data)
+        # the records are processed in post
         return {}
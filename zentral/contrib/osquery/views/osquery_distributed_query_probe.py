@@ -2,8 +2,10 @@ import logging
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
+from django.views.generic import ListView
 from django.views.generic.edit import FormView
 from zentral.core.probes.models import ProbeSource
+from zentral.core.stores import frontend_store
 from zentral.contrib.osquery.forms import CreateDistributedQueryProbeForm, DistributedQueryForm
 
 logger = logging.getLogger('zentral.contrib.osquery.views.osquery_distributed_query_probe')
@@ -54,3 +56,69 @@ class UpdateDistributedQueryProbeQueryView(LoginRequiredMixin, FormView):
 
     def get_success_url(self):
         return self.probe_source.get_absolute_url("osquery")
+
+
+class DistributedQueryResultRowSet(object):
+    def __init__(self, probe):
+        self.probe = probe
+        self.store = frontend_store
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.store.distributed_query_result_rows_count(self.probe)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start = int(k.start or 0)
+            stop = int(k.stop or start + 1)
+        else:
+            start = k
+            stop = k + 1
+        return list(self.store.distributed_query_result_rows_fetch(self.probe, start, stop - start))
+
+
+class DistributedQueryProbeResultRowsView(LoginRequiredMixin, ListView):
+    template_name = "osquery/distributed_query_probe_result_rows.html"
+    paginate_by = 25
+
+    def dispatch(self, request, *args, **kwargs):
+        self.probe_source = get_object_or_404(ProbeSource, pk=kwargs["probe_id"],
+                                              model="OsqueryDistributedQueryProbe")
+        self.probe = self.probe_source.load()
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return DistributedQueryResultRowSet(self.probe)
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        ctx["probes"] = True
+        ctx["probe_source"] = self.probe_source
+        ctx["probe"] = self.probe
+        # rows
+        events = ctx["object_list"]
+        columns = sorted({column for event in events for column in event.payload.get("row", {})})
+        ctx["columns"] = columns
+        ctx["rows"] = [(event, [event.payload.get("row", {}).get(column) for column in columns])
+                       for event in events]
+        # column values aggregation
+        column = self.request.GET.get("column")
+        if column:
+            ctx["column"] = column
+            ctx["column_values"] = frontend_store.distributed_query_result_rows_terms(self.probe, column, 20)
+        # pagination
+        page = ctx["page_obj"]
+        if page.has_next():
+            qd = self.request.GET.copy()
+            qd["page"] = page.next_page_number()
+            ctx["next_url"] = "?{}".format(qd.urlencode())
+        if page.has_previous():
+            qd = self.request.GET.copy()
+            qd["page"] = page.previous_page_number()
+            ctx["previous_url"] = "?{}".format(qd.urlencode())
+        return ctx
@@ -1,15 +1,47 @@
+import io
 import logging
-import os
-import tempfile
+from django.core.cache import cache
 from django.core.files import File
+from zentral.contrib.inventory.models import MachineSnapshot
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.core.events import event_cls_from_type
 from zentral.core.queues import queues
+from .events import INVENTORY_QUERY_SNAPSHOT_QUEUE_NAME, pending_inventory_query_snapshot_cache_key
 from .models import CarveSession
 
 
 logger = logging.getLogger("zentral.contrib.osquery.workers")
 
 
+class CarveBlocksReader(io.RawIOBase):
+    """Read the files of the carve blocks one after the other."""
+    def __init__(self, carve_blocks):
+        self.carve_blocks = carve_blocks
+        self.current_file = None
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self.current_file is None:
+                try:
+                    carve_block = next(self.carve_blocks)
+                except StopIteration:
+                    return 0
+                self.current_file = carve_block.file
+                self.current_file.open("rb")
+            data = self.current_file.read(len(b))
+            if data:
+                read_size = len(data)
+                b[:read_size] = data
+                self.bytes_read += read_size
+                return read_size
+            self.current_file.close()
+            self.current_file = None
+
+
 class FinishedFileCarveSessionPreprocessor(object):
     name = "osquery finished file carve session preprocessor"
     input_queue_name = "osquery_finished_file_carve_session"
@@ -22,17 +54,13 @@ class FinishedFileCarveSessionPreprocessor(object):
             logger.error("Archive already exists for session %s", session_id)
             return
 
-        archive_size = 0
-        tmp_fh, tmp_path = tempfile.mkstemp(suffix=self.__module__)
-        logger.info("Start building archive %s %s", session_id, tmp_path)
-        with os.fdopen(tmp_fh, "wb") as f:
-            for carve_block in carve_session.carveblock_set.all().order_by("block_id"):
-                for chunk in carve_block.file.chunks():
-                    f.write(chunk)
-                    archive_size += len(chunk)
-        with open(tmp_path, "rb") as f:
-            carve_session.archive.save("archive.tar", File(f))
-        os.unlink(tmp_path)
+        # stream the blocks into the archive storage
+        carve_blocks = CarveBlocksReader(carve_session.carveblock_set.all().order_by("block_id").iterator())
+        archive_file = File(carve_blocks)
+        archive_file.size = carve_session.carve_size
+        logger.info("Start building archive %s", session_id)
+        carve_session.archive.save("archive.tar", archive_file)
+        archive_size = carve_blocks.bytes_read
 
         # yield osquery file carve event
         event_cls = event_cls_from_type("osquery_file_carve")
@@ -49,5 +77,94 @@ class FinishedFileCarveSessionPreprocessor(object):
             yield event
 
 
+class InventoryQuerySnapshotPreprocessor(object):
+    name = "osquery inventory query snapshot preprocessor"
+    input_queue_name = INVENTORY_QUERY_SNAPSHOT_QUEUE_NAME
+
+    def commit_inventory_query_result(self, ms, ip, snapshot):
+        tree = ms.serialize()
+        tree["serial_number"] = ms.serial_number
+        if ip:
+            tree["public_ip_address"] = ip
+        if ms.business_unit:
+            tree['business_unit'] = ms.business_unit.serialize()
+
+        def clean_dict(d):
+            for k, v in list(d.items()):
+                if v is None or v == "":
+                    del d[k]
+            return d
+
+        deb_packages = []
+        network_interfaces = []
+        osx_app_instances = []
+        for t in snapshot:
+            table_name = t.pop('table_name')
+            if table_name == 'os_version':
+                os_version = clean_dict(t)
+                if os_version:
+                    tree['os_version'] = os_version
+            elif table_name == 'system_info':
+                system_info = clean_dict(t)
+                if system_info:
+                    tree['system_info'] = system_info
+            elif table_name == 'uptime':
+                try:
+                    system_uptime = int(t['total_seconds'])
+                except (KeyError, TypeError, ValueError):
+                    pass
+                else:
+                    if system_uptime > 0:
+                        tree['system_uptime'] = system_uptime
+            elif table_name == 'network_interface':
+                network_interface = clean_dict(t)
+                if network_interface:
+                    if network_interface not in network_interfaces:
+                        network_interfaces.append(network_interface)
+                    else:
+                        logger.warning("Duplicated network interface")
+            elif table_name == 'deb_packages':
+                deb_package = clean_dict(t)
+                if deb_package:
+                    if deb_package not in deb_packages:
+                        deb_packages.append(deb_package)
+                    else:
+                        logger.warning("Duplicated deb package")
+            elif table_name == 'apps':
+                bundle_path = t.pop('bundle_path')
+                osx_app = clean_dict(t)
+                if osx_app and bundle_path:
+                    osx_app_instance = {'app': osx_app,
+                                        'bundle_path': bundle_path}
+                    if osx_app_instance not in osx_app_instances:
+                        osx_app_instances.append(osx_app_instance)
+                    else:
+                        logger.warning("Duplicated osx app instance")
+        if deb_packages:
+            tree["deb_packages"] = deb_packages
+        if network_interfaces:
+            tree["network_interfaces"] = network_interfaces
+        if osx_app_instances:
+            tree["osx_app_instances"] = osx_app_instances
+        commit_machine_snapshot_and_trigger_events(tree)
+
+    def process_raw_event(self, raw_event):
+        serial_number = raw_event["machine_serial_number"]
+        pending_posted_at = cache.get(pending_inventory_query_snapshot_cache_key(serial_number))
+        if pending_posted_at is not None and pending_posted_at > raw_event["posted_at"]:
+            logger.info("Skip inventory query snapshot of machine %s. More recent one pending.", serial_number)
+            return []
+        try:
+            ms = MachineSnapshot.objects.current().get(source__module="zentral.contrib.osquery",
+                                                       reference=raw_event["node_key"])
+        except MachineSnapshot.DoesNotExist:
+            logger.error("No current osquery machine snapshot for machine %s", serial_number)
+            return []
+        self.commit_inventory_query_result(ms, raw_event.get("ip"), raw_event["snapshot"])
+        # the inventory events are posted during the commit
+        return []
+
+
 def get_workers():
     yield queues.get_preprocessor_worker(FinishedFileCarveSessionPreprocessor())
+    yield queues.get_preprocessor_worker(InventoryQuerySnapshotPreprocessor())
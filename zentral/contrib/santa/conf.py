@@ -1,4 +1,13 @@
+from collections import Counter, OrderedDict
+import hashlib
+import json
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
 from zentral.core.probes.conf import ProbeList
+from zentral.core.probes.models import ProbeSource
+from .models import MachineRuleSet, RuleSet
+from .probes import Rule
 
 
 def build_santa_conf(machine):
@@ -15,3 +24,128 @@ def build_santa_conf(machine):
         # TODO test duplicated rules
         rules.extend(r.to_configuration() for r in probe.rules)
     return {'rules': rules}
+
+
+RULE_SET_CACHE_TIMEOUT = 7 * 86400  # seconds
+
+
+def get_machine_rule_set_class(machine):
+    # everything the rule set depends on, besides the probes
+    return [sorted(machine.meta_business_unit_id_set),
+            sorted(machine.tag_id_set),
+            machine.platform,
+            machine.type]
+
+
+def get_santa_rule_set(machine):
+    """
+    Return the version and the rules of the rule set of the machine.
+
+    The rule sets are compiled once per probe sources version and machine class.
+    """
+    class_key = json.dumps([ProbeSource.objects.version(), get_machine_rule_set_class(machine)])
+    class_cache_key = "santa.rule_set_class.{}".format(hashlib.sha1(class_key.encode("utf-8")).hexdigest())
+    version_and_rules = cache.get(class_cache_key)
+    if version_and_rules is None:
+        rules = build_santa_conf(machine)["rules"]
+        version = hashlib.sha1(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+        version_and_rules = (version, rules)
+        cache.set(class_cache_key, version_and_rules, RULE_SET_CACHE_TIMEOUT)
+    return version_and_rules
+
+
+def get_rule_targets(rules):
+    # (rule type, sha256) → rules, since santa keeps only one rule per target
+    targets = OrderedDict()
+    for rule in rules:
+        targets.setdefault((rule["rule_type"], rule["sha256"]), []).append(rule)
+    return targets
+
+
+def diff_santa_rules(old_rules, new_rules):
+    """
+    Return the rules to send to a santa client to go from old_rules to new_rules.
+
+    The rules of the new or modified targets are sent, and a REMOVE rule for each removed target.
+    """
+    old_targets = get_rule_targets(old_rules)
+    new_targets = get_rule_targets(new_rules)
+    rules = []
+    for target, target_rules in new_targets.items():
+        if old_targets.get(target) != target_rules:
+            rules.extend(target_rules)
+    for rule_type, sha256 in old_targets:
+        if (rule_type, sha256) not in new_targets:
+            rules.append({"policy": Rule.REMOVE,
+                          "rule_type": rule_type,
+                          "sha256": sha256})
+    return rules
+
+
+def build_santa_rule_download(machine):
+    """
+    Build the rule download response of a santa client.
+
+    Only the differences with the last rule set acknowledged by the machine are sent.
+    All the rules are sent otherwise. The rule sets of the machines are stored in the DB,
+    because they must be consistent across all the web workers.
+    """
+    version, rules = get_santa_rule_set(machine)
+    if not machine.serial_number:
+        return {'rules': rules}
+    rule_set, _ = RuleSet.objects.get_or_create(version=version, defaults={"rules": rules})
+    machine_rule_set, _ = (MachineRuleSet.objects.select_related("acknowledged_rule_set")
+                                                 .get_or_create(serial_number=machine.serial_number))
+    acknowledged_rule_set = machine_rule_set.acknowledged_rule_set
+    if acknowledged_rule_set == rule_set:
+        rules = []
+    elif acknowledged_rule_set:
+        rules = diff_santa_rules(acknowledged_rule_set.rules, rules)
+    machine_rule_set.pending_rule_set = rule_set
+    machine_rule_set.save(update_fields=["pending_rule_set", "updated_at"])
+    return {'rules': rules}
+
+
+def acknowledge_santa_rule_set(serial_number):
+    """
+    Record the last downloaded rule set as the current rule set of the machine.
+
+    Called at the end of a successful santa sync.
+    """
+    if not serial_number:
+        return
+    (MachineRuleSet.objects.filter(serial_number=serial_number, pending_rule_set__isnull=False)
+                           .update(acknowledged_rule_set=F("pending_rule_set"),
+                                   pending_rule_set=None,
+                                   updated_at=timezone.now()))
+
+
+def reset_santa_rule_set(serial_number, preflight_data, enrollment=False):
+    """
+    Forget the rule set acknowledged by the machine if the client rules are not in sync.
+
+    Called during the santa preflight. The client database could have been wiped (re-install, re-enrollment,
+    clean sync). The next rule download will contain all the rules. Returns True if the rule set was reset.
+    """
+    if not serial_number:
+        return False
+    reset = enrollment or bool(preflight_data.get("request_clean_sync"))
+    if not reset:
+        machine_rule_set = (MachineRuleSet.objects.select_related("acknowledged_rule_set")
+                                                  .filter(serial_number=serial_number).first())
+        acknowledged_rule_set = machine_rule_set and machine_rule_set.acknowledged_rule_set
+        if acknowledged_rule_set:
+            # santa keeps only one rule per target
+            rule_counts = Counter(rule_type for rule_type, _ in get_rule_targets(acknowledged_rule_set.rules))
+            for count_key, rule_type in (("binary_rule_count", Rule.BINARY),
+                                         ("certificate_rule_count", Rule.CERTIFICATE)):
+                try:
+                    reported_count = int(preflight_data[count_key])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if reported_count != rule_counts[rule_type]:
+                    reset = True
+                    break
+    if reset:
+        MachineRuleSet.objects.filter(serial_number=serial_number).delete()
+    return reset
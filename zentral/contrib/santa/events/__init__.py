@@ -1,7 +1,9 @@
 from datetime import datetime
 import logging
 from zentral.core.events.base import BaseEvent, register_event_type
+from zentral.core.queues import queues
 from zentral.contrib.santa.models import CollectedApplication
+from zentral.utils.mt_models import prepare_commit_tree
 
 logger = logging.getLogger('zentral.contrib.santa.events')
 
@@ -106,21 +108,53 @@ def get_created_at(payload):
     return datetime.utcfromtimestamp(payload['execution_time'])
 
 
-def post_santa_events(msn, user_agent, ip, data):
-    events = data.get("events", [])
+# mt_hash of the collected apps already committed by this process
+COMMITTED_APP_MT_HASHES_MAX_SIZE = 10000
+committed_app_mt_hashes = set([])
+
+
+def commit_collected_apps(events):
+    # deduplicate the app trees of the batch, and skip the ones recently committed
+    app_trees = {}
     for event_d in events:
         try:
             app_d = build_collected_app_tree_from_santa_event(event_d)
+            prepare_commit_tree(app_d)
         except:
             logger.exception("Could not build app tree from santa event")
         else:
-            try:
-                CollectedApplication.objects.commit(app_d)
-            except:
-                logger.exception("Could not commit collected appi %s", app_d)
-    SantaEventEvent.post_machine_request_payloads(msn, user_agent, ip,
-                                                  data.get('events', []),
-                                                  get_created_at)
+            mt_hash = app_d["mt_hash"]
+            if mt_hash not in committed_app_mt_hashes:
+                app_trees[mt_hash] = app_d
+    if not app_trees:
+        return
+    if len(committed_app_mt_hashes) + len(app_trees) > COMMITTED_APP_MT_HASHES_MAX_SIZE:
+        committed_app_mt_hashes.clear()
+    # one query to find the apps already in the DB
+    existing_mt_hashes = (CollectedApplication.objects.filter(mt_hash__in=list(app_trees))
+                                                      .values_list("mt_hash", flat=True))
+    for mt_hash in existing_mt_hashes:
+        del app_trees[mt_hash]
+        committed_app_mt_hashes.add(mt_hash)
+    for mt_hash, app_d in app_trees.items():
+        try:
+            CollectedApplication.objects.commit(app_d)
+        except:
+            logger.exception("Could not commit collected app %s", app_d)
+        else:
+            committed_app_mt_hashes.add(mt_hash)
+
+
+SANTA_EVENTS_QUEUE_NAME = "santa_events"
+
+
+def post_santa_events(msn, user_agent, ip, data):
+    # the apps are collected and the events posted by the santa events preprocessor
+    raw_event = {"request": {"user_agent": user_agent,
+                             "ip": ip},
+                 "machine_serial_number": msn,
+                 "events": data.get("events", [])}
+    queues.post_raw_event(SANTA_EVENTS_QUEUE_NAME, raw_event)
 
 
 def post_santa_preflight(msn, user_agent, ip, data):
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0034_trigram_indexes'),
+        ('santa', '0002_collectedapplication_bundle_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectedCertificate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('certificate', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE,
+                                                     to='inventory.Certificate')),
+            ],
+        ),
+        migrations.RunSQL(
+            "WITH RECURSIVE certificates AS ("
+            "SELECT c1.id, c1.signed_by_id "
+            "FROM inventory_certificate AS c1 "
+            "JOIN santa_collectedapplication ca ON (ca.signed_by_id = c1.id) "
+            "UNION "
+            "SELECT c2.id, c2.signed_by_id "
+            "FROM inventory_certificate AS c2 "
+            "JOIN certificates c ON (c.signed_by_id = c2.id)"
+            ") INSERT INTO santa_collectedcertificate (certificate_id) "
+            "SELECT DISTINCT id FROM certificates;",
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX santa_collectedapplication_name_trgm "
+            "ON santa_collectedapplication USING gin (UPPER(name) gin_trgm_ops);",
+            "DROP INDEX santa_collectedapplication_name_trgm;"
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('santa', '0003_collectedcertificate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RuleSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.CharField(max_length=40, unique=True)),
+                ('rules', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MachineRuleSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.TextField(unique=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('acknowledged_rule_set', models.ForeignKey(blank=True, null=True,
+                                                            on_delete=django.db.models.deletion.SET_NULL,
+                                                            related_name='+', to='santa.RuleSet')),
+                ('pending_rule_set', models.ForeignKey(blank=True, null=True,
+                                                       on_delete=django.db.models.deletion.SET_NULL,
+                                                       related_name='+', to='santa.RuleSet')),
+            ],
+        ),
+    ]
@@ -1,5 +1,7 @@
 import logging
+from django.contrib.postgres.fields import JSONField
 from django.db import connection, models
+from django.db.models import Q
 from zentral.contrib.inventory.models import Certificate, OSXApp
 from zentral.utils.mt_models import AbstractMTObject, MTObjectManager
 
@@ -7,11 +9,19 @@ logger = logging.getLogger("zentral.contrib.santa.models")
 
 
 class CollectedApplicationManager(MTObjectManager):
+    def commit(self, tree, **extra_obj_save_kwargs):
+        obj, created = super().commit(tree, **extra_obj_save_kwargs)
+        if created and obj.signed_by_id:
+            CollectedCertificate.objects.add_signing_chain(obj.signed_by_id)
+        return obj, created
+
     def search(self, **kwargs):
         qs = self.all()
         name = kwargs.get("name")
         if name:
-            qs = qs.filter(name__icontains=name)
+            # trigram indexes on the app names and the bundle names
+            qs = qs.filter(Q(name__icontains=name)
+                           | Q(bundle__in=OSXApp.objects.filter(bundle_name__icontains=name)))
             return qs.select_related("bundle").order_by("bundle__bundle_name", "name")
         else:
             return []
@@ -21,27 +31,12 @@ class CollectedApplicationManager(MTObjectManager):
         if not q:
             return []
         else:
-            query = (
-                "WITH RECURSIVE certificates AS ("
-                "SELECT c1.id, c1.signed_by_id "
-                "FROM inventory_certificate AS c1 "
-                "JOIN santa_collectedapplication ca ON (ca.signed_by_id = c1.id) "
-
-                "UNION "
-
-                "SELECT c2.id, c2.signed_by_id "
-                "FROM inventory_certificate AS c2 "
-                "JOIN certificates c ON (c.signed_by_id = c2.id)"
-                ") SELECT * FROM inventory_certificate c3 "
-                "JOIN certificates AS c ON (c.id = c3.id) "
-                "WHERE UPPER(c3.common_name) LIKE UPPER(%s) "
-                "OR UPPER(c3.organization) LIKE UPPER(%s) "
-                "OR UPPER(c3.organizational_unit) LIKE UPPER(%s) "
-                "ORDER BY c3.common_name, c3.organization, c3.organizational_unit;"
-            )
-            print(query)
-            q = "%{}%".format(connection.ops.prep_for_like_query(q))
-            return Certificate.objects.raw(query, [q, q, q])
+            # trigram indexes on the certificate names, and precomputed signing chain membership
+            return (Certificate.objects.filter(collectedcertificate__isnull=False)
+                                       .filter(Q(common_name__icontains=q)
+                                               | Q(organization__icontains=q)
+                                               | Q(organizational_unit__icontains=q))
+                                       .order_by("common_name", "organization", "organizational_unit"))
 
 
 class CollectedApplication(AbstractMTObject):
@@ -53,3 +48,48 @@ class CollectedApplication(AbstractMTObject):
     signed_by = models.ForeignKey(Certificate, blank=True, null=True, on_delete=models.PROTECT)
 
     objects = CollectedApplicationManager()
+
+
+class CollectedCertificateManager(models.Manager):
+    def add_signing_chain(self, certificate_id):
+        query = (
+            "WITH RECURSIVE certificates AS ("
+            "SELECT c1.id, c1.signed_by_id "
+            "FROM inventory_certificate AS c1 "
+            "WHERE c1.id = %s "
+
+            "UNION "
+
+            "SELECT c2.id, c2.signed_by_id "
+            "FROM inventory_certificate AS c2 "
+            "JOIN certificates c ON (c.signed_by_id = c2.id)"
+            ") INSERT INTO santa_collectedcertificate (certificate_id) "
+            "SELECT id FROM certificates "
+            "ON CONFLICT (certificate_id) DO NOTHING"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, [certificate_id])
+
+
+class CollectedCertificate(models.Model):
+    """Certificate found in the signing chain of a collected application."""
+    certificate = models.OneToOneField(Certificate, on_delete=models.CASCADE)
+
+    objects = CollectedCertificateManager()
+
+
+class RuleSet(models.Model):
+    """Compiled santa rule set, the base of the incremental rule downloads."""
+    version = models.CharField(max_length=40, unique=True)
+    rules = JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class MachineRuleSet(models.Model):
+    """Last rule sets downloaded and acknowledged by a santa client."""
+    serial_number = models.TextField(unique=True)
+    acknowledged_rule_set = models.ForeignKey(RuleSet, blank=True, null=True, on_delete=models.SET_NULL,
+                                              related_name="+")
+    pending_rule_set = models.ForeignKey(RuleSet, blank=True, null=True, on_delete=models.SET_NULL,
+                                         related_name="+")
+    updated_at = models.DateTimeField(auto_now=True)
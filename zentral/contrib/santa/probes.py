@@ -64,11 +64,12 @@ class Rule(object):
         return dict(self.RULE_TYPE_CHOICES)[self.rule_type]
 
     def to_configuration(self):
-        s = RuleSerializer(instance=self)
-        d = s.data
-        for key, val in list(d.items()):
-            if val is None:
-                del d[key]
+        # already validated, no need for the RuleSerializer
+        d = {"policy": self.policy,
+             "rule_type": self.rule_type,
+             "sha256": self.sha256}
+        if self.custom_msg is not None:
+            d["custom_msg"] = self.custom_msg
         return d
 
     @cached_property
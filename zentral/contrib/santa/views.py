@@ -13,7 +13,7 @@ from zentral.core.events.base import post_machine_conflict_event
 from zentral.core.probes.models import ProbeSource
 from zentral.utils.api_views import (make_secret, APIAuthError,
                                      SignedRequestJSONPostAPIView, BaseEnrollmentView, BaseInstallerPackageView)
-from .conf import build_santa_conf
+from .conf import acknowledge_santa_rule_set, build_santa_rule_download, reset_santa_rule_set
 from .events import post_santa_events, post_santa_preflight
 from .forms import CertificateSearchForm, CollectedApplicationSearchForm, CreateProbeForm, RuleForm
 from .models import CollectedApplication
@@ -290,6 +290,14 @@ class PreflightView(BaseView):
                 }
         if self.business_unit:
             tree['business_unit'] = self.business_unit.serialize()
+        # new enrollment if the machine is unknown
+        try:
+            MachineSnapshot.objects.current_reference_info('zentral.contrib.santa', self.machine_serial_number)
+        except MachineSnapshot.DoesNotExist:
+            enrollment = True
+        else:
+            enrollment = False
+        reset_santa_rule_set(self.machine_serial_number, data, enrollment)
         commit_machine_snapshot_and_trigger_events(tree)
         return {'BatchSize': 20,  # TODO: ???
                 'UploadLogsUrl': 'https://{host}{path}'.format(host=self.request.get_host(),
@@ -299,19 +307,17 @@ class PreflightView(BaseView):
 
 class RuleDownloadView(BaseView):
     def do_post(self, data):
-        return build_santa_conf(MetaMachine(self.machine_serial_number))
+        return build_santa_rule_download(MetaMachine(self.machine_serial_number))
 
 
 class EventUploadView(BaseView):
     def do_post(self, data):
         try:
-            ms = MachineSnapshot.objects.current().get(source__module='zentral.contrib.santa',
-                                                       reference=self.machine_serial_number)
+            machine_serial_number, _, _ = MachineSnapshot.objects.current_reference_info('zentral.contrib.santa',
+                                                                                         self.machine_serial_number)
         except MachineSnapshot.DoesNotExist:
             machine_serial_number = "UNKNOWN"
             logger.error("Machine ID not found", extra={'request': self.request})
-        else:
-            machine_serial_number = ms.serial_number
         post_santa_events(machine_serial_number,
                           self.user_agent,
                           self.ip,
@@ -325,4 +331,5 @@ class LogUploadView(BaseView):
 
 class PostflightView(BaseView):
     def do_post(self, data):
+        acknowledge_santa_rule_set(self.machine_serial_number)
         return {}
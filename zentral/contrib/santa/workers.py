@@ -0,0 +1,26 @@
+import logging
+from zentral.core.queues import queues
+from .events import SANTA_EVENTS_QUEUE_NAME, SantaEventEvent, commit_collected_apps, get_created_at
+
+
+logger = logging.getLogger("zentral.contrib.santa.workers")
+
+
+class SantaEventsPreprocessor(object):
+    name = "santa events preprocessor"
+    input_queue_name = SANTA_EVENTS_QUEUE_NAME
+
+    def process_raw_event(self, raw_event):
+        events = raw_event["events"]
+        commit_collected_apps(events)
+        yield from SantaEventEvent.build_from_machine_request_payloads(
+            raw_event["machine_serial_number"],
+            raw_event["request"]["user_agent"],
+            raw_event["request"]["ip"],
+            events,
+            get_created_at
+        )
+
+
+def get_workers():
+    yield queues.get_preprocessor_worker(SantaEventsPreprocessor())
@@ -206,8 +206,7 @@ class BaseEvent(object):
 
     @classmethod
     def post_machine_request_payloads(cls, msn, user_agent, ip, payloads, get_created_at=None):
-        for event in cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at):
-            event.post()
+        queues.post_events(cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at))
 
     def __init__(self, metadata, payload):
         self.metadata = metadata
@@ -2,7 +2,7 @@ import logging
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.urlresolvers import reverse
 from django.db import models, transaction
-from django.db.models import F, Func
+from django.db.models import Count, F, Func, Max
 from django.utils.text import slugify
 from zentral.core.events import event_types
 from zentral.utils.dict import dict_diff
@@ -62,6 +62,16 @@ class ProbeSourceManager(models.Manager):
     def active(self):
         return self.filter(status=ProbeSource.ACTIVE)
 
+    def version(self):
+        """
+        Fingerprint of the probe sources, changes each time one of them is created, updated or deleted.
+        """
+        agg = self.aggregate(Count("id"), Max("id"), Max("updated_at"))
+        updated_at_max = agg["updated_at__max"]
+        return "{}.{}.{}".format(agg["id__count"],
+                                 agg["id__max"] or 0,
+                                 updated_at_max.timestamp() if updated_at_max else 0)
+
     def current_models(self):
         qs = ProbeSource.objects.values("model").distinct().order_by()
         return sorted(((rd["model"], probe_classes[rd["model"]].model_display)
@@ -208,8 +208,12 @@ class EventQueues(object):
                              declare=[exchange])
 
     def post_event(self, event):
+        self.post_events([event])
+
+    def post_events(self, events):
         with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(event.serialize(machine_metadata=False),
-                             serializer='json',
-                             exchange=events_exchange,
-                             declare=[events_exchange])
+            for event in events:
+                producer.publish(event.serialize(machine_metadata=False),
+                                 serializer='json',
+                                 exchange=events_exchange,
+                                 declare=[events_exchange])
@@ -22,6 +22,39 @@ class BaseEventStore(object):
     def machine_events_types_with_usage(self, machine_serial_number):
         return {}
 
+    def fetch_machine_events_page(self, machine_serial_number, event_type=None, limit=10, cursor=None):
+        """
+        Return a page of machine events.
+
+        The page is a dict with the events, the total number of events, the number of events
+        for each event type (ignoring event_type), and the cursors of the newer and older pages.
+        The cursors are opaque strings.
+        """
+        try:
+            offset = max(0, int(cursor or 0))
+        except ValueError:
+            offset = 0
+        total = self.machine_events_count(machine_serial_number, event_type)
+        return {"events": list(self.machine_events_fetch(machine_serial_number, offset, limit, event_type)),
+                "total": total,
+                "event_types": self.machine_events_types_with_usage(machine_serial_number),
+                "newer_cursor": str(max(0, offset - limit)) if offset else None,
+                "older_cursor": str(offset + limit) if offset + limit < total else None}
+
+    def get_last_machine_heartbeats(self, machine_serial_number):
+        return []
+
+    # distributed query result rows
+
+    def distributed_query_result_rows_count(self, probe):
+        return 0
+
+    def distributed_query_result_rows_fetch(self, probe, offset=0, limit=0):
+        return []
+
+    def distributed_query_result_rows_terms(self, probe, column, size=10):
+        return []
+
     # probe events
 
     def probe_events_fetch(self, probe, offset=0, limit=0, **search_dict):
@@ -38,3 +71,8 @@ class BaseEventStore(object):
 
     def get_app_hist_data(self, interval, bucket_number, tag=None, event_type=None):
         return []
+
+    # retention
+
+    def prune_events(self, before=None):
+        return []
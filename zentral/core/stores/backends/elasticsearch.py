@@ -1,3 +1,7 @@
+import base64
+import copy
+from datetime import datetime, timedelta, timezone
+import json
 import logging
 import random
 import time
@@ -5,6 +9,7 @@ import urllib.parse
 from dateutil import parser
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 from elasticsearch.exceptions import ConnectionError, RequestError
+from elasticsearch.helpers import bulk
 from requests_aws4auth import AWS4Auth
 from zentral.core.events import event_from_event_d, event_tags, event_types
 from zentral.core.exceptions import ImproperlyConfigured
@@ -68,6 +73,24 @@ class EventStore(BaseEventStore):
         "week": "w",
         "month": "M",
     }
+    # generous upper bounds of the interval units, to find the indices overlapping a histogram
+    INTERVAL_TIMEDELTA = {
+        "hour": timedelta(hours=1),
+        "day": timedelta(days=1),
+        "week": timedelta(weeks=1),
+        "month": timedelta(days=31),
+    }
+    ROLLING_INTERVALS = ("day", "week")
+    # one index per probe for the distributed query result rows,
+    # to keep their arbitrary columns out of the events index mappings
+    # bulk indexed when the distributed query result events are stored
+    DISTRIBUTED_QUERY_RESULT_EVENT_TYPE = "osquery_distributed_query_result"
+    DISTRIBUTED_QUERY_RESULT_ROW_EVENT_TYPE = "osquery_distributed_query_result_row"
+    # above this number of rolling indices, search the whole pattern
+    MAX_READ_INDICES = 60
+    # the events created before this delay, or in the future, are written to the rolling index of
+    # their ingestion time, to keep the clients with a wrong clock from creating arbitrary indices
+    MAX_WRITE_INDEX_AGE = timedelta(days=30)
 
     def __init__(self, config_d, test=False):
         super(EventStore, self).__init__(config_d)
@@ -108,18 +131,134 @@ class EventStore(BaseEventStore):
         self._es = Elasticsearch(**kwargs)
 
         self.index = config_d['index']
-        self.read_index = config_d.get('read_index', self.index)
+        # rolling indices
+        # {index}-YYYY.MM.DD or {index}-YYYY.wWW write indices,
+        # created from a template, behind the {index} alias.
+        self.rolling_interval = config_d.get('rolling_interval')
+        if self.rolling_interval:
+            if self.rolling_interval not in self.ROLLING_INTERVALS:
+                raise ImproperlyConfigured("Unknown rolling_interval {}".format(self.rolling_interval))
+            self.rolling_index_pattern = "{}-*".format(self.index)
+            default_read_index = self.rolling_index_pattern
+        else:
+            self.rolling_index_pattern = None
+            default_read_index = self.index
+        self.read_index = config_d.get('read_index', default_read_index)
+        self.retention_days = config_d.get('retention_days')
         self.kibana_base_url = config_d.get('kibana_base_url', None)
         self.INDEX_CONF["settings"]["number_of_shards"] = config_d.get("number_of_shards", 1)
         self.test = test
 
+    # rolling indices
+
+    def _get_rolling_index_suffix(self, d):
+        if self.rolling_interval == "day":
+            return d.strftime("%Y.%m.%d")
+        else:
+            iso_year, iso_week, _ = d.isocalendar()
+            return "{:04d}.w{:02d}".format(iso_year, iso_week)
+
+    def _get_rolling_index_period(self, index):
+        """Return the first day and the day after the last day of a rolling index."""
+        prefix = "{}-".format(self.index)
+        if not index.startswith(prefix):
+            raise ValueError("Not a rolling index")
+        suffix = index[len(prefix):]
+        if self.rolling_interval == "day":
+            start = datetime.strptime(suffix, "%Y.%m.%d").date()
+            return start, start + timedelta(days=1)
+        else:
+            start = datetime.strptime("{}-1".format(suffix), "%G.w%V-%u").date()
+            return start, start + timedelta(weeks=1)
+
+    def _get_write_index(self, created_at):
+        if not self.rolling_interval:
+            return self.index
+        return "{}-{}".format(self.index, self._get_rolling_index_suffix(created_at))
+
+    def _get_event_write_index(self, created_at):
+        if not self.rolling_interval:
+            return self.index
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        now = datetime.utcnow()
+        if created_at > now or created_at < now - self.MAX_WRITE_INDEX_AGE:
+            created_at = now
+        return self._get_write_index(created_at)
+
+    def _get_read_index(self, start=None):
+        """Return the index, indices or pattern to search for the events created after start."""
+        if not self.rolling_interval or start is None:
+            return self.read_index
+        indices = []
+        day = start.date()
+        today = datetime.utcnow().date()
+        while day <= today:
+            index = self._get_write_index(day)
+            if not indices or indices[-1] != index:
+                indices.append(index)
+            day += timedelta(days=1)
+            if len(indices) > self.MAX_READ_INDICES:
+                return self.read_index
+        return ",".join(indices)
+
+    def _get_distributed_query_result_rows_index(self, probe_id):
+        # not matching the {index}-* rolling indices pattern
+        return "{}_dq_{}".format(self.index, probe_id)
+
+    def _get_distributed_query_result_rows_index_template(self):
+        template = copy.deepcopy(self.INDEX_CONF)
+        template["template"] = self._get_distributed_query_result_rows_index("*")
+        return template
+
+    def _get_index_template(self):
+        template = copy.deepcopy(self.INDEX_CONF)
+        template["template"] = self.rolling_index_pattern
+        template["aliases"] = {self.index: {}}
+        return template
+
+    def prune_events(self, before=None):
+        """
+        Delete the rolling indices only containing events older than before.
+
+        Defaults to the configured retention. Returns the names of the deleted indices.
+        """
+        if not self.rolling_interval:
+            logger.warning("Store %s: only rolling indices can be pruned", self.name)
+            return []
+        if before is None:
+            if not self.retention_days:
+                return []
+            before = datetime.utcnow() - timedelta(days=self.retention_days)
+        before = before.date()
+        deleted_indices = []
+        for index in sorted(self._es.indices.get_alias(index=self.rolling_index_pattern)):
+            try:
+                _, end = self._get_rolling_index_period(index)
+            except ValueError:
+                logger.warning("Store %s: skip unknown index %s", self.name, index)
+                continue
+            if end <= before:
+                self._es.indices.delete(index=index)
+                logger.info("Store %s: index %s deleted", self.name, index)
+                deleted_indices.append(index)
+        return deleted_indices
+
     def wait_and_configure(self):
         for i in range(self.MAX_CONNECTION_ATTEMPTS):
-            # get or create index
+            # get or create index, or update index template
             try:
-                if not self._es.indices.exists(self.index):
+                if self.rolling_interval:
+                    if self._es.indices.exists(self.index) and not self._es.indices.exists_alias(name=self.index):
+                        raise ImproperlyConfigured("Index {} exists and cannot be used "
+                                                   "as the rolling indices alias".format(self.index))
+                    self._es.indices.put_template(self.index, body=self._get_index_template())
+                    logger.info("Index template %s updated", self.index)
+                elif not self._es.indices.exists(self.index):
                     self._es.indices.create(self.index, body=self.INDEX_CONF)
                     logger.info("Index %s created", self.index)
+                self._es.indices.put_template("{}_dq".format(self.index),
+                                              body=self._get_distributed_query_result_rows_index_template())
             except ConnectionError as e:
                 s = (i + 1) * random.uniform(0.9, 1.1)
                 logger.warning('Could not connect to server %d/%d. Sleep %ss',
@@ -133,9 +272,12 @@ class EventStore(BaseEventStore):
                 else:
                     raise
             # wait for index recovery
+            recovery_index = self.rolling_index_pattern or self.index
             while True:
-                recovery = self._es.indices.get(self.index, feature="_recovery")
-                shards = recovery.get(self.index, {}).get("shards", [])
+                recovery = self._es.indices.get(recovery_index, feature="_recovery")
+                shards = [shard
+                          for index_recovery in recovery.values()
+                          for shard in index_recovery.get("shards", [])]
                 if any(c["stage"] != "DONE" for c in shards):
                     s = 1000 / random.randint(1000, 3000)
                     time.sleep(s)
@@ -166,12 +308,30 @@ class EventStore(BaseEventStore):
         if isinstance(event, dict):
             event = event_from_event_d(event)
         doc_type, body = self._serialize_event(event)
+        if doc_type == self.DISTRIBUTED_QUERY_RESULT_ROW_EVENT_TYPE:
+            index = self._get_distributed_query_result_rows_index(event.payload["probe"]["id"])
+        else:
+            index = self._get_event_write_index(event.metadata.created_at)
         try:
-            self._es.index(index=self.index, doc_type=doc_type, body=body)
+            self._es.index(index=index, doc_type=doc_type, body=body)
             if self.test:
-                self._es.indices.refresh(self.index)
+                self._es.indices.refresh(index)
         except:
             logger.exception('Could not add event to elasticsearch index')
+        if doc_type == self.DISTRIBUTED_QUERY_RESULT_EVENT_TYPE:
+            self._bulk_index_distributed_query_result_rows(event)
+
+    def _bulk_index_distributed_query_result_rows(self, event):
+        def iter_actions():
+            for row_event in event.iter_result_row_events():
+                doc_type, body = self._serialize_event(row_event)
+                yield {"_index": self._get_distributed_query_result_rows_index(row_event.payload["probe"]["id"]),
+                       "_type": doc_type,
+                       "_source": body}
+        try:
+            bulk(self._es, iter_actions(), refresh=self.test)
+        except Exception:
+            logger.exception('Could not bulk index the distributed query result rows')
 
     # machine events
 
@@ -192,15 +352,71 @@ class EventStore(BaseEventStore):
             body['query']['bool']['filter'].append({'term': {'tags': tag}})
         return body
 
+    def _dump_machine_events_cursor(self, reverse, sort_values):
+        return base64.urlsafe_b64encode(json.dumps([reverse, sort_values]).encode("utf-8")).decode("ascii")
+
+    def _load_machine_events_cursor(self, cursor):
+        try:
+            reverse, sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        except (TypeError, ValueError):
+            logger.warning("Invalid machine events cursor %s", cursor)
+            return False, None
+        return bool(reverse), sort_values
+
+    def fetch_machine_events_page(self, machine_serial_number, event_type=None, limit=10, cursor=None):
+        """
+        Return a page of machine events with one search.
+
+        The event type filter is a post filter, to aggregate the event types of all the machine events.
+        The pages are fetched with search_after. The newer pages are fetched in reverse order.
+        """
+        body = self._get_machine_events_body(machine_serial_number)
+        if event_type:
+            body['post_filter'] = {'type': {'value': event_type}}
+        reverse, search_after = False, None
+        if cursor:
+            reverse, search_after = self._load_machine_events_cursor(cursor)
+        if search_after:
+            body['search_after'] = search_after
+        order = 'asc' if reverse else 'desc'
+        body.update({
+            'size': limit + 1,  # one more to know if there is another page
+            'sort': [{'created_at': order}, {'_uid': order}],
+            'aggs': {
+                'doc_types': {
+                    'terms': {
+                        'field': '_type',
+                        'size': len(event_types)
+                    }
+                }
+            }
+        })
+        r = self._es.search(index=self.read_index, body=body)
+        hits = r['hits']['hits']
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        if reverse:
+            hits.reverse()
+        newer_cursor = older_cursor = None
+        if hits:
+            if (search_after and not reverse) or (reverse and has_more):
+                newer_cursor = self._dump_machine_events_cursor(True, hits[0]['sort'])
+            if reverse or has_more:
+                older_cursor = self._dump_machine_events_cursor(False, hits[-1]['sort'])
+        return {"events": [self._deserialize_event(hit['_type'], hit['_source']) for hit in hits],
+                "total": r['hits']['total'],
+                "event_types": {bucket['key']: bucket['doc_count']
+                                for bucket in r['aggregations']['doc_types']['buckets']},
+                "newer_cursor": newer_cursor,
+                "older_cursor": older_cursor}
+
     def machine_events_count(self, machine_serial_number, event_type=None):
-        # TODO: count could work from first fetch with elasticsearch.
         body = self._get_machine_events_body(machine_serial_number, event_type)
         body['size'] = 0
         r = self._es.search(index=self.read_index, body=body)
         return r['hits']['total']
 
     def machine_events_fetch(self, machine_serial_number, offset=0, limit=0, event_type=None):
-        # TODO: count could work from first fetch with elasticsearch.
         body = self._get_machine_events_body(machine_serial_number, event_type)
         if offset:
             body['from'] = offset
@@ -291,6 +507,46 @@ class EventStore(BaseEventStore):
                                    parser.parse(bucket["max_created_at"]["value_as_string"])))
         return heartbeats
 
+    # distributed query result rows
+
+    def _search_distributed_query_result_rows(self, probe, body):
+        self.wait_and_configure_if_necessary()
+        # no probe metadata filter, the index only contains the rows of the probe
+        return self._es.search(index=self._get_distributed_query_result_rows_index(probe.pk),
+                               body=body, ignore_unavailable=True)
+
+    def distributed_query_result_rows_count(self, probe):
+        r = self._search_distributed_query_result_rows(probe, {'size': 0})
+        return r['hits']['total']
+
+    def distributed_query_result_rows_fetch(self, probe, offset=0, limit=0):
+        body = {'sort': [{'created_at': 'desc'}]}
+        if offset:
+            body['from'] = offset
+        if limit:
+            body['size'] = limit
+        r = self._search_distributed_query_result_rows(probe, body)
+        for hit in r['hits']['hits']:
+            yield self._deserialize_event(hit['_type'], hit['_source'])
+
+    def distributed_query_result_rows_terms(self, probe, column, size=10):
+        body = {'size': 0,
+                'aggs': {
+                    'column': {
+                        'terms': {
+                            'field': '{}.row.{}'.format(self.DISTRIBUTED_QUERY_RESULT_ROW_EVENT_TYPE, column),
+                            'size': size
+                        }
+                    }
+                }}
+        r = self._search_distributed_query_result_rows(probe, body)
+        agg_result = r.get('aggregations', {}).get('column', {})
+        values = [(b['key'], b['doc_count']) for b in agg_result.get('buckets', [])]
+        sum_other_doc_count = agg_result.get('sum_other_doc_count')
+        if sum_other_doc_count:
+            values.append((None, sum_other_doc_count))
+        return values
+
     # probe events
 
     def _get_probe_events_body(self, probe, **search_dict):
@@ -599,9 +855,11 @@ class EventStore(BaseEventStore):
                   }
                 }}
         self.wait_and_configure_if_necessary()
-        r = self._es.search(index=self.read_index, body=body)
+        start = datetime.utcnow() - bucket_number * self.INTERVAL_TIMEDELTA[interval]
+        r = self._es.search(index=self._get_read_index(start), body=body, ignore_unavailable=True)
+        # no aggregations if none of the rolling indices exist
         return [(parser.parse(b["key_as_string"]), b["doc_count"], b["unique_msn"]["value"])
-                for b in r['aggregations']['buckets']['buckets']]
+                for b in r.get('aggregations', {}).get('buckets', {}).get('buckets', [])]
 
     def close(self):
         for connection in self._es.transport.connection_pool.connections:
@@ -92,6 +92,30 @@ def make_secret(module, business_unit=None):
     return signing.dumps(data, key=API_SECRET)
 
 
+class ZlibReader(object):
+    """Minimal file object to read a zlib compressed stream."""
+    def __init__(self, fileobj, chunk_size=65536):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj()
+        self.eof = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(self.chunk_size), b""))
+        while not self.eof:
+            compressed_data = self.decompressor.unconsumed_tail
+            if not compressed_data:
+                compressed_data = self.fileobj.read(self.chunk_size)
+                if not compressed_data:
+                    self.eof = True
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(compressed_data, size)
+            if data:
+                return data
+        return b""
+
+
 class JSONPostAPIView(View):
     payload_encoding = 'utf-8'
 
@@ -114,22 +138,28 @@ class JSONPostAPIView(View):
     def do_post(self, data):
         raise NotImplementedError
 
+    def get_payload_fileobj(self, request):
+        """
+        Return a file object to read the decompressed payload, or None if the encoding is not supported.
+        """
+        content_encoding = request.META.get('HTTP_CONTENT_ENCODING', None)
+        if not content_encoding:
+            return request
+        elif content_encoding == "deflate" \
+                or "santa" in self.user_agent and content_encoding == "zlib" \
+                or self.user_agent == "Zentral/mnkpf 0.1" and content_encoding == "gzip":
+            return ZlibReader(request)
+        elif content_encoding == "gzip":
+            return GzipFile(fileobj=request)
+
     def post(self, request, *args, **kwargs):
-        payload = request.body
+        payload_fileobj = self.get_payload_fileobj(request)
+        if payload_fileobj is None:
+            return HttpResponse("Unsupported Media Type", status=415)
+        payload = payload_fileobj.read()
         if not payload:
             data = payload
         else:
-            content_encoding = request.META.get('HTTP_CONTENT_ENCODING', None)
-            if content_encoding:
-                # try to decompress the payload.
-                if content_encoding == "deflate" \
-                   or "santa" in self.user_agent and content_encoding == "zlib" \
-                   or self.user_agent == "Zentral/mnkpf 0.1" and content_encoding == "gzip":
-                    payload = zlib.decompress(payload)
-                elif content_encoding == "gzip":
-                    payload = GzipFile(fileobj=request).read()
-                else:
-                    return HttpResponse("Unsupported Media Type", status=415)
             try:
                 payload = payload.decode(self.payload_encoding)
             except UnicodeDecodeError:
@@ -146,6 +176,9 @@ class JSONPostAPIView(View):
             logger.error("APIAuthError %s", auth_err, extra={'request': request})
             return HttpResponseForbidden(str(auth_err))
         response_data = self.do_post(data)
+        if isinstance(response_data, HttpResponse):
+            # already serialized
+            return response_data
         return JsonResponse(response_data)
 
 
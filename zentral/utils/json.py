@@ -1,5 +1,7 @@
+import codecs
 import json
 import os.path
+import re
 from django.utils import timezone
 
 
@@ -8,3 +10,172 @@ def log_data(data, directory, file_prefix):
                               timezone.now().strftime("%Y-%m-%d_%H.%M.%S.%f"))
     with open(os.path.join(directory, filename), "w", encoding="utf-8") as f:
         json.dump(data, f)
+
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+STRING_SPECIAL_CHAR_RE = re.compile(r'["\\]')
+CONTAINER_SPECIAL_CHAR_RE = re.compile(r'["\[\]{}]')
+SCALAR_END_RE = re.compile(r'[,\]} \t\n\r]')
+
+
+class JSONValueScanner(object):
+    """Find the end of a JSON value, one chunk at a time, without decoding it."""
+    def __init__(self):
+        self.kind = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def scan(self, buf, pos):
+        """Return the end of the value in buf, or None if the value continues in the next chunk."""
+        if self.kind is None:
+            if pos >= len(buf):
+                return None
+            char = buf[pos]
+            if char in "[{":
+                self.kind = "container"
+            elif char == '"':
+                self.kind = "string"
+                self.in_string = True
+                pos += 1
+            else:
+                self.kind = "scalar"
+        if self.kind == "scalar":
+            m = SCALAR_END_RE.search(buf, pos)
+            return m.start() if m else None
+        while True:
+            if self.escape:
+                if pos >= len(buf):
+                    return None
+                pos += 1
+                self.escape = False
+            if self.in_string:
+                m = STRING_SPECIAL_CHAR_RE.search(buf, pos)
+                if not m:
+                    return None
+                pos = m.end()
+                if m.group() == "\\":
+                    self.escape = True
+                    continue
+                self.in_string = False
+                if self.depth == 0:
+                    return pos
+            else:
+                m = CONTAINER_SPECIAL_CHAR_RE.search(buf, pos)
+                if not m:
+                    return None
+                pos = m.end()
+                char = m.group()
+                if char == '"':
+                    self.in_string = True
+                elif char in "[{":
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        return pos
+
+
+class JSONStreamReader(object):
+    """Decode JSON tokens and values from a binary file object, one chunk at a time."""
+    def __init__(self, fileobj, encoding="utf-8", chunk_size=65536):
+        self.fileobj = fileobj
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        # append the next chunk to the unparsed part of the buffer. False at the end of the stream.
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            text = self.text_decoder.decode(b"", final=True)
+        else:
+            text = self.text_decoder.decode(chunk)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._read():
+                return
+
+    def expect(self, *chars):
+        self._skip_whitespace()
+        char = self.buf[self.pos:self.pos + 1]
+        if char not in chars:
+            raise json.JSONDecodeError("Expecting {}".format(" or ".join(repr(c) for c in chars)),
+                                       self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def skip_if(self, char):
+        self._skip_whitespace()
+        if self.buf.startswith(char, self.pos):
+            self.pos += 1
+            return True
+        return False
+
+    def expect_end(self):
+        self._skip_whitespace()
+        if self.pos < len(self.buf):
+            raise json.JSONDecodeError("Extra data", self.buf, self.pos)
+
+    def decode_value(self):
+        # the end of the value is found first, scanning each chunk only once,
+        # then the value is decoded in one pass
+        self._skip_whitespace()
+        scanner = JSONValueScanner()
+        parts = []
+        while True:
+            end = scanner.scan(self.buf, self.pos)
+            if end is not None:
+                parts.append(self.buf[self.pos:end])
+                self.pos = end
+                break
+            parts.append(self.buf[self.pos:])
+            self.pos = len(self.buf)
+            if not self._read():
+                break
+        text = "".join(parts)
+        value, end = self.json_decoder.raw_decode(text)
+        if end < len(text):
+            raise json.JSONDecodeError("Extra data", text, end)
+        return value
+
+
+def iter_json_object_items(fileobj, array_keys=(), encoding="utf-8", chunk_size=65536):
+    """
+    Parse a JSON object incrementally from a binary file object.
+
+    Yield the (key, value) items of the object. The values of the array_keys
+    are yielded one array item at a time, as (key, array item).
+    Raise json.JSONDecodeError or UnicodeDecodeError if the payload is not valid.
+    """
+    reader = JSONStreamReader(fileobj, encoding, chunk_size)
+    reader.expect("{")
+    if not reader.skip_if("}"):
+        while True:
+            key = reader.decode_value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name", reader.buf, reader.pos)
+            reader.expect(":")
+            if key in array_keys:
+                reader.expect("[")
+                if not reader.skip_if("]"):
+                    while True:
+                        yield key, reader.decode_value()
+                        if reader.expect(",", "]") == "]":
+                            break
+            else:
+                yield key, reader.decode_value()
+            if reader.expect(",", "}") == "}":
+                break
+    reader.expect_end()